@@ -6,22 +6,68 @@ import sys
 import anyio
 import logging
 import uuid
-import io
 import inspect
+import math
+import time
+from bisect import bisect
+from collections import deque
 from itertools import count
 
 import pamqp
+import pamqp.frame
 
 from . import constants as amqp_constants
 from . import frame as amqp_frame
 from . import exceptions
-from . import properties as amqp_properties
+from .content import BodyStream
 from .envelope import Envelope, ReturnEnvelope
-from .future import Future
+from .future import Future, ConfirmFuture
 from .exceptions import AmqpClosedConnection, SynchronizationError
 
 logger = logging.getLogger(__name__)
 
+# Number of delivered messages that may be waiting for a consumer, unless
+# basic_qos limits the number of unacknowledged messages
+CONSUMER_BUFFER_SIZE = 30
+
+# Handlers for the methods a server sends, by frame index, i.e.
+# class_id << 16 | method_id. Channel.__init__ binds them.
+METHOD_HANDLERS = {
+    pamqp.specification.Channel.OpenOk.index: 'open_ok',
+    pamqp.specification.Channel.FlowOk.index: 'flow_ok',
+    pamqp.specification.Channel.CloseOk.index: 'close_ok',
+    pamqp.specification.Channel.Close.index: 'server_channel_close',
+
+    pamqp.specification.Exchange.DeclareOk.index: 'exchange_declare_ok',
+    pamqp.specification.Exchange.BindOk.index: 'exchange_bind_ok',
+    pamqp.specification.Exchange.UnbindOk.index: 'exchange_unbind_ok',
+    pamqp.specification.Exchange.DeleteOk.index: 'exchange_delete_ok',
+
+    pamqp.specification.Queue.DeclareOk.index: 'queue_declare_ok',
+    pamqp.specification.Queue.DeleteOk.index: 'queue_delete_ok',
+    pamqp.specification.Queue.BindOk.index: 'queue_bind_ok',
+    pamqp.specification.Queue.UnbindOk.index: 'queue_unbind_ok',
+    pamqp.specification.Queue.PurgeOk.index: 'queue_purge_ok',
+
+    pamqp.specification.Basic.QosOk.index: 'basic_qos_ok',
+    pamqp.specification.Basic.ConsumeOk.index: 'basic_consume_ok',
+    pamqp.specification.Basic.CancelOk.index: 'basic_cancel_ok',
+    pamqp.specification.Basic.GetEmpty.index: 'basic_get_empty',
+    pamqp.specification.Basic.Cancel.index: 'server_basic_cancel',
+    pamqp.specification.Basic.Ack.index: 'basic_server_ack',
+    pamqp.specification.Basic.Nack.index: 'basic_server_nack',
+    pamqp.specification.Basic.RecoverOk.index: 'basic_recover_ok',
+
+    pamqp.specification.Confirm.SelectOk.index: 'confirm_select_ok',
+}
+
+# Handlers for methods that are followed by content
+CONTENT_HANDLERS = {
+    pamqp.specification.Basic.GetOk.index: 'basic_get_ok',
+    pamqp.specification.Basic.Deliver.index: 'basic_deliver',
+    pamqp.specification.Basic.Return.index: 'basic_return',
+}
+
 
 class BasicListener:
     """This class is returned by :meth:Channel.new_consumer`.
@@ -32,12 +78,7 @@ class BasicListener:
         self.channel = channel
         self.kwargs = kwargs
         self.consumer_tag = consumer_tag
-
-    async def _data(self, channel, msg, env, prop):
-        if msg is None:
-            await self._q_w.send(None)
-        else:
-            await self._q_w.send((msg, env, prop))
+        self._stream = None  # the BodyStream that get() returned last
 
     if sys.version_info >= (3,5,3):
         def __aiter__(self):
@@ -47,27 +88,65 @@ class BasicListener:
             return self
 
     async def __anext__(self):
-        res = await self._q_r.receive()
+        try:
+            res = await self.get()
+        except anyio.EndOfStream:
+            # the channel has been closed
+            raise StopAsyncIteration
         if res is None:
             raise StopAsyncIteration
         return res
 
     async def get(self):
-        return await self._q_r.receive()
+        # The next message can't arrive before the previous body has been
+        # read, so discard whatever is left of it.
+        await self._close_stream()
+        res = await self._q_r.receive()
+        if res is not None:
+            self.channel._consumer_took(self.consumer_tag)
+            if type(res[0]) is BodyStream:
+                res[0]._take()
+                self._stream = res[0]
+        return res
+
+    async def _close_stream(self):
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            await stream.aclose()
+
+    @property
+    def queue_depth(self):
+        """The number of received messages that are waiting to be read"""
+        return self.channel.queue_depth(self.consumer_tag)
 
     async def __aenter__(self):
-        await self.channel.basic_consume(self._data, consumer_tag=self.consumer_tag, **self.kwargs)
-        self._q_w,self._q_r = anyio.create_memory_object_stream(30)  # TODO: 2 + possible prefetch
+        self._q_w,self._q_r = anyio.create_memory_object_stream(
+            self.channel._consumer_buffer_size(self.kwargs.get('no_ack', False))
+        )
+        res = await self.channel._basic_consume(self._q_w, consumer_tag=self.consumer_tag, **self.kwargs)
+        self.consumer_tag = res['consumer_tag']
         return self
 
     async def __aexit__(self, *tb):
         async with anyio.open_cancel_scope(shield=True):
+            # Unread bodies would block the reader, which then can't
+            # receive the CancelOk. Discard them, and anything that arrives
+            # before the cancellation is through.
+            await self._close_stream()
+            while True:
+                try:
+                    message = await self._q_r.receive_nowait()
+                except (anyio.WouldBlock, anyio.EndOfStream):
+                    break
+                if message is not None and type(message[0]) is BodyStream:
+                    await message[0].aclose()
+            await self._q_r.aclose()
             try:
                 await self.channel.basic_cancel(self.consumer_tag)
             except AmqpClosedConnection:
                 pass
         await self._q_w.aclose()
-        await self._q_r.aclose()
+        self.channel._consumer_depth.pop(self.consumer_tag, None)
         # these messages are not acknowledged, thus deleting the queue will
         # not lose them
 
@@ -81,6 +160,124 @@ class BasicListener:
         raise RuntimeError("You need to use 'async for'.")
 
 
+class Publisher:
+    """This class is returned by :meth:`Channel.publisher`.
+    It publishes messages that only differ in their body.
+
+    The Basic.Publish method frame and the content header are encoded
+    once, when the publisher is created. Changing the properties
+    afterwards has no effect.
+    """
+
+    def __init__(
+        self, channel, exchange_name, routing_key, properties=None, mandatory=False, immediate=False
+    ):
+        self.channel = channel
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        method = pamqp.specification.Basic.Publish(
+            exchange=exchange_name,
+            routing_key=routing_key,
+            mandatory=mandatory,
+            immediate=immediate
+        )
+        self._template = amqp_frame.ContentTemplate(
+            channel.channel_id, method, properties, channel.protocol.server_frame_max
+        )
+
+    def _marshal(self, payload):
+        payload = amqp_frame.body_view(payload)
+        metrics = self.channel.protocol.metrics
+        if metrics is not None:
+            self.channel._count_publish(metrics, len(payload))
+        return self._template.marshal(payload)
+
+    async def publish(self, payload):
+        """Publish a message with body @payload, like :meth:`Channel.publish`."""
+        return await self.channel._send_message(self._marshal(payload))
+
+    async def publish_many(self, payloads):
+        """Publish a message for each body in @payloads, like
+        :meth:`Channel.publish_many`."""
+        return await self.channel._send_messages([self._marshal(payload) for payload in payloads])
+
+
+class AckBatcher:
+    """The messages of a channel that haven't been settled (acked, nacked
+    or rejected) yet, for :meth:`Channel.coalesce_acks`.
+
+    Acks are held back until :meth:`take` turns them into as few frames
+    as possible: a single ack with ``multiple=True`` for the acked
+    messages that were delivered before the oldest unsettled one, and
+    one ack for each message that was acked out of order.
+    """
+
+    def __init__(self, max_acks, max_delay):
+        self.max_acks = max_acks
+        self.max_delay = max_delay
+        self.n_acked = 0
+        # the number of acks that are held back
+        self.pending = anyio.create_event()
+        # set when acks are held back, for the task that flushes them
+        self._unsettled = {}
+        # delivery tag => whether it has been acked, in delivery order
+
+    def __len__(self):
+        return len(self._unsettled)
+
+    def delivered(self, delivery_tag):
+        self._unsettled[delivery_tag] = False
+
+    def ack(self, delivery_tag):
+        """Hold back the ack of @delivery_tag. Returns ``False`` if that
+        message isn't known, and needs to be acked right away."""
+        if self._unsettled.get(delivery_tag) is not False:
+            return False
+        self._unsettled[delivery_tag] = True
+        self.n_acked += 1
+        return True
+
+    def settled(self, delivery_tag, multiple):
+        """@delivery_tag (and, with @multiple, everything before it) is
+        settled by a frame that isn't held back."""
+        unsettled = self._unsettled
+        if not multiple:
+            if unsettled.pop(delivery_tag, None):
+                self.n_acked -= 1
+            return
+        # delivery tags only increase, so these are at the start
+        while unsettled:
+            tag = next(iter(unsettled))
+            if tag > delivery_tag:
+                break
+            if unsettled.pop(tag):
+                self.n_acked -= 1
+
+    def clear(self):
+        self._unsettled.clear()
+        self.n_acked = 0
+
+    def take(self):
+        """The Basic.Ack frames for the acks that are held back"""
+        if not self.n_acked:
+            return []
+        unsettled = self._unsettled
+        acked = [tag for tag, done in unsettled.items() if done]
+        for tag in acked:
+            del unsettled[tag]
+        self.n_acked = 0
+
+        # A multiple ack covers every unsettled message up to its tag
+        oldest = next(iter(unsettled), None)
+        n_before = len(acked) if oldest is None else bisect(acked, oldest)
+        requests = [
+            pamqp.specification.Basic.Ack(tag, False) for tag in acked[n_before:]
+        ]
+        if n_before:
+            requests.insert(0, pamqp.specification.Basic.Ack(acked[n_before - 1], n_before > 1))
+        return requests
+
+
 class Channel:
     _q_w,_q_r = None,None # for returned messages
 
@@ -98,15 +295,53 @@ class Channel:
         self.delivery_tag_iter = None
         # counting iterator, used for mapping delivered messages
         # to publisher confirms
+        self._confirm_window_size = None
+        self._confirm_window = None
+        # semaphore, limits the number of unconfirmed messages if publish()
+        # shouldn't wait for confirmation
+        self._confirm_futures = deque()
+        # ConfirmFuture objects in delivery tag order, i.e. the first one
+        # is the oldest message that may not have been confirmed yet
+        self._n_unconfirmed = 0
+        self._confirms_done = None
+        self._nacked = []
+
+        self.prefetch_count = 0
+        # as set by the last successful basic_qos
+        self._auto_qos = None
+        # the settings of auto_qos(), if it is active
+        self._consumer_depth = {}
+        # consumer_tag => number of messages waiting for that consumer
+        self._n_consumed = 0
+        # number of messages handed to consumers, for measuring their rate
+        self._stream_body_consumers = set()
+        # tags of the consumers that get bodies as BodyStream objects
+        self._no_ack_consumers = set()
+        # tags of the consumers whose messages needn't be acked
+        self._get_no_ack = False
+        # the no_ack argument of the pending basic_get
+        self._last_delivery_tag = 0
+        # of the last message received, 0 if there was none
+        self._acks = None
+        # AckBatcher, if acks are coalesced
 
         self._write_lock = anyio.create_lock()
+        self._streaming = None
+        # set when the message that publish_stream() is sending is complete
 
         self._futures = {}
-        self._ctag_events = {}
+
+        self._method_handlers = {
+            index: getattr(self, name) for index, name in METHOD_HANDLERS.items()
+        }
+        self._content_handlers = {
+            index: getattr(self, name) for index, name in CONTENT_HANDLERS.items()
+        }
 
     def __aiter__(self):
         if self._q_w is None:
-            self._q_w,self._q_r = anyio.create_memory_object_stream(30)  # TODO: 2 + possible prefetch
+            # Returned messages are not subject to basic_qos.
+            self._q_w,self._q_r = anyio.create_memory_object_stream(CONSUMER_BUFFER_SIZE)
         return self
 
     if sys.version_info < (3,5,3):
@@ -120,6 +355,11 @@ class Channel:
             raise StopAsyncIteration
         return res
 
+    @property
+    def outstanding_futures(self):
+        """The number of replies and publisher confirms being waited for"""
+        return len(self._futures) + len(self._confirm_futures)
+
     def _add_future(self, fut):
         self._futures[fut.rpc_name] = fut
 
@@ -142,7 +382,10 @@ class Channel:
         return not self.close_event.is_set()
 
     async def connection_closed(self, server_code=None, server_reason=None, exception=None):
-        for future in self._futures.values():
+        futures = list(self._futures.values())
+        futures.extend(self._confirm_futures)
+        self._confirm_futures.clear()
+        for future in futures:
             if future.done():
                 continue
             if exception is None:
@@ -154,50 +397,51 @@ class Channel:
                 exception = exceptions.ChannelClosed(**kwargs)
             await future.set_exception(exception)
 
+        content = self.protocol._contents.get(self.channel_id)
+        if content is not None and content.stream is not None:
+            await content.stream._end(exception or exceptions.ChannelClosed())
+        await self._stop_ack_batching()
+
         self.protocol.release_channel_id(self.channel_id)
         await self.close_event.set()
+        self._auto_qos = None
         if self._q_w is not None:
             await self._q_w.aclose()
+        await self._close_consumer_queues()
+        if self._n_unconfirmed:
+            # wake up publishers and wait_for_confirms()
+            if self._confirm_window is not None:
+                for _ in range(self._n_unconfirmed):
+                    await self._confirm_window.release()
+            await self._confirms_done.set()
+
+    async def _close_consumer_queues(self):
+        queues = list(self.consumer_queues.values())
+        self.consumer_queues.clear()
+        for queue in queues:
+            await queue.aclose()
 
     async def dispatch_frame(self, frame):
-        methods = {
-            pamqp.specification.Channel.OpenOk.name: self.open_ok,
-            pamqp.specification.Channel.FlowOk.name: self.flow_ok,
-            pamqp.specification.Channel.CloseOk.name: self.close_ok,
-            pamqp.specification.Channel.Close.name: self.server_channel_close,
-
-            pamqp.specification.Exchange.DeclareOk.name: self.exchange_declare_ok,
-            pamqp.specification.Exchange.BindOk.name: self.exchange_bind_ok,
-            pamqp.specification.Exchange.UnbindOk.name: self.exchange_unbind_ok,
-            pamqp.specification.Exchange.DeleteOk.name: self.exchange_delete_ok,
-
-            pamqp.specification.Queue.DeclareOk.name: self.queue_declare_ok,
-            pamqp.specification.Queue.DeleteOk.name: self.queue_delete_ok,
-            pamqp.specification.Queue.BindOk.name: self.queue_bind_ok,
-            pamqp.specification.Queue.UnbindOk.name: self.queue_unbind_ok,
-            pamqp.specification.Queue.PurgeOk.name: self.queue_purge_ok,
-
-            pamqp.specification.Basic.QosOk.name: self.basic_qos_ok,
-            pamqp.specification.Basic.ConsumeOk.name: self.basic_consume_ok,
-            pamqp.specification.Basic.CancelOk.name: self.basic_cancel_ok,
-            pamqp.specification.Basic.GetOk.name: self.basic_get_ok,
-            pamqp.specification.Basic.GetEmpty.name: self.basic_get_empty,
-            pamqp.specification.Basic.Deliver.name: self.basic_deliver,
-            pamqp.specification.Basic.Cancel.name: self.server_basic_cancel,
-            pamqp.specification.Basic.Ack.name: self.basic_server_ack,
-            pamqp.specification.Basic.Nack.name: self.basic_server_nack,
-            pamqp.specification.Basic.RecoverOk.name: self.basic_recover_ok,
-            pamqp.specification.Basic.Return.name: self.basic_return,
-
-            pamqp.specification.Confirm.SelectOk.name: self.confirm_select_ok,
-        }
-
-        if frame.name not in methods:
-            raise NotImplementedError("Frame %s is not implemented" % frame.name)
-
-        await methods[frame.name](frame)
+        try:
+            handler = self._method_handlers[frame.index]
+        except KeyError:
+            raise NotImplementedError("Frame %s is not implemented" % frame.name) from None
+        await handler(frame)
+
+    async def dispatch_content(self, content):
+        """Dispatch a method whose content has been received completely"""
+        method = content.method
+        await self._content_handlers[method.index](method, content)
+
+    async def _wait_streaming(self):
+        # Nothing may be sent on this channel between the frames of a
+        # message, which publish_stream() may take a while to send.
+        while self._streaming is not None:
+            await self._streaming.wait()
 
     async def _write_frame(self, frame, request, check_open=True, drain=True):
+        if self._streaming is not None:
+            await self._wait_streaming()
         await self.protocol.ensure_open()
         if not self.is_open and check_open:
             raise exceptions.ChannelClosed()
@@ -205,6 +449,30 @@ class Channel:
         if drain:
             await self.protocol._drain()
 
+    async def _write_data(self, data, check_open=True):
+        await self._check_writable(check_open)
+        await self._queue_data(data)
+
+    async def _check_writable(self, check_open=True):
+        # Raise a suitable exception if nothing may be sent on this channel
+        if self._streaming is not None:
+            await self._wait_streaming()
+        await self.protocol.ensure_open()
+        if not self.is_open and check_open:
+            raise exceptions.ChannelClosed()
+
+    async def _queue_data(self, data):
+        if type(data) is not amqp_frame.ContentStream:
+            await self.protocol._write_data(data)
+            return
+
+        streaming = self._streaming = anyio.create_event()
+        try:
+            await data.write(self.protocol)
+        finally:
+            self._streaming = None
+            await streaming.set()
+
     async def _write_frame_awaiting_response(
         self, waiter_id, channel_id, request, no_wait, check_open=True, drain=True
     ):
@@ -223,7 +491,15 @@ class Channel:
                 self._get_waiter(waiter_id)
                 await f.cancel()
                 raise
+            metrics = self.protocol.metrics
+            if metrics is None:
+                return await f()
+            started = time.perf_counter()
             res = await f()
+            seconds = time.perf_counter() - started
+            metrics.rpc_seconds.observe(seconds)
+            if metrics.hooks:
+                metrics.emit('rpc', channel=self, method=waiter_id, seconds=seconds)
             return res
 
 #
@@ -245,9 +521,13 @@ class Channel:
         """Close the channel."""
         if not self.is_open:
             raise exceptions.ChannelClosed("channel already closed or closing")
+        await self.flush_acks()
+        await self._stop_ack_batching()
         await self.close_event.set()
+        self._auto_qos = None
         if self._q_w is not None:
             await self._q_w.aclose()
+        await self._close_consumer_queues()
         request = pamqp.specification.Channel.Close(reply_code, reply_text, class_id=0, method_id=0)
         return await self._write_frame_awaiting_response('close', self.channel_id, request, no_wait=False, check_open=False)
 
@@ -519,32 +799,11 @@ class Channel:
         mandatory=False,
         immediate=False
     ):
-        async with self._write_lock:
-            if properties is None:
-                properties = {}
-
-            method_request = pamqp.specification.Basic.Publish(
-                exchange=exchange_name,
-                routing_key=routing_key,
-                mandatory=mandatory,
-                immediate=immediate
-            )
-
-            await self._write_frame(self.channel_id, method_request, drain=False)
-
-            header_request = pamqp.header.ContentHeader(
-                body_size=len(payload),
-                properties=pamqp.specification.Basic.Properties(**properties)
-            )
-            await self._write_frame(self.channel_id, header_request, drain=False)
-
-            frame_max = self.protocol.server_frame_max or len(payload)
-            for chunk in (payload[0 + i:frame_max + i] for i in range(0, len(payload), frame_max)):
-
-                content_request = pamqp.body.ContentBody(chunk)
-                await self._write_frame(self.channel_id, content_request, drain=False)
-
-        await self.protocol._drain()
+        data = self._marshal_publish(
+            payload, exchange_name, routing_key, properties, mandatory, immediate
+        )
+        await self._write_data(data)
+        await amqp_frame.wait_sent(data)
 
     async def basic_qos(self, prefetch_size=0, prefetch_count=0, connection_global=False):
         """Specifies quality of service.
@@ -564,11 +823,119 @@ class Channel:
                 bool: global=false means that the QoS settings should apply
                 per-consumer channel; and global=true to mean that the QoS
                 settings should apply per-channel.
+
+        Consumers that are started afterwards buffer up to
+        ``prefetch_count`` messages locally. Calling this method stops
+        :meth:`auto_qos`.
         """
+        self._auto_qos = None
+        return await self._basic_qos(prefetch_size, prefetch_count, connection_global)
+
+    async def _basic_qos(self, prefetch_size, prefetch_count, connection_global):
         request = pamqp.specification.Basic.Qos(
             prefetch_size, prefetch_count, connection_global
         )
-        return await self._write_frame_awaiting_response('basic_qos', self.channel_id, request, no_wait=False)
+        res = await self._write_frame_awaiting_response('basic_qos', self.channel_id, request, no_wait=False)
+        self.prefetch_count = prefetch_count
+        return res
+
+    async def auto_qos(
+        self,
+        min_prefetch=1,
+        max_prefetch=1000,
+        target_latency=1.0,
+        interval=1.0,
+        connection_global=False
+    ):
+        """Adjust the prefetch count to the speed of this channel's consumers.
+
+        Every ``interval`` seconds, the rate at which consumers took
+        messages is measured and the prefetch count is set to the number
+        of messages they process in ``target_latency`` seconds, limited to
+        ``min_prefetch`` … ``max_prefetch``. Small changes, and intervals
+        without any messages, are ignored.
+
+        Consumers that are started afterwards buffer up to
+        ``max_prefetch`` messages locally. Calling :meth:`basic_qos` stops
+        the adjustment.
+
+        Args:
+            min_prefetch:
+                int, the lowest prefetch count to use
+            max_prefetch:
+                int, the highest prefetch count to use
+            target_latency:
+                float, seconds' worth of messages to prefetch
+            interval:
+                float, seconds between adjustments
+            connection_global:
+                bool, passed to :meth:`basic_qos`
+        """
+        if not 0 < min_prefetch <= max_prefetch:
+            raise ValueError("Need 0 < min_prefetch <= max_prefetch")
+        prefetch = min(max(self.prefetch_count, min_prefetch), max_prefetch)
+        await self.basic_qos(prefetch_count=prefetch, connection_global=connection_global)
+
+        settings = self._auto_qos = (min_prefetch, max_prefetch, target_latency, interval, connection_global)
+        await self.protocol.nursery.spawn(self._run_auto_qos, settings)
+
+    async def _run_auto_qos(self, settings):
+        min_prefetch, max_prefetch, target_latency, interval, connection_global = settings
+        last_time = await anyio.current_time()
+        last_consumed = self._n_consumed
+        while True:
+            await anyio.sleep(interval)
+            if self._auto_qos is not settings or not self.is_open:
+                return
+            now = await anyio.current_time()
+            consumed = self._n_consumed - last_consumed
+            rate = consumed / (now - last_time)
+            last_time, last_consumed = now, self._n_consumed
+            if not consumed and not self.queue_depth():
+                # idle, which says nothing about the consumers' speed
+                continue
+
+            prefetch = min(max(math.ceil(rate * target_latency), min_prefetch), max_prefetch)
+            if abs(prefetch - self.prefetch_count) * 10 <= self.prefetch_count:
+                continue
+            logger.debug("Prefetch count %d => %d (%.1f msg/s)", self.prefetch_count, prefetch, rate)
+            try:
+                await self._basic_qos(0, prefetch, connection_global)
+            except (exceptions.ChannelClosed, AmqpClosedConnection):
+                return
+
+    def _consumer_buffer_size(self, no_ack):
+        """The number of messages a new consumer may need to buffer"""
+        if no_ack:
+            # basic_qos doesn't limit these
+            return CONSUMER_BUFFER_SIZE
+        if self._auto_qos is not None:
+            prefetch = self._auto_qos[1]
+        else:
+            prefetch = self.prefetch_count
+        if not prefetch:
+            return CONSUMER_BUFFER_SIZE
+        # room for the server's cancel notification, too
+        return prefetch + 2
+
+    def queue_depth(self, consumer_tag=None):
+        """The number of received messages that wait for a consumer.
+
+        Args:
+            consumer_tag:
+                str, the consumer to check. By default, the messages of
+                all consumers on this channel are counted.
+        """
+        if consumer_tag is None:
+            return sum(self._consumer_depth.values())
+        return self._consumer_depth.get(consumer_tag, 0)
+
+    def _consumer_took(self, consumer_tag):
+        """A consumer has taken a message from its queue"""
+        self._n_consumed += 1
+        depth = self._consumer_depth.get(consumer_tag)
+        if depth:
+            self._consumer_depth[consumer_tag] = depth - 1
 
     async def basic_qos_ok(self, frame):
         future = self._get_waiter('basic_qos')
@@ -578,9 +945,8 @@ class Channel:
     async def basic_server_nack(self, frame, delivery_tag=None):
         if delivery_tag is None:
             delivery_tag = frame.delivery_tag
-        fut = self._get_waiter('basic_server_ack_{}'.format(delivery_tag))
         logger.debug('Received nack for delivery tag %r', delivery_tag)
-        await fut.set_exception(exceptions.PublishFailed(delivery_tag))
+        await self._resolve_confirms(delivery_tag, frame.multiple, nack=True)
 
     def new_consumer(
         self,
@@ -590,7 +956,8 @@ class Channel:
         no_ack=False,
         exclusive=False,
         no_wait=False,
-        arguments=None
+        arguments=None,
+        stream_body=False
     ):
         """Starts the consumption of message from a queue.
 
@@ -619,6 +986,13 @@ class Channel:
                     bool, if set, the server will not respond to the method
                 arguments:
                     dict, AMQP arguments to be passed to the server
+                stream_body:
+                    bool, if set, each message's body is a
+                    :class:`async_amqp.content.BodyStream`, which is handed
+                    out as soon as the message starts to arrive. Read it
+                    before waiting on the connection in any way (e.g.
+                    with an RPC, or a confirmed publish): the connection
+                    stops receiving while its frames wait to be read.
 
         If no callback is given, return an iterable which returns (message,
         envelope, properties) triples.
@@ -645,7 +1019,8 @@ class Channel:
             no_ack=no_ack,
             exclusive=exclusive,
             no_wait=no_wait,
-            arguments=arguments
+            arguments=arguments,
+            stream_body=stream_body
         )
 
     async def basic_consume(
@@ -657,7 +1032,8 @@ class Channel:
         no_ack=False,
         exclusive=False,
         no_wait=False,
-        arguments=None
+        arguments=None,
+        stream_body=False
     ):
         """Starts the consumption of message from a queue.
         The callback will be called each time we're receiving a message.
@@ -682,6 +1058,14 @@ class Channel:
                     bool, if set, the server will not respond to the method
                 arguments:
                     dict, AMQP arguments to be passed to the server
+                stream_body:
+                    bool, if set, the callback gets each message's body as a
+                    :class:`async_amqp.content.BodyStream` as soon as the
+                    message starts to arrive. The callback should read it
+                    before it waits on the connection in any way (e.g.
+                    with an RPC, or a confirmed publish), as the connection
+                    stops receiving while its frames wait to be read.
+                    Whatever it leaves is discarded when it returns.
 
         The callback function will be called with three arguments,
         once for each message. Callbacks may be simple functions, async
@@ -699,6 +1083,58 @@ class Channel:
         responsible for calling :meth:`basic_client_ack` or
         :meth:`basic_client_nack` on the envelope's
         :attribute:`delivery_tag`.
+
+        The callback runs in a separate task, so a slow callback does not
+        hold up the connection. Messages are queued for it in the meantime.
+        The queue holds as many messages as the prefetch count set by
+        :meth:`basic_qos` or :meth:`auto_qos` allows, or
+        :data:`CONSUMER_BUFFER_SIZE` messages if there is no limit. If the
+        callback falls behind by more than that, reading from the
+        connection pauses until there is room again.
+        """
+        # If a consumer tag was not passed, create one
+        consumer_tag = consumer_tag or 'ctag%i.%s' % (self.channel_id, uuid.uuid4().hex)
+
+        queue_w, queue_r = anyio.create_memory_object_stream(self._consumer_buffer_size(no_ack))
+        started = anyio.create_event()
+        await self.protocol.nursery.spawn(self._run_consumer, callback, consumer_tag, queue_r, started)
+
+        try:
+            res = await self._basic_consume(
+                queue_w,
+                queue_name=queue_name,
+                consumer_tag=consumer_tag,
+                no_local=no_local,
+                no_ack=no_ack,
+                exclusive=exclusive,
+                no_wait=no_wait,
+                arguments=arguments,
+                stream_body=stream_body
+            )
+            self.consumer_callbacks[consumer_tag] = callback
+            return res
+        finally:
+            # don't call back before we return
+            await started.set()
+
+    async def _basic_consume(
+        self,
+        queue,
+        queue_name='',
+        consumer_tag='',
+        no_local=False,
+        no_ack=False,
+        exclusive=False,
+        no_wait=False,
+        arguments=None,
+        stream_body=False
+    ):
+        """Start consuming. Messages are sent to @queue, as
+        (body, envelope, properties) tuples. ``None`` signals that the
+        server has cancelled the consumer.
+
+        With @stream_body, bodies are :class:`BodyStream` objects, and
+        messages are sent as soon as their header has arrived.
         """
         # If a consumer tag was not passed, create one
         consumer_tag = consumer_tag or 'ctag%i.%s' % (self.channel_id, uuid.uuid4().hex)
@@ -716,51 +1152,123 @@ class Channel:
             arguments=arguments
         )
 
-        self.consumer_callbacks[consumer_tag] = callback
+        self.consumer_queues[consumer_tag] = queue
         self.last_consumer_tag = consumer_tag
+        if stream_body:
+            self._stream_body_consumers.add(consumer_tag)
+        if no_ack:
+            self._no_ack_consumers.add(consumer_tag)
 
-        return_value = await self._write_frame_awaiting_response('basic_consume', self.channel_id, request, no_wait)
+        try:
+            return_value = await self._write_frame_awaiting_response(
+                'basic_consume', self.channel_id, request, no_wait
+            )
+        except BaseException:
+            if self.consumer_queues.get(consumer_tag) is queue:
+                del self.consumer_queues[consumer_tag]
+                self._stream_body_consumers.discard(consumer_tag)
+                self._no_ack_consumers.discard(consumer_tag)
+            await queue.aclose()
+            raise
         if no_wait:
             return_value = {'consumer_tag': consumer_tag}
-        else:
-            await self._ctag_events[consumer_tag].set()
         return return_value
 
+    async def _run_consumer(self, callback, consumer_tag, queue, started):
+        """Feed queued messages to a basic_consume callback."""
+        await started.wait()
+        try:
+            async with queue:
+                async for message in queue:
+                    if message is None:
+                        message = (None, None, None)
+                    else:
+                        self._consumer_took(consumer_tag)
+                        if type(message[0]) is BodyStream:
+                            message[0]._take()
+                    res = callback(self, *message)
+                    if inspect.iscoroutine(res):
+                        await res
+                    if type(message[0]) is BodyStream:
+                        await message[0].aclose()
+                    if message[0] is None:
+                        # cancelled by the server
+                        return
+        finally:
+            self._consumer_depth.pop(consumer_tag, None)
+
     async def basic_consume_ok(self, frame):
         results = {
             'consumer_tag': frame.consumer_tag
         }
         future = self._get_waiter('basic_consume')
         await future.set_result(results)
-        self._ctag_events[frame.consumer_tag] = anyio.create_event()
 
-    async def basic_deliver(self, frame):
+    async def basic_deliver(self, frame, content):
         consumer_tag = frame.consumer_tag
         delivery_tag = frame.delivery_tag
         is_redeliver = frame.redelivered
         exchange_name = frame.exchange
         routing_key = frame.routing_key
-        channel, content_header_frame = await self.protocol.get_frame()
-
-        buffer = io.BytesIO()
-        while (buffer.tell() < content_header_frame.body_size):
-            _channel, content_body_frame = await self.protocol.get_frame()
-            buffer.write(content_body_frame.value)
-
-        body = buffer.getvalue()
+        self._last_delivery_tag = delivery_tag
+        if self._acks is not None and consumer_tag not in self._no_ack_consumers:
+            self._acks.delivered(delivery_tag)
+
+        if content.stream is not None:
+            body = content.stream
+        elif consumer_tag in self._stream_body_consumers:
+            # an empty body, which was complete with the header
+            body = BodyStream(0)
+            await body._end()
+        else:
+            body = content.body
+        metrics = self.protocol.metrics
+        if metrics is not None:
+            size = content.body_size
+            metrics.messages_delivered += 1
+            metrics.bytes_delivered += size
+            if metrics.hooks:
+                metrics.emit('deliver', channel=self, consumer_tag=consumer_tag, size=size)
         envelope = Envelope(consumer_tag, delivery_tag, exchange_name, routing_key, is_redeliver)
-        properties = amqp_properties.from_pamqp(content_header_frame.properties)
+        properties = content.header.properties
 
-        callback = self.consumer_callbacks[consumer_tag]
+        await self._queue_for_consumer(consumer_tag, (body, envelope, properties))
 
-        event = self._ctag_events.get(consumer_tag)
-        if event:
-            await event.wait()
-            del self._ctag_events[consumer_tag]
+    async def start_content(self, content):
+        """Called when a message's header has arrived, but not its body.
 
-        res = callback(self, body, envelope, properties)
-        if inspect.iscoroutine(res):
-            res = await res
+        Deliveries to consumers that stream bodies are dispatched now.
+        """
+        if not self._stream_body_consumers:
+            return
+        method = content.method
+        if method.index == pamqp.specification.Basic.Deliver.index and \
+                method.consumer_tag in self._stream_body_consumers:
+            content.stream = BodyStream(content.body_size)
+            await self.basic_deliver(method, content)
+
+    async def _queue_for_consumer(self, consumer_tag, message):
+        queue = self.consumer_queues.get(consumer_tag)
+        if queue is None:
+            logger.warning("Message for unknown consumer %r dropped", consumer_tag)
+            await self._drop_message(message)
+            return
+        if message is not None:
+            self._consumer_depth[consumer_tag] = self._consumer_depth.get(consumer_tag, 0) + 1
+        try:
+            await queue.send(message)
+        except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+            if message is not None:
+                self._consumer_depth.pop(consumer_tag, None)
+            # The consumer is gone. The message wasn't acked, so the
+            # server will deliver it again.
+            logger.debug("Message for closed consumer %r dropped", consumer_tag)
+            await self._drop_message(message)
+
+    async def _drop_message(self, message):
+        # Nobody reads a dropped body, so don't let it block the reader.
+        if message is not None and type(message[0]) is BodyStream:
+            await message[0].aclose()
 
     async def server_basic_cancel(self, frame):
         # https://www.rabbitmq.com/consumer-cancel.html
@@ -768,43 +1276,45 @@ class Channel:
         _no_wait = frame.nowait
         self.cancelled_consumers.add(consumer_tag)
         logger.info("consume cancelled received")
-        callback = self.consumer_callbacks.get(consumer_tag, None)
-        if callback is None:
-            pass
-        elif not inspect.iscoroutinefunction(callback):
-            callback(self, None, None, None)
-        else:
-            await callback(self, None, None, None)
-
+        await self._queue_for_consumer(consumer_tag, None)
+        await self._consumer_done(consumer_tag)
 
     async def basic_cancel(self, consumer_tag, no_wait=False):
         request = pamqp.specification.Basic.Cancel(consumer_tag, no_wait)
-        return await self._write_frame_awaiting_response('basic_cancel', self.channel_id, request, no_wait=no_wait)
+        res = await self._write_frame_awaiting_response('basic_cancel', self.channel_id, request, no_wait=no_wait)
+        if no_wait:
+            await self._consumer_done(consumer_tag)
+        return res
 
     async def basic_cancel_ok(self, frame):
         results = {
             'consumer_tag': frame.consumer_tag,
         }
+        await self._consumer_done(frame.consumer_tag)
         future = self._get_waiter('basic_cancel')
         await future.set_result(results)
         logger.debug("Cancel ok")
 
-    async def basic_return(self, frame):
+    async def _consumer_done(self, consumer_tag):
+        # No more messages for this consumer. Closing its queue ends the
+        # callback's task after it has processed whatever is still queued.
+        self.consumer_callbacks.pop(consumer_tag, None)
+        self._stream_body_consumers.discard(consumer_tag)
+        self._no_ack_consumers.discard(consumer_tag)
+        queue = self.consumer_queues.pop(consumer_tag, None)
+        if queue is not None:
+            await queue.aclose()
+
+    async def basic_return(self, frame, content):
         reply_code = frame.reply_code
         reply_text = frame.reply_text
         exchange_name = frame.exchange
         routing_key = frame.routing_key
-        channel, content_header_frame = await self.protocol.get_frame()
 
-        buffer = io.BytesIO()
-        while buffer.tell() < content_header_frame.body_size:
-            _channel, content_body_frame = await self.protocol.get_frame()
-            buffer.write(content_body_frame.value)
-
-        body = buffer.getvalue()
+        body = content.body
         envelope = ReturnEnvelope(reply_code, reply_text,
                                   exchange_name, routing_key)
-        properties = amqp_properties.from_pamqp(content_header_frame.properties)
+        properties = content.header.properties
         if self._q_w is None:
             # they have set mandatory bit, but aren't reading
             logger.warning("You don't iterate the channel for returned messages!")
@@ -813,9 +1323,10 @@ class Channel:
 
     async def basic_get(self, queue_name='', no_ack=False):
         request = pamqp.specification.Basic.Get(queue=queue_name, no_ack=no_ack)
+        self._get_no_ack = no_ack
         return await self._write_frame_awaiting_response('basic_get', self.channel_id, request, no_wait=False)
 
-    async def basic_get_ok(self, frame):
+    async def basic_get_ok(self, frame, content):
         data = {
             'delivery_tag': frame.delivery_tag,
             'redelivered': frame.redelivered,
@@ -823,15 +1334,11 @@ class Channel:
             'routing_key': frame.routing_key,
             'message_count': frame.message_count,
         }
-        _channel, content_header_frame = await self.protocol.get_frame()
-
-        buffer = io.BytesIO()
-        while (buffer.tell() < content_header_frame.body_size):
-            _channel, content_body_frame = await self.protocol.get_frame()
-            buffer.write(content_body_frame.value)
-
-        data['message'] = buffer.getvalue()
-        data['properties'] = amqp_properties.from_pamqp(content_header_frame.properties)
+        self._last_delivery_tag = frame.delivery_tag
+        if self._acks is not None and not self._get_no_ack:
+            self._acks.delivered(frame.delivery_tag)
+        data['message'] = content.body
+        data['properties'] = content.header.properties
         future = self._get_waiter('basic_get')
         await future.set_result(data)
 
@@ -840,32 +1347,188 @@ class Channel:
         await future.set_exception(exceptions.EmptyQueue)
 
     async def basic_client_ack(self, delivery_tag, multiple=False):
+        acks = self._acks
+        if acks is not None and not multiple and acks.ack(delivery_tag):
+            # Acks that are held back keep the server from sending more
+            # messages, so they may only take up part of the prefetch window
+            prefetch = self.prefetch_count
+            if acks.n_acked >= acks.max_acks or (prefetch and acks.n_acked * 4 >= prefetch):
+                await self.flush_acks()
+            elif acks.n_acked == 1:
+                await acks.pending.set()
+            return
         request = pamqp.specification.Basic.Ack(delivery_tag, multiple)
-        async with self._write_lock:
-            await self._write_frame(self.channel_id, request)
+        await self._settle(request, multiple)
 
     async def basic_client_nack(self, delivery_tag, multiple=False, requeue=True):
         request = pamqp.specification.Basic.Nack(delivery_tag, multiple, requeue)
+        await self._settle(request, multiple)
+
+    async def _settle(self, request, multiple):
+        # Send an ack, nack or reject right away
+        acks = self._acks
+        if acks is None:
+            async with self._write_lock:
+                await self._write_frame(self.channel_id, request)
+            return
+        # Acks that are held back go first, so that a multiple nack
+        # doesn't cover them
+        requests = acks.take() if multiple else []
+        acks.settled(request.delivery_tag, multiple)
+        requests.append(request)
+        await self._write_acks(requests)
+
+    async def _write_acks(self, requests, wait=False):
+        data = b''.join(pamqp.frame.marshal(request, self.channel_id) for request in requests)
+        if self.protocol.metrics is not None:
+            self.protocol.metrics.frames_out += len(requests)
+        if wait:
+            data = amqp_frame.ContentFrames([data], [amqp_frame.SentEvent()])
         async with self._write_lock:
-            await self._write_frame(self.channel_id, request)
+            await self._write_data(data)
+        await amqp_frame.wait_sent(data)
+
+    async def coalesce_acks(self, max_acks=100, max_delay=0.01):
+        """Hold back acks, and send them together.
+
+        :meth:`basic_client_ack` doesn't send an ack right away. The acks
+        are sent after ``max_acks`` acks, after ``max_delay`` seconds, or
+        when they take up a quarter of the prefetch window, whichever comes
+        first. Acks of messages that were delivered before the oldest one
+        that's still unacked are combined into a single ``multiple=True``
+        frame; the others are sent one by one, in the same write.
+
+        Nacks, rejects and acks with ``multiple=True`` are sent right away.
+        Call this before receiving messages on this channel.
+
+        Args:
+            max_acks:
+                int, the number of acks to hold back at most
+            max_delay:
+                float, seconds to hold an ack back at most
+        """
+        if max_acks < 1 or max_delay <= 0:
+            raise ValueError("Need max_acks >= 1 and max_delay > 0")
+        if self._acks is not None:
+            self._acks.max_acks = max_acks
+            self._acks.max_delay = max_delay
+            return
+        if self._last_delivery_tag:
+            # their acks could be covered by a multiple ack
+            raise RuntimeError("Messages have been received on this channel already")
+        acks = self._acks = AckBatcher(max_acks, max_delay)
+        await self.protocol.nursery.spawn(self._run_ack_batching, acks)
+
+    async def _run_ack_batching(self, acks):
+        while True:
+            await acks.pending.wait()
+            if self._acks is not acks:
+                return
+            await anyio.sleep(acks.max_delay)
+            acks.pending = anyio.create_event()
+            try:
+                await self.flush_acks()
+            except (exceptions.ChannelClosed, AmqpClosedConnection):
+                return
+
+    async def _stop_ack_batching(self):
+        acks = self._acks
+        if acks is not None:
+            self._acks = None
+            await acks.pending.set()
+
+    async def flush_acks(self, wait=False):
+        """Send the acks that :meth:`coalesce_acks` holds back now.
+
+        With @wait, return once they have been written to the socket.
+        """
+        if self._acks is None:
+            return
+        requests = self._acks.take()
+        if requests:
+            await self._write_acks(requests, wait)
 
     async def basic_server_ack(self, frame):
         delivery_tag = frame.delivery_tag
-        fut = self._get_waiter('basic_server_ack_{}'.format(delivery_tag))
         logger.debug('Received ack for delivery tag %s', delivery_tag)
-        await fut.set_result(True)
+        await self._resolve_confirms(delivery_tag, frame.multiple)
+
+    async def _resolve_confirms(self, delivery_tag, multiple, nack=False):
+        """Resolve the futures for confirmed messages.
+
+        With @multiple set, this covers all messages up to and including
+        @delivery_tag. Otherwise just that one.
+        """
+        futures = self._confirm_futures
+        if not futures or delivery_tag < futures[0].delivery_tag:
+            if multiple:
+                # nothing left that this could refer to
+                return
+            raise exceptions.SynchronizationError("Unexpected confirmation %r" % delivery_tag)
+
+        # Delivery tags are consecutive, so there's no need to search
+        if multiple:
+            n_resolved = min(delivery_tag - futures[0].delivery_tag + 1, len(futures))
+            resolved = [futures.popleft() for _ in range(n_resolved)]
+        else:
+            try:
+                fut = futures[delivery_tag - futures[0].delivery_tag]
+            except IndexError:
+                fut = None
+            if fut is None or fut.delivery_tag != delivery_tag:
+                raise exceptions.SynchronizationError("Unexpected confirmation %r" % delivery_tag)
+            resolved = [fut]
+
+        n_resolved = 0
+        for fut in resolved:
+            if fut.done():
+                # acked out of order, before a multiple ack
+                continue
+            n_resolved += 1
+            if nack:
+                if not fut.awaited:
+                    self._nacked.append(fut.delivery_tag)
+                await fut.set_exception(exceptions.PublishFailed(fut.delivery_tag))
+            else:
+                await fut.set_result(True)
+        while futures and futures[0].done():
+            futures.popleft()
+        await self._confirmed(n_resolved)
+
+    def _nack_reported(self, delivery_tag):
+        # the caller of a ConfirmFuture got PublishFailed for this message
+        try:
+            self._nacked.remove(delivery_tag)
+        except ValueError:
+            pass
+
+    async def _confirmed(self, n_messages):
+        # The server has acked or nacked this many messages
+        self._n_unconfirmed -= n_messages
+        if self._confirm_window is not None:
+            for _ in range(n_messages):
+                await self._confirm_window.release()
+        if not self._n_unconfirmed:
+            await self._confirms_done.set()
 
     async def basic_reject(self, delivery_tag, requeue=False):
         request = pamqp.specification.Basic.Reject(delivery_tag, requeue)
-        async with self._write_lock:
-            await self._write_frame(self.channel_id, request)
+        await self._settle(request, False)
+
+    async def _recovering(self):
+        # All unacked messages are delivered again, with new tags
+        if self._acks is not None:
+            await self.flush_acks()
+            self._acks.clear()
 
     async def basic_recover_async(self, requeue=True):
+        await self._recovering()
         request = pamqp.specification.Basic.RecoverAsync(requeue)
         async with self._write_lock:
             await self._write_frame(self.channel_id, request)
 
     async def basic_recover(self, requeue=True):
+        await self._recovering()
         request = pamqp.specification.Basic.Recover(requeue)
         return await self._write_frame_awaiting_response('basic_recover', self.channel_id, request, no_wait=False)
 
@@ -891,53 +1554,313 @@ class Channel:
         mandatory=False,
         immediate=False
     ):
-        if properties is None:
-            properties = {}
-        if not isinstance(payload,(bytes,bytearray)):
-            raise TypeError("Payload must be bytes")
+        # The whole message is queued as a single unit, so there's no need
+        # to lock out other writers. Publisher confirms need the lock
+        # anyway, to keep delivery tags in step with the server.
+        data = self._marshal_publish(
+            payload, exchange_name, routing_key, properties, mandatory, immediate
+        )
+        return await self._send_message(data)
 
-        async with self._write_lock:
-            if self.publisher_confirms:
-                delivery_tag = next(self.delivery_tag_iter)
-                fut = self._set_waiter('basic_server_ack_{}'.format(delivery_tag))
-
-            method_request = pamqp.specification.Basic.Publish(
-                exchange=exchange_name,
-                routing_key=routing_key,
-                mandatory=mandatory,
-                immediate=immediate
-            )
-            await self._write_frame(self.channel_id, method_request, drain=False)
+    async def _send_message(self, data):
+        if not self.publisher_confirms:
+            await self._write_data(data)
+            await amqp_frame.wait_sent(data)
+            return None
 
-            properties = pamqp.specification.Basic.Properties(**properties)
-            header_request = pamqp.header.ContentHeader(
-                body_size=len(payload), properties=properties
-            )
+        fut, = await self._write_confirmed(data, 1)
+        await amqp_frame.wait_sent(data)
+        if self._confirm_window is not None:
+            return fut
+        await fut()
+        return None
 
-            await self._write_frame(self.channel_id, header_request, drain=False)
+    async def publish_stream(
+        self,
+        exchange_name,
+        routing_key,
+        source,
+        size,
+        properties=None,
+        mandatory=False,
+        immediate=False
+    ):
+        """Publish a message whose body is read from @source while it is sent.
 
-            # split the payload
+            Arguments:
+                source:
+                    an async iterator of bytes-like chunks, or a file-like
+                    object. Its ``read`` method may be a coroutine.
+                size:
+                    int, the size of the body. This many bytes are read from
+                    a file-like @source; an iterator must yield exactly this
+                    many.
 
-            frame_max = self.protocol.server_frame_max or len(payload)
-            for chunk in (payload[0 + i:frame_max + i] for i in range(0, len(payload), frame_max)):
-                content_request = pamqp.body.ContentBody(chunk)
-                await self._write_frame(self.channel_id, content_request, drain=False)
+        At most two body frames are held in memory. Nothing else is sent on
+        this channel until the message is complete.
 
-            await self.protocol._drain()
+        If @source fails, or has the wrong size, the message can't be
+        completed. The connection is closed then, and the error is raised.
 
-        if self.publisher_confirms:
-            await fut()
+        Returns like :meth:`publish`.
+        """
+        method_request = pamqp.specification.Basic.Publish(
+            exchange=exchange_name,
+            routing_key=routing_key,
+            mandatory=mandatory,
+            immediate=immediate
+        )
+        template = amqp_frame.ContentTemplate(
+            self.channel_id, method_request, properties, self.protocol.server_frame_max
+        )
+        metrics = self.protocol.metrics
+        if metrics is not None:
+            self._count_publish(metrics, size)
+        return await self._send_message(amqp_frame.ContentStream(template, source, size))
+
+    def publisher(
+        self, exchange_name, routing_key, properties=None, mandatory=False, immediate=False
+    ):
+        """Return a :class:`Publisher` for messages that only differ in
+        their body.
+
+        Its ``publish(payload)`` and ``publish_many(payloads)`` methods
+        work like :meth:`publish` and :meth:`publish_many`, but don't encode
+        the method frame and the properties again for every message.
+        """
+        return Publisher(self, exchange_name, routing_key, properties, mandatory, immediate)
+
+    async def publish_many(self, messages):
+        """Publish a batch of messages.
+
+            Arguments:
+                messages:
+                    iterable. Each message is either a tuple of positional
+                    arguments for :meth:`publish`, i.e. ``(payload,
+                    exchange_name, routing_key[, properties, …])``, or a
+                    dict of its keyword arguments.
+
+        All messages are encoded into a single buffer, which is sent
+        without interleaving any other frame.
+
+        If publisher confirms are enabled, this returns a list with a
+        future for each message, in order. ``await fut()`` waits for the
+        server's confirmation and raises :class:`PublishFailed` if the
+        message was rejected. Otherwise this returns ``None``.
+
+        If the number of unconfirmed messages is limited (see
+        :meth:`confirm_select`), a batch that's larger than the limit is
+        sent in parts.
+        """
+        parts = []
+        for message in messages:
+            if isinstance(message, dict):
+                parts.append(self._marshal_publish(**message))
+            else:
+                parts.append(self._marshal_publish(*message))
+        return await self._send_messages(parts)
+
+    async def _send_messages(self, parts):
+        """Send the encoded messages in @parts, like :meth:`publish_many`"""
+        if not parts:
+            return [] if self.publisher_confirms else None
+
+        if not self.publisher_confirms:
+            data = amqp_frame.ContentFrames.join(parts)
+            await self._write_data(data)
+            await amqp_frame.wait_sent(data)
+            return None
+
+        window = self._confirm_window_size
+        if window is None:
+            window = len(parts)
+        futures = []
+        for offset in range(0, len(parts), window):
+            batch = parts[offset:offset + window]
+            data = amqp_frame.ContentFrames.join(batch)
+            futures.extend(await self._write_confirmed(data, len(batch)))
+            await amqp_frame.wait_sent(data)
+        return futures
 
-    async def confirm_select(self, *, no_wait=False):
+    async def publish_from(self, source, batch_size=100):
+        """Publish messages from an async iterator.
+
+            Arguments:
+                source:
+                    async iterable of messages, in the same format as
+                    :meth:`publish_many` accepts
+                batch_size:
+                    int, send the messages in batches of this size
+
+        A message may thus wait in the current batch until the batch is full
+        or @source is exhausted. Use ``batch_size=1`` if that's a problem.
+
+        If publisher confirms are enabled, the confirmations for a batch
+        are awaited before the next batch is sent.
+
+        Returns the number of messages published.
+        """
+        n_published = 0
+        batch = []
+        async for message in source:
+            batch.append(message)
+            if len(batch) >= batch_size:
+                await self._publish_batch(batch)
+                n_published += len(batch)
+                batch = []
+        if batch:
+            await self._publish_batch(batch)
+            n_published += len(batch)
+        return n_published
+
+    async def _publish_batch(self, batch):
+        futures = await self.publish_many(batch)
+        if futures:
+            for fut in futures:
+                await fut()
+
+    def _marshal_publish(
+        self,
+        payload,
+        exchange_name,
+        routing_key,
+        properties=None,
+        mandatory=False,
+        immediate=False
+    ):
+        payload = amqp_frame.body_view(payload)
+        method_request = pamqp.specification.Basic.Publish(
+            exchange=exchange_name,
+            routing_key=routing_key,
+            mandatory=mandatory,
+            immediate=immediate
+        )
+        metrics = self.protocol.metrics
+        if metrics is not None:
+            self._count_publish(metrics, len(payload))
+        return amqp_frame.marshal_content(
+            self.channel_id, method_request, properties, payload, self.protocol.server_frame_max
+        )
+
+    def _count_publish(self, metrics, size):
+        metrics.messages_published += 1
+        metrics.bytes_published += size
+        metrics.frames_out += 2 + amqp_frame.body_frames(size, self.protocol.server_frame_max)
+        if metrics.hooks:
+            metrics.emit('publish', channel=self, size=size)
+
+    async def _write_confirmed(self, data, n_messages):
+        """Send @data, which contains @n_messages published messages, in
+        confirm mode.
+
+        Returns a list of futures for the messages' confirmations.
+        """
+        window = self._confirm_window
+        if window is not None:
+            acquired = 0
+            try:
+                while acquired < n_messages:
+                    await window.acquire()
+                    acquired += 1
+            except BaseException:
+                for _ in range(acquired):
+                    await window.release()
+                raise
+
+        futures = []
+        async with self._write_lock:
+            if not self._n_unconfirmed:
+                self._confirms_done = anyio.create_event()
+            self._n_unconfirmed += n_messages
+            for _ in range(n_messages):
+                fut = ConfirmFuture(self, next(self.delivery_tag_iter))
+                futures.append(fut)
+                self._confirm_futures.append(fut)
+            try:
+                await self._check_writable()
+            except BaseException:
+                await self._unsent(futures)
+                raise
+            if type(data) is amqp_frame.ContentStream:
+                # A stream that fails after it has started closes the
+                # connection, so its tag doesn't matter anymore
+                await self._queue_data(data)
+                return futures
+            try:
+                # Once the writer has taken the data it will be sent, even
+                # if we get cancelled, so don't give up half-way
+                async with anyio.open_cancel_scope(shield=True):
+                    await self._queue_data(data)
+            except exceptions.AmqpClosedConnection:
+                # the send queue is closed, so the data never got there
+                await self._unsent(futures)
+                raise
+        return futures
+
+    async def _unsent(self, futures):
+        # The server didn't see these messages, so it won't confirm them;
+        # re-use their delivery tags
+        for fut in reversed(futures):
+            if self._confirm_futures and self._confirm_futures[-1] is fut:
+                self._confirm_futures.pop()
+            if not fut.done():
+                await fut.cancel()
+        self.delivery_tag_iter = count(futures[0].delivery_tag)
+        await self._confirmed(len(futures))
+
+    async def wait_for_confirms(self):
+        """Wait until the server has confirmed every published message.
+
+        Raises :class:`PublishFailed`, with the first rejected delivery tag,
+        if the server has nacked any message since the last call. Messages
+        whose failure was already raised by :meth:`publish` or by awaiting
+        their future are not reported again.
+        """
+        while self._n_unconfirmed:
+            await self._confirms_done.wait()
+            if not self.is_open:
+                raise exceptions.ChannelClosed()
+        if self._nacked:
+            delivery_tag = self._nacked[0]
+            self._nacked = []
+            raise exceptions.PublishFailed(delivery_tag)
+
+    async def confirm_select(self, *, no_wait=False, max_in_flight=None):
+        """Enable publisher confirms on this channel.
+
+            Arguments:
+                no_wait:
+                    bool, if set, the server will not respond to the method
+                max_in_flight:
+                    int, if set, :meth:`publish` does not wait for the
+                    server's confirmation. It returns a future instead;
+                    ``await fut()`` waits for the confirmation. Publishing
+                    blocks while this many messages are unconfirmed.
+
+        Use :meth:`wait_for_confirms` to wait for all outstanding
+        confirmations.
+        """
         if self.publisher_confirms:
             raise ValueError('publisher confirms already enabled')
+        if max_in_flight is not None:
+            if max_in_flight < 1:
+                raise ValueError('max_in_flight must be at least 1')
+            self._confirm_window_size = max_in_flight
+            self._confirm_window = anyio.create_semaphore(max_in_flight)
         request = pamqp.specification.Confirm.Select(nowait=no_wait)
 
-        return await self._write_frame_awaiting_response('confirm_select', self.channel_id, request, no_wait)
+        res = await self._write_frame_awaiting_response('confirm_select', self.channel_id, request, no_wait)
+        if no_wait:
+            # there won't be a SelectOk
+            self._start_confirms()
+        return res
 
-    async def confirm_select_ok(self, frame):
+    def _start_confirms(self):
         self.publisher_confirms = True
         self.delivery_tag_iter = count(1)
+
+    async def confirm_select_ok(self, frame):
+        self._start_confirms()
         fut = self._get_waiter('confirm_select')
         await fut.set_result(True)
         logger.debug("Confirm selected")
@@ -0,0 +1,182 @@
+"""
+    Assembly of message content
+
+Basic.Deliver, Basic.Return and Basic.GetOk are followed by a content
+header frame and as many body frames as it takes to transfer the message
+body. Frames of other channels may be interleaved with them.
+
+Consumers that asked for it get the body as a :class:`BodyStream` instead,
+as soon as the header has arrived. Bodies above the connection's spill
+threshold are written to an anonymous temporary file as they arrive, and
+handed out as a read-only memoryview of a memory map of that file, so
+that they don't take up the process' heap.
+"""
+
+import mmap
+import tempfile
+from collections import deque
+
+import anyio
+import pamqp.specification
+
+# Frame indexes of the methods that are followed by content
+CONTENT_METHODS = frozenset((
+    pamqp.specification.Basic.Deliver.index,
+    pamqp.specification.Basic.Return.index,
+    pamqp.specification.Basic.GetOk.index,
+))
+
+# Number of body frames that may wait for a BodyStream's reader
+BODY_STREAM_BUFFER = 4
+
+
+class BodyStream:
+    """The body of a message, while it is being received.
+
+    Iterate it to get the body in chunks (memoryview objects), as they
+    arrive. :attr:`body_size` is the size of the whole body.
+
+    Until the consumer takes the stream, its chunks are held in memory.
+    Afterwards, reading from the connection pauses while more than
+    :data:`BODY_STREAM_BUFFER` chunks wait to be read, so read the body
+    promptly, or call :meth:`aclose` to discard the rest of it.
+    """
+
+    def __init__(self, body_size):
+        self.body_size = body_size
+        self.received = 0
+        self._error = None
+        self._held = deque()  # chunks that arrived before the stream was taken
+        self._taken = False
+        self._w, self._r = anyio.create_memory_object_stream(BODY_STREAM_BUFFER)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._held:
+            chunk = self._held.popleft()
+            self.received += len(chunk)
+            return chunk
+        try:
+            chunk = await self._r.receive()
+        except (anyio.EndOfStream, anyio.ClosedResourceError):
+            if self._error is not None:
+                raise self._error
+            raise StopAsyncIteration
+        self.received += len(chunk)
+        return chunk
+
+    async def read(self):
+        """The rest of the body, as bytes"""
+        return b''.join([bytes(chunk) async for chunk in self])
+
+    async def aclose(self):
+        """Discard the rest of the body"""
+        self._taken = True
+        self._held.clear()
+        await self._r.aclose()
+
+    def _take(self):
+        # The consumer got the stream. Until then, it may be queued behind
+        # messages whose handling waits for the connection, so the reader
+        # must not wait for it.
+        self._taken = True
+
+    async def _feed(self, chunk, done):
+        if not self._taken:
+            self._held.append(chunk)
+            if done:
+                await self._w.aclose()
+            return
+        try:
+            await self._w.send(chunk)
+            if done:
+                await self._w.aclose()
+        except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+            # the reader isn't interested anymore
+            pass
+
+    async def _end(self, exc=None):
+        self._error = exc
+        await self._w.aclose()
+
+
+class Content:
+    """A message that's being received on a channel.
+
+    Feed it the header and body frames, in order. Both :meth:`add_header`
+    and :meth:`add_body` return ``True`` when the message is complete.
+
+    If the channel sets :attr:`stream` to a :class:`BodyStream` after the
+    header, body frames go to :meth:`stream_body` instead.
+    """
+    __slots__ = ('method', 'header', 'received', 'stream', '_parts', '_spill', '_file')
+
+    def __init__(self, method):
+        self.method = method
+        self.header = None
+        self.received = 0
+        self.stream = None
+        self._parts = []
+        self._spill = False
+        self._file = None
+
+    @property
+    def body_size(self):
+        return self.header.body_size
+
+    def add_header(self, frame, spill_threshold=None):
+        """Bodies of more than @spill_threshold bytes are written to a
+        temporary file."""
+        self.header = frame
+        self._spill = spill_threshold is not None and frame.body_size > spill_threshold
+        return frame.body_size == 0
+
+    def add_body(self, frame):
+        if self._spill:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile()
+            # The file is written synchronously: this goes to the page
+            # cache, and is cheaper than handing frames to a thread.
+            self._file.write(frame.value)
+        else:
+            self._parts.append(frame.value)
+        self.received += len(frame.value)
+        return self.received >= self.header.body_size
+
+    async def stream_body(self, frame):
+        """Pass a body frame on to :attr:`stream`. Returns ``True`` when the
+        message is complete."""
+        self.received += len(frame.value)
+        done = self.received >= self.header.body_size
+        await self.stream._feed(frame.value, done)
+        return done
+
+    def discard(self):
+        """Drop an incomplete message"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def body(self):
+        """The complete message body, as bytes, or as a memoryview of the
+        temporary file it was written to"""
+        if self._file is not None:
+            return self._map_file()
+        # The body frames are views of the data that was received. Joining
+        # them copies each byte once, into a bytes object of the right size;
+        # filling a preallocated bytearray would zero it first, and copy
+        # again to make bytes of it.
+        if len(self._parts) == 1:
+            return bytes(self._parts[0])
+        return b''.join(self._parts)
+
+    def _map_file(self):
+        with self._file:
+            self._file.flush()
+            # the mapping stays valid once the file is closed
+            region = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._file = None
+        return memoryview(region)
@@ -38,58 +38,501 @@ Content Payload
 
 """
 
+import inspect
 import io
 import struct
 import socket
 import os
 import datetime
-from anyio import ClosedResourceError, IncompleteRead
+import anyio
+from anyio import BrokenResourceError, EndOfStream
+from collections import deque
 from itertools import count
 from decimal import Decimal
 
 import pamqp.encode
 import pamqp.specification
 import pamqp.frame
+import pamqp.body
+import pamqp.header
+import pamqp.heartbeat
 
 from . import exceptions
 from . import constants as amqp_constants
+from . import properties as amqp_properties
 from .properties import Properties
 
 DUMP_FRAMES = False
 
+FRAME_HEADER = struct.Struct('>BHI')
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+FRAME_END = amqp_constants.FRAME_END[0]
+FRAME_OVERHEAD = FRAME_HEADER_SIZE + 1  # header plus frame-end octet
+METHOD_INDEX = struct.Struct('>I')
+CONTENT_HEADER = struct.Struct('>HHQ')  # class-id, weight, body size
+BODY_SIZE = struct.Struct('>Q')
 
-async def read(reader):
-    """Read a new frame from the wire
+# Frame size for streamed messages if the server doesn't limit it
+STREAM_FRAME_MAX = 131072
 
-        reader:     anyio Stream
+# Message bodies of at least this size are sent straight from the
+# publisher's buffer, instead of being copied next to their frame headers
+COPY_LIMIT = 65536
 
-    Returns (channel, frame) a tuple containing both channel and the pamqp frame,
-                             the object describing the frame
+
+class FrameReader:
+    """Split AMQP frames out of a byte stream.
+
+    The stream is read in large chunks. Every frame that's complete after
+    a read is decoded right away, so a single read usually yields many
+    frames. Incomplete data is kept until the rest of the frame arrives.
+
+    Body frame payloads are :class:`memoryview` slices of the received
+    data; they are not copied.
     """
-    if not reader:
-        raise exceptions.AmqpClosedConnection()
-    try:
-        data = await reader.receive_exactly(7)
-    except (ClosedResourceError, IncompleteRead):
-        raise exceptions.AmqpClosedConnection() from ex
 
-    frame_type, channel, frame_length = pamqp.frame.frame_parts(data)
+    def __init__(self, stream, read_size=65536):
+        self._stream = stream
+        self._read_size = read_size
+        self._frames = deque()
+        self._tail = None  # bytearray with an incomplete frame
+        self._need = FRAME_HEADER_SIZE  # … which needs that many bytes
+        self.metrics = None  # counts the bytes received, if set
+
+    async def read_frame(self):
+        """Return the next (channel, frame) tuple."""
+        while not self._frames:
+            await self._receive()
+        return self._frames.popleft()
+
+    async def _receive(self):
+        size = self._read_size
+        if self._tail is not None:
+            size = max(size, self._need - len(self._tail))
+        try:
+            data = await self._stream.receive(size)
+        except (EndOfStream, BrokenResourceError):
+            raise exceptions.AmqpClosedConnection() from None
+        if self.metrics is not None:
+            self.metrics.bytes_in += len(data)
 
-    payload_data = await reader.receive_exactly(frame_length)
-    frame = None
+        if self._tail is not None:
+            self._tail += data
+            data = self._tail
+        pos = self._split(data)
+
+        if pos == len(data):
+            self._tail = None
+            self._need = FRAME_HEADER_SIZE
+        elif pos or data is not self._tail:
+            # Frames that we just parsed may still refer to @data, so it
+            # must not be modified. Copy the remainder instead.
+            self._tail = bytearray(memoryview(data)[pos:])
+
+    def _split(self, data):
+        """Decode all complete frames in @data.
+
+        Returns the offset of the first byte that has not been used.
+        """
+        pos = 0
+        end = len(data)
+        with memoryview(data) as view:
+            while end - pos >= FRAME_HEADER_SIZE:
+                frame_type, channel, frame_length = FRAME_HEADER.unpack_from(data, pos)
+                frame_end = pos + FRAME_HEADER_SIZE + frame_length
+                if frame_end >= end:
+                    self._need = FRAME_HEADER_SIZE + frame_length + 1
+                    break
+                assert data[frame_end] == FRAME_END
+                payload = view[pos + FRAME_HEADER_SIZE:frame_end]
+                self._frames.append((channel, decode(frame_type, payload)))
+                pos = frame_end + 1
+            else:
+                self._need = FRAME_HEADER_SIZE
+        return pos
+
+
+def decode(frame_type, payload):
+    """Build the pamqp frame object for a frame's payload.
+
+    The properties of content headers are decoded into a
+    :class:`Properties` instance, not pamqp's.
+    """
+    if frame_type == amqp_constants.TYPE_BODY:
+        return pamqp.body.ContentBody(payload)
 
     if frame_type == amqp_constants.TYPE_METHOD:
-        frame = pamqp.frame._unmarshal_method_frame(payload_data)
+        return pamqp.frame._unmarshal_method_frame(bytes(payload))
+
+    if frame_type == amqp_constants.TYPE_HEADER:
+        class_id, weight, body_size = CONTENT_HEADER.unpack_from(payload)
+        header = pamqp.header.ContentHeader(
+            weight, body_size, amqp_properties.decode(payload, CONTENT_HEADER.size)
+        )
+        header.class_id = class_id
+        return header
+
+    if frame_type == amqp_constants.TYPE_HEARTBEAT:
+        return pamqp.heartbeat.Heartbeat()
+
+    return None
+
+
+def _put_frame(buf, pos, frame_type, channel_id, payload):
+    """Store a frame in @buf at offset @pos. Returns the offset after it."""
+    size = len(payload)
+    FRAME_HEADER.pack_into(buf, pos, frame_type, channel_id, size)
+    pos += FRAME_HEADER_SIZE
+    buf[pos:pos + size] = payload
+    pos += size
+    buf[pos] = FRAME_END
+    return pos + 1
+
+
+def body_view(payload):
+    """A flat, byte-sized memoryview of @payload.
+
+    @payload may be any object that supports the buffer protocol, e.g.
+    bytes, bytearray, memoryview, mmap or a NumPy array. It is only copied
+    if it's not contiguous.
+    """
+    try:
+        view = memoryview(payload)
+    except TypeError:
+        raise TypeError(
+            "Payload must be a bytes-like object, not %s" % type(payload).__name__
+        ) from None
+    if view.ndim != 1 or view.itemsize != 1:
+        try:
+            view = view.cast('B')
+        except TypeError:
+            view = memoryview(view.tobytes())
+    return view
+
+
+class SentEvent:
+    """Set once frames that refer to a caller's buffer have been written,
+    or when they can't be written anymore."""
+    __slots__ = ('_event', 'failed')
+
+    def __init__(self):
+        self._event = anyio.create_event()
+        self.failed = False
+
+    def is_set(self):
+        return self._event.is_set()
+
+    async def set(self, failed=False):
+        if not self._event.is_set():
+            self.failed = failed
+            await self._event.set()
+
+    async def wait(self):
+        """Raises :class:`AmqpClosedConnection` if the frames weren't sent."""
+        await self._event.wait()
+        if self.failed:
+            raise exceptions.AmqpClosedConnection()
+
+
+class ContentFrames:
+    """Frames that are written one piece after the other.
+
+    A large message body is not copied: @pieces alternates between
+    frame headers and ends (bytes) and memoryview slices of the body.
+    If the body may change, each :class:`SentEvent` in @sent is set once
+    the pieces have been written.
+    """
+    __slots__ = ('pieces', 'sent', 'size')
+
+    def __init__(self, pieces, sent=()):
+        self.pieces = pieces
+        self.sent = sent
+        self.size = sum(len(piece) for piece in pieces)
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def join(cls, parts):
+        """Concatenate @parts, which are bytes-like objects or ContentFrames.
+
+        The result is a bytes object if none of them is a ContentFrames.
+        """
+        if not any(type(part) is cls for part in parts):
+            return b''.join(parts)
+        pieces = []
+        sent = []
+        pending = []
+        for part in parts:
+            if type(part) is not cls:
+                pending.append(part)
+                continue
+            for piece in part.pieces:
+                if type(piece) is memoryview:
+                    if pending:
+                        pieces.append(b''.join(pending))
+                        pending = []
+                    pieces.append(piece)
+                else:
+                    pending.append(piece)
+            sent.extend(part.sent)
+        if pending:
+            pieces.append(b''.join(pending))
+        return cls(pieces, sent)
+
+
+async def send(stream, data):
+    """Write @data, a bytes-like object or ContentFrames, to @stream."""
+    if type(data) is not ContentFrames:
+        await stream.send(data)
+        return
+    try:
+        for piece in data.pieces:
+            await stream.send(piece)
+    except BaseException:
+        await release(data, failed=True)
+        raise
+    await release(data)
 
-    elif frame_type == amqp_constants.TYPE_HEADER:
-        frame = pamqp.frame._unmarshal_header_frame(payload_data)
 
-    elif frame_type == amqp_constants.TYPE_BODY:
-        frame = pamqp.frame._unmarshal_body_frame(payload_data)
+async def release(data, failed=False):
+    """Let go of the buffers that @data, which was queued for sending,
+    refers to, and wake up whoever waits for it to be sent. With
+    @failed, they get an error."""
+    if type(data) is not ContentFrames:
+        return
+    for piece in data.pieces:
+        if type(piece) is memoryview:
+            # let go of the publisher's buffer, e.g. so that an mmap
+            # can be closed
+            piece.release()
+    async with anyio.open_cancel_scope(shield=True):
+        for event in data.sent:
+            await event.set(failed)
 
-    elif frame_type == amqp_constants.TYPE_HEARTBEAT:
-        frame = pamqp.heartbeat.Heartbeat()
 
-    frame_end = await reader.receive_exactly(1)
-    assert frame_end == amqp_constants.FRAME_END
-    return channel, frame
+async def wait_sent(data):
+    """Wait until @data, which was queued for sending, has been written,
+    if it refers to a buffer that the caller may change.
+
+    Raises :class:`AmqpClosedConnection` if the connection was closed
+    before that.
+    """
+    if type(data) is ContentFrames:
+        for event in data.sent:
+            await event.wait()
+
+
+def body_frames(body_size, frame_max):
+    """The number of body frames a message of @body_size bytes needs"""
+    if not body_size:
+        return 0
+    if not frame_max:
+        return 1
+    return -(-body_size // (frame_max - FRAME_OVERHEAD))
+
+
+class ContentTemplate:
+    """The frames of a message, except for its body size and its body.
+
+    Messages that only differ in their body are encoded from a copy of the
+    template, with the body size patched in and the body frames appended.
+
+        channel_id: the channel to send on
+        method:     the pamqp method frame, e.g. Basic.Publish
+        properties: the message properties: a :class:`Properties`, a dict
+                    or None
+        frame_max:  the negotiated maximum frame size, or 0 for no limit
+    """
+    __slots__ = ('channel_id', 'frame_max', 'prefix', 'suffix')
+
+    def __init__(self, channel_id, method, properties, frame_max):
+        self.channel_id = channel_id
+        self.frame_max = frame_max
+
+        method_payload = METHOD_INDEX.pack(method.index) + method.marshal()
+        property_list = amqp_properties.encode(properties)
+        # the method frame, and the header frame up to the body size
+        self.prefix = b''.join((
+            FRAME_HEADER.pack(amqp_constants.TYPE_METHOD, channel_id, len(method_payload)),
+            method_payload,
+            amqp_constants.FRAME_END,
+            FRAME_HEADER.pack(
+                amqp_constants.TYPE_HEADER, channel_id, CONTENT_HEADER.size + len(property_list)
+            ),
+            struct.pack('>HH', amqp_constants.CLASS_BASIC, 0),  # class-id, weight
+        ))
+        # the rest of the header frame
+        self.suffix = property_list + amqp_constants.FRAME_END
+
+    def marshal(self, payload):
+        """Encode the message with body @payload, any bytes-like object.
+
+        Usually, all frames are written to a single buffer, which can be
+        queued for sending as one unit. Bodies of :data:`COPY_LIMIT` bytes
+        or more are not copied; a :class:`ContentFrames` that refers to
+        them is returned instead.
+        """
+        body = body_view(payload)
+        frame_max = self.frame_max
+        body_size = len(body)
+        # without a frame limit, the whole body goes in one frame; an empty
+        # body needs none, but range() needs a non-zero step
+        chunk_size = (frame_max - FRAME_OVERHEAD) if frame_max else (body_size or 1)
+        if body_size >= COPY_LIMIT:
+            return self._marshal_pieces(body, chunk_size)
+
+        n_chunks = body_frames(body_size, frame_max)
+        prefix = self.prefix
+        suffix = self.suffix
+
+        buf = bytearray(len(prefix) + 8 + len(suffix) + FRAME_OVERHEAD * n_chunks + body_size)
+        pos = len(prefix)
+        buf[:pos] = prefix
+        BODY_SIZE.pack_into(buf, pos, body_size)
+        pos += 8
+        buf[pos:pos + len(suffix)] = suffix
+        pos += len(suffix)
+        for offset in range(0, body_size, chunk_size):
+            pos = _put_frame(
+                buf, pos, amqp_constants.TYPE_BODY, self.channel_id, body[offset:offset + chunk_size]
+            )
+        return buf
+
+    def head(self, body_size):
+        """The method and header frames of a message of @body_size bytes"""
+        return self.prefix + BODY_SIZE.pack(body_size) + self.suffix
+
+    def _marshal_pieces(self, body, chunk_size):
+        body_size = len(body)
+        head = self.head(body_size)
+        pieces = []
+        for offset in range(0, body_size, chunk_size):
+            chunk = body[offset:offset + chunk_size]
+            pieces.append(head + FRAME_HEADER.pack(amqp_constants.TYPE_BODY, self.channel_id, len(chunk)))
+            pieces.append(chunk)
+            head = amqp_constants.FRAME_END
+        pieces.append(head)
+        return ContentFrames(pieces, () if body.readonly else [SentEvent()])
+
+
+class ContentStream:
+    """A message whose body is read from @source while it is sent.
+
+        template:   the message's :class:`ContentTemplate`
+        source:     an async iterator of bytes-like chunks, or a file-like
+                    object whose ``read`` method may be a coroutine
+        body_size:  the number of bytes to read from @source
+
+    Body frames are filled one at a time, alternating between two buffers
+    of the size of a frame. A buffer is only refilled once the frame that
+    it held has been written.
+    """
+
+    def __init__(self, template, source, body_size):
+        self.template = template
+        self.source = source
+        self.body_size = body_size
+        self._chunks = None
+        self._rest = None  # the part of the last chunk that wasn't used yet
+        if not hasattr(source, 'read'):
+            self._chunks = source.__aiter__()
+
+    async def _read(self, size):
+        """Up to @size bytes from the source, or b'' at its end"""
+        if self._chunks is None:
+            data = self.source.read(size)
+            if inspect.isawaitable(data):
+                data = await data
+            return data
+
+        data = self._rest
+        while not data:
+            try:
+                data = body_view(await self._chunks.__anext__())
+            except StopAsyncIteration:
+                return b''
+        self._rest = data[size:]
+        return data[:size]
+
+    async def _has_more(self):
+        if self._chunks is None:
+            return False  # a file may well be longer
+        return bool(self._rest) or bool(await self._read(1))
+
+    async def write(self, protocol):
+        """Queue the message's frames for sending on @protocol.
+
+        If the source fails, or yields more or less than @body_size bytes,
+        the message can't be completed, and the connection is closed.
+        """
+        template = self.template
+        await protocol._write_data(template.head(self.body_size))
+
+        chunk_size = (template.frame_max or STREAM_FRAME_MAX) - FRAME_OVERHEAD
+        buffers = [bytearray(FRAME_OVERHEAD + min(chunk_size, self.body_size)) for _ in range(2)]
+        queued = None  # the last frame that was queued
+        remaining = self.body_size
+        try:
+            while remaining:
+                size = min(chunk_size, remaining)
+                remaining -= size
+                buf = buffers[0]
+                buffers.reverse()
+                end = FRAME_HEADER_SIZE + size
+                FRAME_HEADER.pack_into(buf, 0, amqp_constants.TYPE_BODY, template.channel_id, size)
+                pos = FRAME_HEADER_SIZE
+                while pos < end:
+                    data = await self._read(end - pos)
+                    if not data:
+                        raise ValueError(
+                            "The source ended %d bytes short" % (end - pos + remaining)
+                        )
+                    buf[pos:pos + len(data)] = data
+                    pos += len(data)
+                buf[end] = FRAME_END
+                if not remaining and await self._has_more():
+                    raise ValueError("The source is longer than %d bytes" % self.body_size)
+
+                frame = ContentFrames([memoryview(buf)[:end + 1]], [SentEvent()])
+                await protocol._write_data(frame)
+                # the other buffer is free once its frame has been sent
+                if queued is not None:
+                    await wait_sent(queued)
+                queued = frame
+        except BaseException:
+            # The server expects the rest of the body. The channel can't be
+            # used anymore, and closing it would be a protocol error too.
+            async with anyio.open_cancel_scope(shield=True):
+                await protocol.close(no_wait=True)
+            raise
+
+
+def marshal_content(channel_id, method, properties, payload, frame_max):
+    """Encode a content-bearing method, its header and its body.
+
+    The body is split into as many frames as @frame_max requires. All
+    frames are written to a single buffer, which can be queued for sending
+    as one unit.
+
+        channel_id: the channel to send on
+        method:     the pamqp method frame, e.g. Basic.Publish
+        properties: the message properties: a :class:`Properties`, a dict
+                    or None
+        payload:    the message body, any bytes-like object
+        frame_max:  the negotiated maximum frame size, or 0 for no limit
+    """
+    return ContentTemplate(channel_id, method, properties, frame_max).marshal(payload)
+
+
+async def read(reader):
+    """Read a new frame from the wire
+
+        reader:     a FrameReader
+
+    Returns (channel, frame) a tuple containing both channel and the pamqp frame,
+                             the object describing the frame
+    """
+    if not reader:
+        raise exceptions.AmqpClosedConnection()
+    return await reader.read_frame()
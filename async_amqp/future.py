@@ -5,6 +5,8 @@
 import anyio
 import logging
 
+from . import exceptions
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,7 +21,8 @@ class Future:
         self.event = anyio.create_event()
         self.result = None
         self.exc = None
-        channel._add_future(self)
+        if rpc_name is not None:
+            channel._add_future(self)
 
     async def __call__(self):
         await self.event.wait()
@@ -48,3 +51,29 @@ class Future:
 
     def done(self):
         return self.event.is_set()
+
+
+class ConfirmFuture(Future):
+    """Waits for the server to confirm a published message.
+
+    The channel keeps these in delivery tag order instead of registering
+    them by name.
+    """
+
+    def __init__(self, channel, delivery_tag):
+        super().__init__(channel, None)
+        self.delivery_tag = delivery_tag
+        self.awaited = False
+        # set while somebody waits for the result, so that a nack is
+        # reported to them instead of to wait_for_confirms()
+
+    async def __call__(self):
+        self.awaited = True
+        try:
+            await self.event.wait()
+        finally:
+            if not self.done():
+                self.awaited = False
+        if isinstance(self.exc, exceptions.PublishFailed):
+            self.channel._nack_reported(self.delivery_tag)
+        return await super().__call__()
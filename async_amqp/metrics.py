@@ -0,0 +1,164 @@
+"""
+    Connection metrics and instrumentation hooks
+
+Pass a :class:`Metrics` instance to :func:`connect_amqp` (``metrics=…``) to
+count what the connection does. Without one, the instrumented code paths
+only test an attribute for ``None``.
+
+A :class:`Metrics` instance may be shared by several connections; counters
+and histograms then add up, and :func:`prometheus_text` sums the gauges of
+all connections that are currently open.
+"""
+
+import logging
+from bisect import bisect_left
+from math import inf
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the buckets of the timing histograms
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, inf)
+
+# name => help text, in export order
+COUNTERS = {
+    'frames_in': "Frames received",
+    'frames_out': "Frames queued for sending",
+    'bytes_in': "Bytes received",
+    'bytes_out': "Bytes sent",
+    'writes': "Socket writes",
+    'heartbeats_in': "Heartbeats received",
+    'heartbeats_out': "Heartbeats sent",
+    'messages_published': "Messages published",
+    'bytes_published': "Message body bytes published",
+    'messages_delivered': "Messages delivered to consumers",
+    'bytes_delivered': "Message body bytes delivered to consumers",
+}
+HISTOGRAMS = {
+    'write_seconds': "Time the writer spent in a socket write",
+    'dispatch_seconds': "Time spent dispatching a received frame",
+    'rpc_seconds': "Round trip time of synchronous methods",
+}
+GAUGES = {
+    'connections': "Open connections",
+    'channels': "Open channels",
+    'send_queue_depth': "Frames waiting for the writer",
+    'outstanding_futures': "Replies and publisher confirms being waited for",
+}
+
+
+class Histogram:
+    """Counts observations in buckets with fixed upper bounds."""
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        if buckets[-1] != inf:
+            buckets = tuple(buckets) + (inf,)
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """(upper bound, number of observations <= bound) pairs"""
+        total = 0
+        for bound, n in zip(self.buckets, self.counts):
+            total += n
+            yield bound, total
+
+
+class Metrics:
+    """Counters, histograms and event hooks.
+
+    The counters named in :data:`COUNTERS` are plain integer attributes,
+    the histograms in :data:`HISTOGRAMS` are :class:`Histogram` attributes.
+
+    Hooks are called as ``hook(event, **info)`` for these events:
+
+    * ``connected`` and ``closed``: ``protocol``
+    * ``frame``: ``channel``, ``frame``, after it has been dispatched
+    * ``write``: ``size``, ``seconds``, for each socket write
+    * ``publish``: ``channel``, ``size``, for each published message
+    * ``deliver``: ``channel``, ``consumer_tag``, ``size``
+    * ``rpc``: ``channel``, ``method``, ``seconds``
+
+    Hooks run synchronously in the connection's reader or writer task, so
+    they must be quick. Exceptions they raise are logged and otherwise
+    ignored.
+    """
+
+    def __init__(self):
+        for name in COUNTERS:
+            setattr(self, name, 0)
+        for name in HISTOGRAMS:
+            setattr(self, name, Histogram())
+        self.hooks = []
+        self.connections = set()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def emit(self, event, **info):
+        for hook in self.hooks:
+            try:
+                hook(event, **info)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Metrics hook %r failed on %s", hook, event)
+
+    def connected(self, protocol):
+        self.connections.add(protocol)
+        if self.hooks:
+            self.emit('connected', protocol=protocol)
+
+    def disconnected(self, protocol):
+        if protocol in self.connections:
+            self.connections.discard(protocol)
+            if self.hooks:
+                self.emit('closed', protocol=protocol)
+
+    def gauges(self):
+        """The current value of the gauges named in :data:`GAUGES`"""
+        values = dict.fromkeys(GAUGES, 0)
+        for protocol in self.connections:
+            values['connections'] += 1
+            values['channels'] += protocol.channels_ids_count
+            values['send_queue_depth'] += protocol.send_queue_depth
+            for channel in protocol.channels.values():
+                values['outstanding_futures'] += channel.outstanding_futures
+        return values
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == inf else repr(bound)
+
+
+def prometheus_text(metrics, prefix='async_amqp'):
+    """Render @metrics in the Prometheus text exposition format"""
+    lines = []
+    for name, text in COUNTERS.items():
+        full = '%s_%s_total' % (prefix, name)
+        lines.append('# HELP %s %s' % (full, text))
+        lines.append('# TYPE %s counter' % full)
+        lines.append('%s %d' % (full, getattr(metrics, name)))
+    for name, value in metrics.gauges().items():
+        full = '%s_%s' % (prefix, name)
+        lines.append('# HELP %s %s' % (full, GAUGES[name]))
+        lines.append('# TYPE %s gauge' % full)
+        lines.append('%s %d' % (full, value))
+    for name, text in HISTOGRAMS.items():
+        full = '%s_%s' % (prefix, name)
+        histogram = getattr(metrics, name)
+        lines.append('# HELP %s %s' % (full, text))
+        lines.append('# TYPE %s histogram' % full)
+        for bound, total in histogram.cumulative():
+            lines.append('%s_bucket{le="%s"} %d' % (full, _format_bound(bound), total))
+        lines.append('%s_sum %r' % (full, histogram.sum))
+        lines.append('%s_count %d' % (full, histogram.count))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,161 @@
+"""
+    Connecting to one of several hosts
+
+:func:`connect_fastest` races connection attempts to several hosts, in the
+style of "happy eyeballs" (RFC 8305): attempts start one after the other,
+a short delay apart, or as soon as the previous attempt failed. The first
+host that completes the TCP and AMQP handshakes wins; the other attempts
+are abandoned.
+
+The time each host took is remembered, and the next call tries the fastest
+host first.
+"""
+
+import logging
+from math import inf
+try:
+    from contextlib import asynccontextmanager
+except ImportError:
+    from async_generator import asynccontextmanager
+
+import anyio
+
+from . import protocol as amqp_protocol
+
+logger = logging.getLogger(__name__)
+
+# Delay between the start of two connection attempts, as RFC 8305 suggests
+STAGGER_DELAY = 0.25
+
+# (host, port) => seconds the last connection took, inf if it failed
+_latencies = {}
+
+
+def parse_host(host):
+    """Split "host", "host:port", "[v6addr]:port" or a (host, port) tuple
+    into a (host, port) tuple. The port is None if not given."""
+    if isinstance(host, tuple):
+        return host
+    name, sep, port = host.rpartition(':')
+    # a bare IPv6 address has colons, but no port
+    if sep and port.isdigit() and (
+        ':' not in name or name.startswith('[') and name.endswith(']')
+    ):
+        return name.strip('[]'), int(port)
+    return host.strip('[]'), None
+
+
+def host_latency(host, port=None):
+    """The time the last connection to @host took, or None if unknown"""
+    return _latencies.get((host, port))
+
+
+def _by_latency(hosts):
+    # Hosts that worked, fastest first, then those that weren't tried yet,
+    # then those that failed. Otherwise keep the given order.
+    def key(item):
+        i, host = item
+        latency = _latencies.get(host)
+        if latency is None:
+            return 1, 0, i
+        return (2 if latency == inf else 0), latency, i
+    return [host for _i, host in sorted(enumerate(hosts), key=key)]
+
+
+class _Race:
+    def __init__(self, hosts, stagger, kwargs):
+        self.hosts = _by_latency([parse_host(host) for host in hosts])
+        self.stagger = stagger
+        self.kwargs = kwargs
+        self.starts = [anyio.create_event() for _ in self.hosts]
+        self.scopes = []  # cancel scopes of attempts and stagger timers
+        self.failures = [None] * len(self.hosts)
+        self.winner = None
+        self.decided = anyio.create_event()
+        self.release = anyio.create_event()
+
+    async def run(self, nursery):
+        self.nursery = nursery
+        for i in range(len(self.hosts)):
+            await nursery.spawn(self._attempt, i)
+        await self.starts[0].set()
+
+    async def _start_next(self, i):
+        if i + 1 < len(self.starts):
+            await self.starts[i + 1].set()
+
+    async def _stagger(self, i):
+        async with anyio.open_cancel_scope() as scope:
+            self.scopes.append(scope)
+            await anyio.sleep(self.stagger)
+            await self._start_next(i)
+
+    async def _attempt(self, i):
+        host, port = self.hosts[i]
+        won = False
+        async with anyio.open_cancel_scope() as scope:
+            self.scopes.append(scope)
+            await self.starts[i].wait()
+            if self.winner is not None:
+                return
+            await self.nursery.spawn(self._stagger, i)
+            started = await anyio.current_time()
+            try:
+                async with amqp_protocol.connect_amqp(host=host, port=port, **self.kwargs) as protocol:
+                    _latencies[(host, port)] = await anyio.current_time() - started
+                    if self.winner is not None:
+                        # another attempt finished at the same time
+                        return
+                    won = True
+                    await self._won(scope, protocol)
+                    await self.release.wait()
+                    return
+            except Exception as exc:  # pylint: disable=broad-except
+                if won:
+                    raise
+                _latencies[(host, port)] = inf
+                logger.debug("Connecting to %s:%s failed: %r", host, port, exc)
+                self.failures[i] = exc
+            await self._start_next(i)
+            if all(failure is not None for failure in self.failures):
+                await self.decided.set()
+
+    async def _won(self, own_scope, protocol):
+        self.winner = protocol
+        for scope in self.scopes:
+            if scope is not own_scope:
+                await scope.cancel()
+        await self.decided.set()
+
+
+@asynccontextmanager
+async def connect_fastest(hosts, *, stagger=STAGGER_DELAY, **kwargs):
+    """Connect to whichever of @hosts is fastest to complete the handshake.
+
+        hosts:
+            list of host names, ``"host:port"`` strings or ``(host, port)``
+            tuples
+        stagger:
+            seconds to wait before starting the next attempt, if the
+            current one neither succeeded nor failed yet
+
+    All other arguments are passed to :func:`connect_amqp`. If no host can
+    be reached, the exception of the first attempt is raised.
+
+    Usage::
+
+        async with connect_fastest(["rabbit1", "rabbit2", "rabbit3:5673"]) as amqp:
+            ...
+    """
+    if not hosts:
+        raise ValueError("At least one host is required")
+    race = _Race(hosts, stagger, kwargs)
+    async with anyio.create_task_group() as nursery:
+        await race.run(nursery)
+        await race.decided.wait()
+        if race.winner is None:
+            raise race.failures[0]
+        try:
+            yield race.winner
+        finally:
+            await race.release.set()
@@ -0,0 +1,188 @@
+"""
+    Connection and channel pool
+
+A :class:`ConnectionPool` keeps a number of connections open, each with a
+number of pre-opened channels. Tasks borrow a channel and give it back,
+which doesn't involve the broker, so many tasks can publish concurrently
+without paying for a Channel.Open round trip each.
+"""
+
+import logging
+try:
+    from contextlib import asynccontextmanager
+except ImportError:
+    from async_generator import asynccontextmanager
+
+import anyio
+
+from . import exceptions
+from . import protocol as amqp_protocol
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """A connection of the pool, and its channels that aren't borrowed"""
+
+    def __init__(self, protocol, max_channels):
+        self.protocol = protocol
+        self.max_channels = max_channels
+        self.idle = []
+        self.borrowed = 0
+
+    @property
+    def is_open(self):
+        return self.protocol.state == amqp_protocol.OPEN
+
+
+class ConnectionPool:
+    """A set of connections with pre-opened channels.
+
+    Don't create this directly; use :func:`connect_pool`.
+
+    A borrowed channel must be given back in a state that other borrowers
+    can use, i.e. without consumers and with the pool's QoS and confirm
+    settings. Channels that have been closed, e.g. by a channel error, are
+    dropped and replaced in the background.
+    """
+
+    def __init__(self, nursery, connections=2, channels=10):
+        if connections < 1 or channels < 1:
+            raise ValueError("A pool needs at least one connection and one channel")
+        self._nursery = nursery
+        self._n_connections = connections
+        self._n_channels = channels
+        self._connections = {}  # AmqpProtocol => PooledConnection
+        self._closing = anyio.create_event()
+        self._available = None  # semaphore, counts channels that may be borrowed
+
+    @property
+    def connections(self):
+        """The pool's connections, e.g. for starting consumers"""
+        return [conn.protocol for conn in self._connections.values()]
+
+    async def _start(self, args, kwargs):
+        for _ in range(self._n_connections):
+            ready = anyio.create_event()
+            await self._nursery.spawn(self._run_connection, args, kwargs, ready)
+            await ready.wait()
+
+        capacity = sum(conn.max_channels for conn in self._connections.values())
+        self._available = anyio.create_semaphore(capacity)
+
+    async def _run_connection(self, args, kwargs, ready):
+        async with amqp_protocol.connect_amqp(*args, **kwargs) as protocol:
+            max_channels = self._n_channels
+            if protocol.server_channel_max:
+                max_channels = min(max_channels, protocol.server_channel_max)
+            conn = PooledConnection(protocol, max_channels)
+            for _ in range(max_channels):
+                conn.idle.append(await protocol.channel())
+            self._connections[protocol] = conn
+            await ready.set()
+            try:
+                await self._closing.wait()
+            finally:
+                del self._connections[protocol]
+
+    async def _stop(self):
+        await self._closing.set()
+
+    async def acquire(self):
+        """Borrow a channel. Waits until one is free.
+
+        Give it back with :meth:`release`, or use :meth:`channel` instead.
+        """
+        if self._closing.is_set():
+            raise exceptions.AmqpClosedConnection()
+        await self._available.acquire()
+        try:
+            return await self._take()
+        except BaseException:
+            await self._available.release()
+            raise
+
+    async def _take(self):
+        while True:
+            connections = [conn for conn in self._connections.values() if conn.is_open]
+            if not connections:
+                raise exceptions.AmqpClosedConnection()
+
+            # the least busy connection has the most idle channels
+            conn = max(connections, key=lambda conn: len(conn.idle))
+            if not conn.idle:
+                # all idle channels are gone; their replacements aren't
+                # open yet
+                conn = min(connections, key=lambda conn: conn.borrowed)
+                channel = await conn.protocol.channel()
+            else:
+                channel = conn.idle.pop()
+                if not channel.is_open:
+                    await self._nursery.spawn(self._replace, conn)
+                    continue
+            conn.borrowed += 1
+            return channel
+
+    async def release(self, channel):
+        """Give back a channel borrowed by :meth:`acquire`."""
+        conn = self._connections.get(channel.protocol)
+        try:
+            if conn is None:
+                # the connection has been closed
+                return
+            conn.borrowed -= 1
+            if channel.is_open:
+                conn.idle.append(channel)
+            elif conn.is_open and not self._closing.is_set():
+                await self._nursery.spawn(self._replace, conn)
+        finally:
+            await self._available.release()
+
+    async def _replace(self, conn):
+        """Open a channel on @conn to replace one that has been closed"""
+        try:
+            channel = await conn.protocol.channel()
+        except (exceptions.AmqpClosedConnection, exceptions.ChannelClosed,
+                exceptions.NoChannelAvailable) as exc:
+            logger.warning("Could not replace a closed pool channel: %r", exc)
+            return
+        if self._closing.is_set() or len(conn.idle) + conn.borrowed >= conn.max_channels:
+            # not needed any more, as _take opened one meanwhile
+            await channel.close()
+            return
+        conn.idle.append(channel)
+
+    @asynccontextmanager
+    async def channel(self):
+        """Borrow a channel for the duration of an ``async with`` block::
+
+            async with pool.channel() as channel:
+                await channel.publish(…)
+        """
+        channel = await self.acquire()
+        try:
+            yield channel
+        finally:
+            await self.release(channel)
+
+
+@asynccontextmanager
+async def connect_pool(*args, connections=2, channels=10, **kwargs):
+    """Open a pool of @connections connections with @channels channels each.
+
+    All other arguments are passed to :func:`connect_amqp`. The number of
+    channels per connection is limited by the server's ``channel_max``.
+
+    Usage::
+
+        async with connect_pool(host="rabbit", connections=4, channels=50) as pool:
+            async with pool.channel() as channel:
+                await channel.publish(b"hello", "", routing_key="q")
+    """
+    async with anyio.create_task_group() as nursery:
+        pool = ConnectionPool(nursery, connections, channels)
+        try:
+            await pool._start(args, kwargs)
+            yield pool
+        finally:
+            await pool._stop()
@@ -1,10 +1,47 @@
 # pylint: disable=redefined-builtin
+"""
+    Message properties, and their encoding in content headers
+
+A content header carries a property list: a 16-bit flags word, with one bit
+per property that is present, followed by the values of those properties in
+a fixed order. :func:`decode` and :func:`encode` convert between that list
+and :class:`Properties` without going through pamqp's objects.
+"""
+
+import calendar
+import datetime
+import struct
+import time
+
+import pamqp.decode
+import pamqp.encode
+
 from .constants import MESSAGE_PROPERTIES
 
+_SHORT = struct.Struct('>H')
+_LONG = struct.Struct('>I')
+_LONGLONG = struct.Struct('>Q')
+
+# how each property is encoded
+SHORTSTR, OCTET, TABLE, TIMESTAMP = range(4)
+
+_TYPES = {'headers': TABLE, 'delivery_mode': OCTET, 'priority': OCTET, 'timestamp': TIMESTAMP}
+
+# (name, flag, type) in property list order; the first one has bit 15
+FIELDS = tuple(
+    (name, 1 << (15 - i), _TYPES.get(name, SHORTSTR)) for i, name in enumerate(MESSAGE_PROPERTIES)
+)
+_FIELDS_BY_NAME = {field[0]: field for field in FIELDS}
+
 
 class Properties:
-    """Class for basic message properties"""
-    __slots__ = tuple(MESSAGE_PROPERTIES)
+    """Class for basic message properties
+
+    Properties that were received from the server keep the encoded headers
+    table until :attr:`headers` is read. If they are published again before
+    that, the table is sent as it was received, without being decoded.
+    """
+    __slots__ = tuple(name for name in MESSAGE_PROPERTIES if name != 'headers') + ('_headers', '_raw_headers')
 
     def __init__(
         self,
@@ -25,7 +62,8 @@ class Properties:
     ):
         self.content_type = content_type
         self.content_encoding = content_encoding
-        self.headers = headers
+        self._headers = headers
+        self._raw_headers = None
         self.delivery_mode = delivery_mode
         self.priority = priority
         self.correlation_id = correlation_id
@@ -38,6 +76,18 @@ class Properties:
         self.app_id = app_id
         self.cluster_id = cluster_id
 
+    @property
+    def headers(self):
+        if self._raw_headers is not None:
+            _, self._headers = pamqp.decode.field_table(self._raw_headers)
+            self._raw_headers = None
+        return self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self._headers = value
+        self._raw_headers = None
+
 
 def from_pamqp(instance):
     props = Properties()
@@ -56,3 +106,100 @@ def from_pamqp(instance):
     props.app_id = instance.app_id
     props.cluster_id = instance.cluster_id
     return props
+
+
+def decode(data, offset=0):
+    """Decode the property list in @data, starting at @offset.
+
+    @data may be any bytes-like object. The headers table is copied, but
+    not decoded until it is used.
+    """
+    flags, = _SHORT.unpack_from(data, offset)
+    pos = offset + 2
+    while data[pos - 1] & 1:
+        # more flag words. Basic has no properties that use them.
+        pos += 2
+
+    props = Properties.__new__(Properties)
+    props._headers = None
+    props._raw_headers = None
+    for name, flag, kind in FIELDS:
+        if not flags & flag:
+            if kind != TABLE:
+                setattr(props, name, None)
+            continue
+        if kind == SHORTSTR:
+            end = pos + 1 + data[pos]
+            value = bytes(data[pos + 1:end]).decode('utf-8')
+            pos = end
+        elif kind == OCTET:
+            value = data[pos]
+            pos += 1
+        elif kind == TABLE:
+            length, = _LONG.unpack_from(data, pos)
+            props._raw_headers = bytes(data[pos:pos + 4 + length])
+            pos += 4 + length
+            continue
+        else:
+            seconds, = _LONGLONG.unpack_from(data, pos)
+            value = time.gmtime(seconds)
+            pos += 8
+        setattr(props, name, value)
+    return props
+
+
+def _encode_value(name, kind, value):
+    if kind == SHORTSTR:
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        elif not isinstance(value, (bytes, bytearray)):
+            raise TypeError("Property %s must be a string, not %r" % (name, value))
+        if len(value) > 255:
+            raise ValueError("Property %s is longer than 255 bytes" % name)
+        return bytes((len(value),)) + value
+    if kind == OCTET:
+        return bytes((value,))
+    if kind == TABLE:
+        return pamqp.encode.field_table(value)
+    if isinstance(value, datetime.datetime):
+        value = calendar.timegm(value.timetuple())
+    elif isinstance(value, time.struct_time):
+        value = calendar.timegm(value)
+    return _LONGLONG.pack(int(value))
+
+
+def encode(properties):
+    """Encode @properties as a property list.
+
+    @properties is a :class:`Properties` instance, a dict with some of its
+    attributes, or None. Properties that are None or empty are left out.
+    """
+    flags = 0
+    parts = [b'']
+    if isinstance(properties, Properties):
+        for name, flag, kind in FIELDS:
+            if kind == TABLE and properties._raw_headers is not None:
+                flags |= flag
+                parts.append(properties._raw_headers)
+                continue
+            value = getattr(properties, name)
+            if value is not None and value != '':
+                flags |= flag
+                parts.append(_encode_value(name, kind, value))
+    elif properties:
+        fields = []
+        for name, value in properties.items():
+            if value is None or value == '':
+                continue
+            try:
+                field = _FIELDS_BY_NAME[name]
+            except KeyError:
+                raise TypeError("Unknown message property %r" % name) from None
+            fields.append(field)
+            flags |= field[1]
+        if len(fields) > 1:
+            fields.sort(key=lambda field: -field[1])
+        for name, _flag, kind in fields:
+            parts.append(_encode_value(name, kind, properties[name]))
+    parts[0] = _SHORT.pack(flags)
+    return b''.join(parts)
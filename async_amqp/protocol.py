@@ -8,22 +8,40 @@ import logging
 from math import inf
 import socket
 import ssl
+import time
 try:
     from contextlib import asynccontextmanager
 except ImportError:
     from async_generator import asynccontextmanager
 import pamqp
+import pamqp.body
+import pamqp.header
+import pamqp.heartbeat
 from anyio.abc import SocketAttribute
 
 from . import channel as amqp_channel
 from . import constants as amqp_constants
 from . import frame as amqp_frame
+from .content import Content, CONTENT_METHODS
 from . import exceptions
 
 logger = logging.getLogger(__name__)
 
 CONNECTING, OPEN, CLOSING, CLOSED = range(4)
-READ_BUF_SIZE = 1024
+READ_BUF_SIZE = 65536
+
+# Upper limits for coalescing queued frames into a single socket write
+WRITE_BATCH_SIZE = 256 * 1024
+WRITE_BATCH_FRAMES = 64
+
+# Handlers for the connection methods a server sends, by frame index
+METHOD_HANDLERS = {
+    pamqp.specification.Connection.Close.index: 'server_close',
+    pamqp.specification.Connection.CloseOk.index: 'close_ok',
+    pamqp.specification.Connection.Tune.index: 'tune',
+    pamqp.specification.Connection.Start.index: 'start',
+    pamqp.specification.Connection.OpenOk.index: 'open_ok',
+}
 
 
 class ChannelContext:
@@ -80,7 +98,11 @@ class AmqpProtocol:
         heartbeat=None,
         client_properties=None,
         login_method='AMQPLAIN',
-        insist=False
+        insist=False,
+        write_batch_size=WRITE_BATCH_SIZE,
+        write_batch_frames=WRITE_BATCH_FRAMES,
+        metrics=None,
+        spill_threshold=None
     ):
         """Defines our new protocol instance
 
@@ -122,6 +144,22 @@ class AmqpProtocol:
                 heartbeat.
             client_properties:
                 dict, client-props to tune the client identification
+            write_batch_size:
+                the writer sends everything that's queued up in a single
+                socket write. Stop collecting more frames once the batch
+                has reached this many bytes.
+            write_batch_frames:
+                maximum number of queued frames to send in a single
+                socket write. A published message counts as one frame.
+                1 disables coalescing.
+            metrics:
+                a :class:`async_amqp.metrics.Metrics` instance that counts
+                what this connection does. None disables instrumentation.
+            spill_threshold:
+                received message bodies of more than this many bytes are
+                written to an anonymous temporary file, and delivered as a
+                memoryview of a memory map of it instead of bytes. None
+                keeps all bodies in memory.
         """
 
         self._reader_scope = None
@@ -137,6 +175,18 @@ class AmqpProtocol:
         if heartbeat is not None:
             self.connection_tunning['heartbeat'] = heartbeat
 
+        if write_batch_frames < 1:
+            raise ValueError("write_batch_frames must be at least 1")
+        self._write_batch_size = write_batch_size
+        self._write_batch_frames = write_batch_frames
+        self.metrics = metrics
+        self.spill_threshold = spill_threshold
+        self._send_queued = 0  # items in the send queue, or waiting to get there
+
+        self._method_handlers = {
+            index: getattr(self, name) for index, name in METHOD_HANDLERS.items()
+        }
+
         if login_method != 'AMQPLAIN':
             # TODO
             logger.warning('only AMQPLAIN login_method is supported, ' 'falling back to AMQPLAIN')
@@ -184,13 +234,58 @@ class AmqpProtocol:
         #    # version of Python where this bugs exists is supported anymore.
         #    await self._stream_writer.drain()
 
+    @property
+    def send_queue_depth(self):
+        """The number of frames (or published messages) waiting to be sent"""
+        return self._send_queued
+
     async def _write_frame(self, channel_id, request, drain=True):
         # Doesn't actually write frame, pushes it for _writer_loop task to
         # pick it up.
         data = pamqp.frame.marshal(request, channel_id)
-        await self._send_queue_w.send(data)
+        if self.metrics is not None:
+            self.metrics.frames_out += 1
+        await self._write_data(data)
+
+    async def _write_data(self, data):
+        # Like _write_frame, for frames that have already been marshalled.
+        # All of @data is sent without interleaving any other frame.
+        self._send_queued += 1
+        try:
+            await self._send_queue_w.send(data)
+        except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+            self._send_queued -= 1
+            # the writer is gone
+            raise exceptions.AmqpClosedConnection() from None
+        except BaseException:
+            self._send_queued -= 1
+            raise
+
+    async def _close_send_queue(self):
+        # Writers that wait for room in the queue don't wait for a writer
+        # loop that's gone. Whoever waits for something that is still
+        # queued to be sent gets an error, as do later writers.
+        async with anyio.open_cancel_scope(shield=True):
+            await self._send_queue_w.aclose()
+            while True:
+                try:
+                    data = await self._send_queue_r.receive_nowait()
+                except (anyio.WouldBlock, anyio.EndOfStream):
+                    break
+                self._send_queued -= 1
+                await amqp_frame.release(data, failed=True)
+            await self._send_queue_r.aclose()
 
     async def _writer_loop(self, done):
+        try:
+            await self._write_loop(done)
+        finally:
+            # Nothing can be sent anymore
+            async with anyio.open_cancel_scope(shield=True):
+                await self.connection_closed.set()
+            await self._close_send_queue()
+
+    async def _write_loop(self, done):
         async with anyio.open_cancel_scope(shield=True) as scope:
             self._writer_scope = scope
             await done.set()
@@ -205,13 +300,50 @@ class AmqpProtocol:
                 if timeout_scope.cancel_called:
                     await self.send_heartbeat()
                     continue
+                self._send_queued -= 1
+                if self._write_batch_frames > 1:
+                    data = await self._collect_frames(data)
 
+                metrics = self.metrics
+                if metrics is not None:
+                    started = time.perf_counter()
                 try:
-                    await self._stream.send(data)
+                    await amqp_frame.send(self._stream, data)
                 except (anyio.ClosedResourceError, BrokenPipeError):
                     # raise exceptions.AmqpClosedConnection(self) from None
                     # the reader will raise the error also
                     return
+                if metrics is not None:
+                    self._count_write(metrics, len(data), time.perf_counter() - started)
+
+    @staticmethod
+    def _count_write(metrics, size, seconds):
+        metrics.writes += 1
+        metrics.bytes_out += size
+        metrics.write_seconds.observe(seconds)
+        if metrics.hooks:
+            metrics.emit('write', size=size, seconds=seconds)
+
+    async def _collect_frames(self, data):
+        """Append whatever else is waiting in the send queue to @data.
+
+        Frames are kept in queue order. Collecting stops when the queue is
+        empty or when one of the batch limits is reached.
+        """
+        frames = [data]
+        size = len(data)
+        while len(frames) < self._write_batch_frames and size < self._write_batch_size:
+            try:
+                data = await self._send_queue_r.receive_nowait()
+            except anyio.WouldBlock:
+                break
+            self._send_queued -= 1
+            frames.append(data)
+            size += len(data)
+
+        if len(frames) == 1:
+            return frames[0]
+        return amqp_frame.ContentFrames.join(frames)
 
     async def close(self, no_wait=False):
         """Close connection (and all channels)"""
@@ -223,6 +355,8 @@ class AmqpProtocol:
             return
 
         try:
+            if self.state == OPEN and not self.connection_closed.is_set():
+                await self._flush_acks()
             self.state = CLOSING
             got_close = self.connection_closed.is_set()
             await self.connection_closed.set()
@@ -238,7 +372,7 @@ class AmqpProtocol:
                 )
                 try:
                     await self._write_frame(0, request)
-                except anyio.ClosedResourceError:
+                except exceptions.AmqpClosedConnection:
                     pass
                 except Exception:
                     logger.exception("Error while closing")
@@ -260,6 +394,20 @@ class AmqpProtocol:
                 finally:
                     self._nursery = None
                     self.state = CLOSED
+                    if self.metrics is not None:
+                        self.metrics.disconnected(self)
+
+    async def _flush_acks(self):
+        # Acks that channels hold back would be lost with the connection.
+        # Closing cancels the writer, so wait until they have been sent.
+        async with anyio.move_on_after(2):
+            for channel in list(self.channels.values()):
+                if not channel.is_open:
+                    continue
+                try:
+                    await channel.flush_acks(wait=True)
+                except (exceptions.ChannelClosed, exceptions.AmqpClosedConnection):
+                    pass
 
     async def wait_closed(self):
         await self.connection_closed.wait()
@@ -284,11 +432,13 @@ class AmqpProtocol:
         self.server_locales = None
         self.server_heartbeat = None
         self.channels = {}
+        self._contents = {}  # channel_id => Content that's being received
         self.server_frame_max = None
         self.server_channel_max = None
         self.channels_ids_ceil = 0
         self.channels_ids_free = set()
-        self._send_queue_w,self._send_queue_r = anyio.create_memory_object_stream(1)
+        self._send_queue_w,self._send_queue_r = anyio.create_memory_object_stream(self._write_batch_frames)
+        self._send_queued = 0
 
         if self._ssl:
             if self._ssl is True:
@@ -310,9 +460,9 @@ class AmqpProtocol:
 
         stream.extra(SocketAttribute.raw_socket).setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        from anyio.streams.buffered import BufferedByteReceiveStream
         self._stream = stream
-        self._rstream = BufferedByteReceiveStream(stream)
+        self._rstream = amqp_frame.FrameReader(stream, READ_BUF_SIZE)
+        self._rstream.metrics = self.metrics
 
         # the writer loop needs to run since the beginning
         done_here = anyio.create_event()
@@ -374,6 +524,8 @@ class AmqpProtocol:
             done_here = anyio.create_event()
             await self._nursery.spawn(self._reader_loop, done_here)
             await done_here.wait()
+            if self.metrics is not None:
+                self.metrics.connected(self)
 
         except BaseException as exc:
             async with anyio.fail_after(2, shield=True):
@@ -406,36 +558,60 @@ class AmqpProtocol:
     async def dispatch_frame(self, frame_channel=None, frame=None):
         """Dispatch the received frame to the corresponding handler"""
 
-        method_dispatch = {
-            pamqp.specification.Connection.Close.name: self.server_close,
-            pamqp.specification.Connection.CloseOk.name: self.close_ok,
-            pamqp.specification.Connection.Tune.name: self.tune,
-            pamqp.specification.Connection.Start.name: self.start,
-            pamqp.specification.Connection.OpenOk.name: self.open_ok,
-        }
         if frame is None:
             frame_channel, frame = await self.get_frame()
 
-        if isinstance(frame, pamqp.heartbeat.Heartbeat):
+        frame_type = type(frame)
+        if frame_type is pamqp.heartbeat.Heartbeat:
+            if self.metrics is not None:
+                self.metrics.heartbeats_in += 1
             return
 
         if frame_channel:
             channel = self.channels.get(frame_channel)
-            if channel is not None:
-                await channel.dispatch_frame(frame)
-            else:
+            if channel is None:
                 logger.info("Unknown channel %s", frame_channel)
+                return
+            if frame_type is pamqp.body.ContentBody:
+                content = self._get_content(frame_channel)
+                if content.stream is not None:
+                    if await content.stream_body(frame):
+                        del self._contents[frame_channel]
+                elif content.add_body(frame):
+                    await channel.dispatch_content(self._contents.pop(frame_channel))
+            elif frame_type is pamqp.header.ContentHeader:
+                content = self._get_content(frame_channel)
+                if content.add_header(frame, self.spill_threshold):
+                    await channel.dispatch_content(self._contents.pop(frame_channel))
+                else:
+                    await channel.start_content(content)
+            elif frame.index in CONTENT_METHODS:
+                self._contents[frame_channel] = Content(frame)
+            else:
+                await channel.dispatch_frame(frame)
             return
 
-        if frame.name not in method_dispatch:
+        handler = self._method_handlers.get(frame.index)
+        if handler is None:
             logger.info("frame %s is not handled", frame.name)
             return
-        await method_dispatch[frame.name](frame)
+        await handler(frame)
+
+    def _get_content(self, channel_id):
+        try:
+            return self._contents[channel_id]
+        except KeyError:
+            raise exceptions.SynchronizationError(
+                "Content frame without a method on channel %d" % channel_id
+            ) from None
 
     def release_channel_id(self, channel_id):
         """Called from the channel instance, it relase a previously used
         channel_id
         """
+        content = self._contents.pop(channel_id, None)
+        if content is not None:
+            content.discard()
         self.channels_ids_free.add(channel_id)
 
     @property
@@ -463,6 +639,10 @@ class AmqpProtocol:
             try:
                 await done.set()
                 while True:
+                    # On asyncio, the cancellation may be absorbed by the
+                    # inner timeout scope; don't read again in that case.
+                    if scope.cancel_called:
+                        return
                     try:
                         if self._stream is None:
                             raise exceptions.AmqpClosedConnection
@@ -479,7 +659,10 @@ class AmqpProtocol:
                                 # the stream is now *really* closed …
                                 return
                         try:
-                            await self.dispatch_frame(channel, frame)
+                            if self.metrics is None:
+                                await self.dispatch_frame(channel, frame)
+                            else:
+                                await self._dispatch_counted(channel, frame)
                         except Exception as exc:
                             # We want to raise this exception so that the
                             # nursery ends the protocol, but we need keep
@@ -506,15 +689,31 @@ class AmqpProtocol:
                         raise
             finally:
                 self._reader_scope = None
+                if self.metrics is not None:
+                    self.metrics.disconnected(self)
                 async with anyio.fail_after(2, shield=True):
                     await self.connection_closed.set()
 
+    async def _dispatch_counted(self, channel, frame):
+        # dispatch_frame, instrumented
+        metrics = self.metrics
+        started = time.perf_counter()
+        try:
+            await self.dispatch_frame(channel, frame)
+        finally:
+            metrics.frames_in += 1
+            metrics.dispatch_seconds.observe(time.perf_counter() - started)
+            if metrics.hooks:
+                metrics.emit('frame', channel=channel, frame=frame)
+
     async def send_heartbeat(self):
         """Sends an heartbeat message.
         It can be an ack for the server or the client willing to check for the
         connexion timeout
         """
         request = pamqp.heartbeat.Heartbeat()
+        if self.metrics is not None:
+            self.metrics.heartbeats_out += 1
         await self._write_frame(0, request)
 
     # Amqp specific methods
@@ -0,0 +1,512 @@
+"""
+    Connections that recover from network failures
+
+:func:`connect_robust` returns a :class:`RobustConnection`. When its
+connection is lost, it reconnects with exponential backoff, racing the
+given hosts with :func:`connect_fastest`, then declares the exchanges, queues and bindings it
+has seen being declared again, reopens its channels and restores their
+QoS settings, publisher confirms and ``basic_consume`` consumers.
+
+Publishing while the connection is down either waits for it to come back
+or, with ``publish_buffer``, queues up to that many messages per channel.
+"""
+
+import inspect
+import logging
+import random
+import uuid
+from collections import deque
+try:
+    from contextlib import asynccontextmanager
+except ImportError:
+    from async_generator import asynccontextmanager
+
+import anyio
+
+from . import exceptions
+from .channel import Channel
+from .multihost import connect_fastest, parse_host
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+
+
+def _arguments(method, args, kwargs):
+    """The arguments of a Channel @method call, by name"""
+    bound = inspect.signature(getattr(Channel, method)).bind(None, *args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    del arguments['self']
+    return arguments
+
+
+class RobustChannel:
+    """A channel that is reopened, with its state, after a reconnection.
+
+    Methods that aren't listed here are passed on to the current
+    :class:`Channel`. Queue names that the server generated are mapped to
+    the names the server generates for them after a reconnection.
+    """
+
+    def __init__(self, connection, publish_buffer):
+        self._connection = connection
+        self._channel = None
+        self._ready = anyio.create_event()
+        self._closed = False
+        self._qos = None
+        self._confirm = None
+        self._consumers = {}  # consumer_tag => basic_consume arguments
+        self._buffer = deque()
+        self._buffer_size = publish_buffer
+
+    def __getattr__(self, name):
+        if self._channel is None:
+            raise exceptions.AmqpClosedConnection()
+        return getattr(self._channel, name)
+
+    @property
+    def channel(self):
+        """The current :class:`Channel`, or None while disconnected"""
+        return self._channel
+
+    @property
+    def is_open(self):
+        return not self._closed
+
+    async def _restore(self, protocol):
+        """Open a new channel on @protocol and restore this one's state"""
+        channel = await protocol.channel()
+        if self._qos is not None:
+            await channel.basic_qos(**self._qos)
+        if self._confirm is not None:
+            await channel.confirm_select(**self._confirm)
+        for consumer_tag, arguments in self._consumers.items():
+            arguments = dict(arguments, consumer_tag=consumer_tag)
+            arguments['queue_name'] = self._connection._queue_name(arguments['queue_name'])
+            try:
+                await channel.basic_consume(**arguments)
+            except exceptions.ChannelClosed as exc:
+                # e.g. the queue is gone. Drop the consumer and start over,
+                # as the server has closed the channel.
+                logger.error("Could not resume consumer %s: %r", consumer_tag, exc)
+                del self._consumers[consumer_tag]
+                return await self._restore(protocol)
+        self._channel = channel
+        while self._buffer:
+            args, kwargs = self._buffer[0]
+            await self._publish(channel, args, kwargs)
+            self._buffer.popleft()
+        await self._ready.set()
+
+    async def _lost(self):
+        if self._ready.is_set():
+            self._ready = anyio.create_event()
+
+    async def _usable(self):
+        """The current channel, if it can be used. None if it's being
+        replaced; wait for :attr:`_ready` then."""
+        if self._closed:
+            raise exceptions.ChannelClosed()
+        channel = self._channel
+        if channel.is_open:
+            return channel
+        if not channel.protocol.connection_closed.is_set():
+            # the server closed the channel, not the connection
+            raise exceptions.ChannelClosed()
+        # the connection is lost, and the supervisor may not know yet
+        await self._lost()
+        return None
+
+    async def _call(self, method, *args, **kwargs):
+        while True:
+            channel = await self._usable()
+            if channel is not None:
+                return await getattr(channel, method)(*args, **kwargs)
+            await self._ready.wait()
+
+    async def close(self):
+        """Close the channel for good."""
+        if self._closed:
+            return
+        self._closed = True
+        self._connection._channels.remove(self)
+        channel = self._channel
+        if channel is not None and channel.is_open:
+            await channel.close()
+
+    async def exchange_declare(self, *args, **kwargs):
+        result = await self._call('exchange_declare', *args, **kwargs)
+        self._connection._record_exchange(_arguments('exchange_declare', args, kwargs))
+        return result
+
+    async def exchange_delete(self, *args, **kwargs):
+        result = await self._call('exchange_delete', *args, **kwargs)
+        self._connection._forget_exchange(_arguments('exchange_delete', args, kwargs)['exchange_name'])
+        return result
+
+    async def exchange_bind(self, *args, **kwargs):
+        result = await self._call('exchange_bind', *args, **kwargs)
+        self._connection._record_binding('exchange_bind', _arguments('exchange_bind', args, kwargs))
+        return result
+
+    async def exchange_unbind(self, *args, **kwargs):
+        result = await self._call('exchange_unbind', *args, **kwargs)
+        self._connection._forget_binding('exchange_bind', _arguments('exchange_unbind', args, kwargs))
+        return result
+
+    async def queue_declare(self, *args, **kwargs):
+        arguments = _arguments('queue_declare', args, kwargs)
+        name = arguments['queue_name']
+        arguments['queue_name'] = self._connection._queue_name(name)
+        result = await self._call('queue_declare', **arguments)
+        arguments['queue_name'] = name
+        self._connection._record_queue(arguments, result['queue'])
+        return result
+
+    async def queue_delete(self, *args, **kwargs):
+        arguments = _arguments('queue_delete', args, kwargs)
+        name = arguments['queue_name']
+        arguments['queue_name'] = self._connection._queue_name(name)
+        result = await self._call('queue_delete', **arguments)
+        self._connection._forget_queue(name)
+        return result
+
+    async def queue_bind(self, *args, **kwargs):
+        arguments = _arguments('queue_bind', args, kwargs)
+        result = await self._call(
+            'queue_bind', **dict(arguments, queue_name=self._connection._queue_name(arguments['queue_name']))
+        )
+        self._connection._record_binding('queue_bind', arguments)
+        return result
+
+    async def queue_unbind(self, *args, **kwargs):
+        arguments = _arguments('queue_unbind', args, kwargs)
+        result = await self._call(
+            'queue_unbind', **dict(arguments, queue_name=self._connection._queue_name(arguments['queue_name']))
+        )
+        self._connection._forget_binding('queue_bind', arguments)
+        return result
+
+    async def queue_purge(self, queue_name, no_wait=False):
+        return await self._call('queue_purge', self._connection._queue_name(queue_name), no_wait=no_wait)
+
+    async def basic_get(self, queue_name='', no_ack=False):
+        return await self._call('basic_get', self._connection._queue_name(queue_name), no_ack=no_ack)
+
+    async def basic_qos(self, *args, **kwargs):
+        result = await self._call('basic_qos', *args, **kwargs)
+        self._qos = _arguments('basic_qos', args, kwargs)
+        return result
+
+    async def confirm_select(self, *, no_wait=False, max_in_flight=None):
+        result = await self._call('confirm_select', no_wait=no_wait, max_in_flight=max_in_flight)
+        self._confirm = {'no_wait': no_wait, 'max_in_flight': max_in_flight}
+        return result
+
+    async def basic_consume(self, *args, **kwargs):
+        """Start a consumer that is resubscribed after a reconnection.
+
+        Messages that weren't acknowledged when the connection was lost are
+        delivered again, with new delivery tags.
+        """
+        arguments = _arguments('basic_consume', args, kwargs)
+        # the tag must stay the same, so don't let the channel pick one
+        consumer_tag = arguments.pop('consumer_tag') or 'ctag.%s' % uuid.uuid4().hex
+        result = await self._call(
+            'basic_consume', consumer_tag=consumer_tag,
+            **dict(arguments, queue_name=self._connection._queue_name(arguments['queue_name']))
+        )
+        self._consumers[consumer_tag] = arguments
+        return result
+
+    async def basic_cancel(self, consumer_tag, no_wait=False):
+        self._consumers.pop(consumer_tag, None)
+        return await self._call('basic_cancel', consumer_tag, no_wait=no_wait)
+
+    async def publish(self, *args, **kwargs):
+        """Publish a message, like :meth:`Channel.publish`.
+
+        While the connection is down, the message is buffered if there's
+        room in the publish buffer; otherwise this waits for the
+        connection to be restored.
+        """
+        while True:
+            channel = await self._usable()
+            # while the channel is being restored, buffered messages go first
+            if channel is not None and self._ready.is_set():
+                try:
+                    return await self._publish(channel, args, kwargs)
+                except (exceptions.AmqpClosedConnection, exceptions.ChannelClosed):
+                    if not channel.protocol.connection_closed.is_set():
+                        raise
+                    # lost along with the connection; publish it again
+                    continue
+            if len(self._buffer) < self._buffer_size:
+                self._buffer.append((args, kwargs))
+                return None
+            await self._ready.wait()
+
+    async def _publish(self, channel, args, kwargs):
+        arguments = _arguments('publish', args, kwargs)
+        if arguments['exchange_name'] == '':
+            arguments['routing_key'] = self._connection._queue_name(arguments['routing_key'])
+        return await channel.publish(**arguments)
+
+
+class RobustChannelContext:
+    """Returned by :meth:`RobustConnection.new_channel`"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        self.channel = await self.connection.channel()
+        return self.channel
+
+    async def __aexit__(self, *tb):
+        async with anyio.move_on_after(2, shield=True):
+            try:
+                await self.channel.close()
+            except (exceptions.AmqpClosedConnection, exceptions.ChannelClosed):
+                pass
+
+
+class RobustConnection:
+    """A connection that recovers from network failures.
+
+    Don't create this directly; use :func:`connect_robust`.
+    """
+
+    def __init__(
+        self,
+        hosts,
+        kwargs,
+        reconnect_delay=RECONNECT_DELAY,
+        max_reconnect_delay=MAX_RECONNECT_DELAY,
+        publish_buffer=0,
+    ):
+        if not hosts:
+            raise ValueError("At least one host is required")
+        self._hosts = [parse_host(host) for host in hosts]
+        self._kwargs = kwargs
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._publish_buffer = publish_buffer
+
+        self.protocol = None
+        self.reconnects = 0
+        self._connected_before = False
+        self._connected = anyio.create_event()
+        self._closing = anyio.create_event()
+        self._channels = []
+
+        # the topology to restore, in declaration order
+        self._exchanges = {}  # name => exchange_declare arguments
+        self._queues = {}  # name => queue_declare arguments
+        self._queue_names = {}  # declared name => current name, for server-named queues
+        self._bindings = []  # (method, arguments)
+
+    @property
+    def is_connected(self):
+        return self._connected.is_set()
+
+    async def wait_connected(self):
+        await self._connected.wait()
+
+    async def _run(self):
+        delay = self._reconnect_delay
+        while not self._closing.is_set():
+            try:
+                async with connect_fastest(self._hosts, **self._kwargs) as protocol:
+                    await self._recover(protocol)
+                    delay = self._reconnect_delay
+                    await self._closing.wait()
+            except (Exception, anyio.ExceptionGroup) as exc:  # pylint: disable=broad-except
+                if self._closing.is_set():
+                    break
+                logger.warning("Connection failed: %r", exc)
+            finally:
+                self.protocol = None
+                if self._connected.is_set():
+                    self._connected = anyio.create_event()
+                for channel in self._channels:
+                    await channel._lost()
+            if self._closing.is_set():
+                break
+
+            # jitter, so that many clients don't reconnect in lockstep
+            await anyio.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, self._max_reconnect_delay)
+
+    async def _recover(self, protocol):
+        """Restore the topology and the channels on a new connection"""
+        self.protocol = protocol
+        if self._exchanges or self._queues or self._bindings:
+            await self._restore_topology(protocol)
+        for channel in list(self._channels):
+            await channel._restore(protocol)
+        if self._connected_before:
+            self.reconnects += 1
+            logger.info("Reconnected to %s:%s", protocol._host, protocol._port)
+        self._connected_before = True
+        await self._connected.set()
+
+    def _topology(self):
+        """(method, name, arguments) of everything that was declared.
+
+        This is a generator, so that bindings use the names that
+        server-named queues got when they were declared again.
+        """
+        for name, arguments in self._exchanges.items():
+            yield 'exchange_declare', name, arguments
+        for name, arguments in self._queues.items():
+            yield 'queue_declare', name, arguments
+        for method, arguments in self._bindings:
+            if method == 'queue_bind':
+                arguments = dict(arguments, queue_name=self._queue_name(arguments['queue_name']))
+            yield method, None, arguments
+
+    async def _restore_topology(self, protocol):
+        channel = await protocol.channel()
+        try:
+            for method, name, arguments in self._topology():
+                try:
+                    result = await getattr(channel, method)(**arguments)
+                except exceptions.ChannelClosed as exc:
+                    # e.g. declared with different arguments meanwhile;
+                    # retrying won't help
+                    logger.error("Could not restore %s %s: %r", method, name or arguments, exc)
+                    channel = await protocol.channel()
+                    continue
+                if name in self._queue_names:
+                    self._queue_names[name] = result['queue']
+        finally:
+            if channel.is_open:
+                await channel.close()
+
+    def _queue_name(self, name):
+        return self._queue_names.get(name, name)
+
+    def _record_exchange(self, arguments):
+        if not arguments['passive']:
+            self._exchanges[arguments['exchange_name']] = dict(arguments, no_wait=False)
+
+    def _forget_exchange(self, name):
+        self._exchanges.pop(name, None)
+        self._bindings = [
+            (method, arguments) for method, arguments in self._bindings
+            if name not in (
+                arguments.get('exchange_name'),
+                arguments.get('exchange_source'),
+                arguments.get('exchange_destination'),
+            )
+        ]
+
+    def _record_queue(self, arguments, name):
+        if arguments['passive']:
+            return
+        declared = arguments['queue_name']
+        if not declared:
+            # a server-named queue keeps the name it got first
+            self._queue_names[name] = name
+            declared = name
+        elif declared in self._queue_names:
+            # declared again, by the name it got first
+            return
+        self._queues[declared] = dict(arguments, no_wait=False)
+
+    def _forget_queue(self, name):
+        self._queues.pop(name, None)
+        self._queue_names.pop(name, None)
+        for channel in self._channels:
+            channel._consumers = {
+                tag: arguments for tag, arguments in channel._consumers.items()
+                if arguments['queue_name'] != name
+            }
+        self._bindings = [
+            (method, arguments) for method, arguments in self._bindings
+            if method != 'queue_bind' or arguments['queue_name'] != name
+        ]
+
+    def _record_binding(self, method, arguments):
+        binding = (method, dict(arguments, no_wait=False))
+        if binding not in self._bindings:
+            self._bindings.append(binding)
+
+    def _forget_binding(self, method, arguments):
+        arguments = dict(arguments, no_wait=False)
+        self._bindings = [
+            (m, a) for m, a in self._bindings
+            if not (m == method and all(a[key] == value for key, value in arguments.items()))
+        ]
+
+    async def channel(self):
+        """Open a :class:`RobustChannel`, waiting for the connection if it's down"""
+        channel = RobustChannel(self, self._publish_buffer)
+        while True:
+            await self._connected.wait()
+            protocol = self.protocol
+            try:
+                await channel._restore(protocol)
+            except (exceptions.AmqpClosedConnection, exceptions.ChannelClosed):
+                if not protocol.connection_closed.is_set():
+                    raise
+                continue
+            self._channels.append(channel)
+            return channel
+
+    def new_channel(self):
+        return RobustChannelContext(self)
+
+    async def close(self):
+        await self._closing.set()
+
+
+@asynccontextmanager
+async def connect_robust(
+    hosts=('localhost',),
+    *,
+    reconnect_delay=RECONNECT_DELAY,
+    max_reconnect_delay=MAX_RECONNECT_DELAY,
+    publish_buffer=0,
+    **kwargs
+):
+    """Connect to the first reachable of @hosts, and reconnect when needed.
+
+        hosts:
+            list of host names, ``"host:port"`` strings or ``(host, port)``
+            tuples. The first one to accept the connection is used.
+        reconnect_delay:
+            seconds to wait before the first reconnection attempt. The delay
+            doubles with every failed attempt.
+        max_reconnect_delay:
+            the longest delay between two attempts
+        publish_buffer:
+            how many messages per channel :meth:`RobustChannel.publish`
+            queues while the connection is down, instead of waiting
+
+    All other arguments are passed to :func:`connect_amqp`.
+
+    Usage::
+
+        async with connect_robust(["rabbit1", "rabbit2:5673"]) as conn:
+            async with conn.new_channel() as channel:
+                await channel.queue_declare("jobs", durable=True)
+                await channel.basic_consume(handle_job, queue_name="jobs")
+                ...
+    """
+    async with anyio.create_task_group() as nursery:
+        conn = RobustConnection(
+            list(hosts), kwargs,
+            reconnect_delay=reconnect_delay,
+            max_reconnect_delay=max_reconnect_delay,
+            publish_buffer=publish_buffer,
+        )
+        await nursery.spawn(conn._run)
+        try:
+            await conn.wait_connected()
+            yield conn
+        finally:
+            await conn.close()
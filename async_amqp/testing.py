@@ -0,0 +1,985 @@
+"""
+    A fake AMQP 0-9-1 broker, for tests and benchmarks
+
+Usage::
+
+    async with FakeBroker() as broker:
+        async with connect_amqp(port=broker.port) as amqp:
+            ...
+
+The broker runs in the current event loop and listens on a local TCP port.
+It implements enough of AMQP 0-9-1, as RabbitMQ does it, to run clients
+without a real server: the connection handshake, channels, direct, fanout,
+topic and headers exchanges, exchange-to-exchange bindings, queues,
+basic_consume with prefetch limits, basic_get, ack/nack/reject, recover,
+publisher confirms and returned messages.
+
+Nothing is persisted, there is a single virtual host and any login is
+accepted. Transactions are not supported.
+"""
+
+import logging
+import math
+import uuid
+from collections import deque, OrderedDict
+from itertools import count
+
+import anyio
+from anyio.abc import SocketAttribute
+from anyio.streams.buffered import BufferedByteReceiveStream
+import pamqp.body
+import pamqp.frame
+import pamqp.header
+import pamqp.heartbeat
+import pamqp.specification as spec
+
+from . import constants as amqp_constants
+from . import exceptions
+from .frame import ContentFrames, FrameReader, marshal_content, send as send_frames
+
+logger = logging.getLogger(__name__)
+
+# Both protocol headers that clients send for 0-9-1
+PROTOCOL_HEADERS = (b'AMQP\x00\x00\x09\x01', amqp_constants.PROTOCOL_HEADER)
+
+# Reply codes
+REPLY_SUCCESS = 200
+NO_ROUTE = 312
+ACCESS_REFUSED = 403
+NOT_FOUND = 404
+RESOURCE_LOCKED = 405
+PRECONDITION_FAILED = 406
+FRAME_ERROR = 501
+COMMAND_INVALID = 503
+CHANNEL_ERROR = 504
+UNEXPECTED_FRAME = 505
+NOT_ALLOWED = 530
+NOT_IMPLEMENTED = 540
+
+EXCHANGE_TYPES = ('direct', 'fanout', 'topic', 'headers')
+
+SERVER_PROPERTIES = {
+    'product': 'async_amqp fake broker',
+    'version': '3.8.0',
+    'capabilities': {
+        'publisher_confirms': True,
+        'exchange_exchange_bindings': True,
+        'basic.nack': True,
+        'consumer_cancel_notify': True,
+        'per_consumer_qos': True,
+    },
+}
+
+
+class _ChannelError(Exception):
+    """Close the channel with this reply code and text"""
+
+    def __init__(self, code, text):
+        super().__init__(code, text)
+        self.code = code
+        self.text = text
+
+
+class _ConnectionError(_ChannelError):
+    """Close the connection with this reply code and text"""
+
+
+def topic_matches(pattern, routing_key):
+    """Does a topic exchange binding's @pattern match @routing_key?"""
+    return _match_words(pattern.split('.'), routing_key.split('.'))
+
+
+def _match_words(pattern, words):
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        return any(_match_words(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return pattern[0] in ('*', words[0]) and _match_words(pattern[1:], words[1:])
+
+
+def headers_match(arguments, headers):
+    """Does a headers exchange binding's @arguments match @headers?"""
+    headers = headers or {}
+    wanted = [(k, v) for k, v in arguments.items() if not k.startswith('x-')]
+    matches = (k in headers and (v is None or headers[k] == v) for k, v in wanted)
+    if arguments.get('x-match', 'all') == 'any':
+        return any(matches)
+    return all(matches)
+
+
+class Message:
+    """A message in a queue"""
+    __slots__ = ('exchange', 'routing_key', 'header', 'body', 'redelivered')
+
+    def __init__(self, exchange, routing_key, header, body):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.header = header
+        self.body = body
+        self.redelivered = False
+
+
+class Exchange:
+    def __init__(self, name, type_name, auto_delete=False, internal=False):
+        self.name = name
+        self.type = type_name
+        self.auto_delete = auto_delete
+        self.internal = internal
+        self.bindings = []  # (destination, routing_key, arguments)
+
+    def matches(self, binding_key, arguments, routing_key, properties):
+        if self.type == 'fanout':
+            return True
+        if self.type == 'topic':
+            return topic_matches(binding_key, routing_key)
+        if self.type == 'headers':
+            return headers_match(arguments, properties.headers)
+        return binding_key == routing_key
+
+
+class Queue:
+    def __init__(self, name, owner=None, auto_delete=False, arguments=None):
+        self.name = name
+        self.owner = owner  # the connection of an exclusive queue
+        self.auto_delete = auto_delete
+        self.arguments = arguments or {}
+        self.messages = deque()
+        self.consumers = deque()  # in round-robin order
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class Consumer:
+    def __init__(self, channel, tag, queue, no_ack, exclusive):
+        self.channel = channel
+        self.tag = tag
+        self.queue = queue
+        self.no_ack = no_ack
+        self.exclusive = exclusive
+        self.unacked = 0
+
+    def can_take(self):
+        channel = self.channel
+        if not channel.active or channel.closing:
+            return False
+        if self.no_ack or not channel.prefetch_count:
+            return True
+        if channel.prefetch_global:
+            return len(channel.unacked) < channel.prefetch_count
+        return self.unacked < channel.prefetch_count
+
+
+class ServerChannel:
+    """A channel, as seen by the broker"""
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.broker = connection.broker
+        self.id = channel_id
+        self.active = True  # Channel.Flow
+        self.closing = False  # sent Channel.Close, waiting for CloseOk
+        self.confirm = False
+        self.publish_seq = 0
+        self.delivery_tags = count(1)
+        self.unacked = OrderedDict()  # delivery_tag => (queue, message, consumer)
+        self.consumers = {}
+        self.prefetch_count = 0
+        self.prefetch_global = False
+        self.last_queue = None
+        self.content = None  # [method, header, body parts, size] of a publish
+
+    async def send_method(self, method):
+        await self.connection.send_method(self.id, method)
+
+    def queue_name(self, name):
+        """Empty queue names refer to the last queue declared on the channel"""
+        if name:
+            return name
+        if self.last_queue is None:
+            raise _ConnectionError(NOT_ALLOWED, "no previously declared queue")
+        return self.last_queue
+
+    async def deliver(self, consumer, queue, message):
+        delivery_tag = next(self.delivery_tags)
+        if not consumer.no_ack:
+            self.unacked[delivery_tag] = (queue, message, consumer)
+            consumer.unacked += 1
+        method = spec.Basic.Deliver(
+            consumer_tag=consumer.tag,
+            delivery_tag=delivery_tag,
+            redelivered=message.redelivered,
+            exchange=message.exchange,
+            routing_key=message.routing_key,
+        )
+        await self.connection.send_content(self.id, method, message.header, message.body)
+
+    def settle(self, delivery_tag, multiple):
+        """Remove acknowledged messages. Returns a list of (queue, message)."""
+        if multiple:
+            tags = [tag for tag in self.unacked if delivery_tag == 0 or tag <= delivery_tag]
+        elif delivery_tag in self.unacked:
+            tags = [delivery_tag]
+        else:
+            tags = []
+        if not tags and (delivery_tag or not multiple):
+            raise _ChannelError(PRECONDITION_FAILED, "unknown delivery tag %d" % delivery_tag)
+
+        settled = []
+        for tag in tags:
+            queue, message, consumer = self.unacked.pop(tag)
+            if consumer is not None:
+                consumer.unacked -= 1
+            settled.append((queue, message))
+        return settled
+
+    def requeue(self, settled):
+        queues = set()
+        for queue, message in reversed(settled):
+            if self.broker.queues.get(queue.name) is not queue:
+                continue  # deleted meanwhile
+            message.redelivered = True
+            queue.messages.appendleft(message)
+            queues.add(queue)
+        return queues
+
+    async def kick(self, queues=()):
+        """Try to deliver more messages, after consumers got more room"""
+        queues = set(queues)
+        queues.update(consumer.queue for consumer in self.consumers.values())
+        for queue in queues:
+            await self.broker.deliver(queue)
+
+    async def close(self):
+        """Release everything the channel holds"""
+        for consumer in list(self.consumers.values()):
+            await self.broker.cancel(consumer)
+        settled = list(self.unacked.values())
+        self.unacked.clear()
+        queues = self.requeue([(queue, message) for queue, message, _ in settled])
+        for queue in queues:
+            await self.broker.deliver(queue)
+
+    #
+    # Channel class
+    #
+
+    async def channel_flow(self, frame):
+        self.active = frame.active
+        await self.send_method(spec.Channel.FlowOk(active=frame.active))
+        if self.active:
+            await self.kick()
+
+    async def channel_flow_ok(self, frame):
+        pass
+
+    #
+    # Exchange class
+    #
+
+    async def exchange_declare(self, frame):
+        broker = self.broker
+        exchange = broker.exchanges.get(frame.exchange)
+        if frame.passive:
+            if exchange is None:
+                raise _ChannelError(NOT_FOUND, "no exchange '%s'" % frame.exchange)
+        else:
+            if frame.exchange == '' or frame.exchange.startswith('amq.'):
+                raise _ChannelError(ACCESS_REFUSED, "exchange name '%s' is reserved" % frame.exchange)
+            if frame.exchange_type not in EXCHANGE_TYPES:
+                raise _ConnectionError(COMMAND_INVALID, "invalid exchange type '%s'" % frame.exchange_type)
+            if exchange is None:
+                broker.exchanges[frame.exchange] = Exchange(
+                    frame.exchange, frame.exchange_type, frame.auto_delete, frame.internal
+                )
+            elif exchange.type != frame.exchange_type or exchange.auto_delete != frame.auto_delete:
+                raise _ChannelError(
+                    PRECONDITION_FAILED, "inequivalent arguments for exchange '%s'" % frame.exchange
+                )
+        if not frame.nowait:
+            await self.send_method(spec.Exchange.DeclareOk())
+
+    async def exchange_delete(self, frame):
+        broker = self.broker
+        exchange = broker.exchanges.get(frame.exchange)
+        if exchange is not None:
+            if frame.if_unused and exchange.bindings:
+                raise _ChannelError(PRECONDITION_FAILED, "exchange '%s' in use" % frame.exchange)
+            broker.delete_exchange(exchange)
+        if not frame.nowait:
+            await self.send_method(spec.Exchange.DeleteOk())
+
+    async def exchange_bind(self, frame):
+        source = self.broker.get_exchange(frame.source)
+        destination = self.broker.get_exchange(frame.destination)
+        binding = (destination, frame.routing_key, frame.arguments or {})
+        if binding not in source.bindings:
+            source.bindings.append(binding)
+        if not frame.nowait:
+            await self.send_method(spec.Exchange.BindOk())
+
+    async def exchange_unbind(self, frame):
+        source = self.broker.get_exchange(frame.source)
+        destination = self.broker.get_exchange(frame.destination)
+        self.broker.unbind(source, destination, frame.routing_key, frame.arguments or {})
+        if not frame.nowait:
+            await self.send_method(spec.Exchange.UnbindOk())
+
+    #
+    # Queue class
+    #
+
+    async def queue_declare(self, frame):
+        broker = self.broker
+        name = frame.queue or 'amq.gen-' + uuid.uuid4().hex
+        queue = broker.queues.get(name)
+        if frame.passive:
+            if queue is None:
+                raise _ChannelError(NOT_FOUND, "no queue '%s'" % name)
+        elif queue is None:
+            if name.startswith('amq.') and frame.queue:
+                raise _ChannelError(ACCESS_REFUSED, "queue name '%s' is reserved" % name)
+            queue = Queue(
+                name,
+                owner=self.connection if frame.exclusive else None,
+                auto_delete=frame.auto_delete,
+                arguments=frame.arguments,
+            )
+            broker.queues[name] = queue
+        broker.check_owner(queue, self.connection)
+
+        self.last_queue = name
+        if not frame.nowait:
+            await self.send_method(spec.Queue.DeclareOk(
+                queue=name, message_count=len(queue), consumer_count=len(queue.consumers)
+            ))
+
+    async def queue_bind(self, frame):
+        queue = self.broker.get_queue(self.queue_name(frame.queue), self.connection)
+        exchange = self.broker.get_exchange(frame.exchange)
+        routing_key = frame.routing_key
+        if not routing_key and not frame.queue:
+            routing_key = queue.name
+        binding = (queue, routing_key, frame.arguments or {})
+        if binding not in exchange.bindings:
+            exchange.bindings.append(binding)
+        if not frame.nowait:
+            await self.send_method(spec.Queue.BindOk())
+
+    async def queue_unbind(self, frame):
+        queue = self.broker.get_queue(self.queue_name(frame.queue), self.connection)
+        exchange = self.broker.get_exchange(frame.exchange)
+        self.broker.unbind(exchange, queue, frame.routing_key, frame.arguments or {})
+        await self.send_method(spec.Queue.UnbindOk())
+
+    async def queue_purge(self, frame):
+        queue = self.broker.get_queue(self.queue_name(frame.queue), self.connection)
+        message_count = len(queue)
+        queue.messages.clear()
+        if not frame.nowait:
+            await self.send_method(spec.Queue.PurgeOk(message_count=message_count))
+
+    async def queue_delete(self, frame):
+        broker = self.broker
+        queue = broker.queues.get(self.queue_name(frame.queue))
+        message_count = 0
+        if queue is not None:
+            broker.check_owner(queue, self.connection)
+            if frame.if_unused and queue.consumers:
+                raise _ChannelError(PRECONDITION_FAILED, "queue '%s' in use" % queue.name)
+            if frame.if_empty and queue.messages:
+                raise _ChannelError(PRECONDITION_FAILED, "queue '%s' not empty" % queue.name)
+            message_count = len(queue)
+            await broker.delete_queue(queue)
+        if not frame.nowait:
+            await self.send_method(spec.Queue.DeleteOk(message_count=message_count))
+
+    #
+    # Basic class
+    #
+
+    async def basic_qos(self, frame):
+        if frame.prefetch_size:
+            raise _ChannelError(NOT_IMPLEMENTED, "prefetch_size is not supported")
+        self.prefetch_count = frame.prefetch_count
+        self.prefetch_global = frame.global_
+        await self.send_method(spec.Basic.QosOk())
+        await self.kick()
+
+    async def basic_consume(self, frame):
+        broker = self.broker
+        queue = broker.get_queue(self.queue_name(frame.queue), self.connection)
+        tag = frame.consumer_tag or 'amq.ctag-' + uuid.uuid4().hex
+        if tag in self.consumers:
+            raise _ConnectionError(NOT_ALLOWED, "attempt to reuse consumer tag '%s'" % tag)
+        if any(consumer.exclusive for consumer in queue.consumers) or \
+                (frame.exclusive and queue.consumers):
+            raise _ChannelError(ACCESS_REFUSED, "queue '%s' in exclusive use" % queue.name)
+
+        consumer = Consumer(self, tag, queue, frame.no_ack, frame.exclusive)
+        self.consumers[tag] = consumer
+        queue.consumers.append(consumer)
+        if not frame.nowait:
+            await self.send_method(spec.Basic.ConsumeOk(consumer_tag=tag))
+        await broker.deliver(queue)
+
+    async def basic_cancel(self, frame):
+        consumer = self.consumers.get(frame.consumer_tag)
+        if consumer is not None:
+            await self.broker.cancel(consumer)
+        if not frame.nowait:
+            await self.send_method(spec.Basic.CancelOk(consumer_tag=frame.consumer_tag))
+
+    async def basic_publish(self, frame):
+        if frame.immediate:
+            raise _ConnectionError(NOT_IMPLEMENTED, "immediate=true")
+        self.content = [frame, None, [], 0]
+
+    async def basic_get(self, frame):
+        queue = self.broker.get_queue(self.queue_name(frame.queue), self.connection)
+        if not queue.messages:
+            await self.send_method(spec.Basic.GetEmpty())
+            return
+        message = queue.messages.popleft()
+        delivery_tag = next(self.delivery_tags)
+        if not frame.no_ack:
+            self.unacked[delivery_tag] = (queue, message, None)
+        method = spec.Basic.GetOk(
+            delivery_tag=delivery_tag,
+            redelivered=message.redelivered,
+            exchange=message.exchange,
+            routing_key=message.routing_key,
+            message_count=len(queue),
+        )
+        await self.connection.send_content(self.id, method, message.header, message.body)
+
+    async def basic_ack(self, frame):
+        settled = self.settle(frame.delivery_tag, frame.multiple)
+        await self.kick(queue for queue, _ in settled)
+
+    async def basic_nack(self, frame):
+        settled = self.settle(frame.delivery_tag, frame.multiple)
+        queues = self.requeue(settled) if frame.requeue else ()
+        await self.kick(queues)
+
+    async def basic_reject(self, frame):
+        settled = self.settle(frame.delivery_tag, False)
+        queues = self.requeue(settled) if frame.requeue else ()
+        await self.kick(queues)
+
+    async def basic_recover(self, frame):
+        await self.basic_recover_async(frame)
+        await self.send_method(spec.Basic.RecoverOk())
+
+    async def basic_recover_async(self, frame):
+        if not frame.requeue:
+            raise _ConnectionError(NOT_IMPLEMENTED, "requeue=false")
+        settled = [(queue, message) for queue, message, _ in self.unacked.values()]
+        for queue, message, consumer in self.unacked.values():
+            if consumer is not None:
+                consumer.unacked -= 1
+        self.unacked.clear()
+        await self.kick(self.requeue(settled))
+
+    #
+    # Confirm class
+    #
+
+    async def confirm_select(self, frame):
+        self.confirm = True
+        if not frame.nowait:
+            await self.send_method(spec.Confirm.SelectOk())
+
+    #
+    # Content
+    #
+
+    async def content_header(self, frame):
+        if self.content is None or self.content[1] is not None:
+            raise _ConnectionError(FRAME_ERROR, "unexpected content header")
+        self.content[1] = frame
+        if frame.body_size == 0:
+            await self.publish()
+
+    async def content_body(self, frame):
+        content = self.content
+        if content is None or content[1] is None:
+            raise _ConnectionError(FRAME_ERROR, "unexpected content body")
+        content[2].append(frame.value)
+        content[3] += len(frame.value)
+        if content[3] >= content[1].body_size:
+            await self.publish()
+
+    async def publish(self):
+        method, header, parts, _size = self.content
+        self.content = None
+        if len(parts) == 1:
+            body = bytes(parts[0])
+        else:
+            body = b''.join(parts)
+        if self.confirm:
+            self.publish_seq += 1
+        await self.broker.publish(self, method, header, body)
+        if self.confirm:
+            await self.send_method(spec.Basic.Ack(delivery_tag=self.publish_seq))
+
+
+# Handlers for the methods a client sends on a channel, by frame index
+CHANNEL_METHODS = {
+    spec.Channel.Flow.index: 'channel_flow',
+    spec.Channel.FlowOk.index: 'channel_flow_ok',
+
+    spec.Exchange.Declare.index: 'exchange_declare',
+    spec.Exchange.Delete.index: 'exchange_delete',
+    spec.Exchange.Bind.index: 'exchange_bind',
+    spec.Exchange.Unbind.index: 'exchange_unbind',
+
+    spec.Queue.Declare.index: 'queue_declare',
+    spec.Queue.Bind.index: 'queue_bind',
+    spec.Queue.Unbind.index: 'queue_unbind',
+    spec.Queue.Purge.index: 'queue_purge',
+    spec.Queue.Delete.index: 'queue_delete',
+
+    spec.Basic.Qos.index: 'basic_qos',
+    spec.Basic.Consume.index: 'basic_consume',
+    spec.Basic.Cancel.index: 'basic_cancel',
+    spec.Basic.Publish.index: 'basic_publish',
+    spec.Basic.Get.index: 'basic_get',
+    spec.Basic.Ack.index: 'basic_ack',
+    spec.Basic.Nack.index: 'basic_nack',
+    spec.Basic.Reject.index: 'basic_reject',
+    spec.Basic.Recover.index: 'basic_recover',
+    spec.Basic.RecoverAsync.index: 'basic_recover_async',
+
+    spec.Confirm.Select.index: 'confirm_select',
+}
+
+
+class ServerConnection:
+    """A client connection, as seen by the broker"""
+
+    def __init__(self, broker, stream):
+        self.broker = broker
+        self.stream = stream
+        self.channels = {}
+        self.frame_max = broker.frame_max
+        self.heartbeat = 0
+        self.closing = False  # sent Connection.Close, waiting for CloseOk
+        self.done = False
+        self._task_group = None
+        self._heartbeat_scope = None
+        self._out_w, self._out_r = anyio.create_memory_object_stream(math.inf)
+
+    async def send(self, data):
+        try:
+            await self._out_w.send_nowait(data)
+        except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+            pass
+
+    async def send_method(self, channel_id, method):
+        await self.send(pamqp.frame.marshal(method, channel_id))
+
+    async def send_content(self, channel_id, method, header, body):
+        await self.send(marshal_content(channel_id, method, header.properties, body, self.frame_max))
+
+    async def run(self):
+        async with anyio.create_task_group() as tg:
+            self._task_group = tg
+            await tg.spawn(self._writer)
+            try:
+                await self._reader()
+            except (exceptions.AmqpClosedConnection, anyio.ClosedResourceError):
+                pass
+            except Exception:
+                logger.exception("Fake broker connection failed")
+            finally:
+                await self._close()
+                # the writer sends what's queued, then closes the stream
+                await self._out_w.aclose()
+                if self._heartbeat_scope is not None:
+                    await self._heartbeat_scope.cancel()
+
+    async def abort(self):
+        """Close the socket without a closing handshake"""
+        await self.stream.aclose()
+
+    async def _writer(self):
+        try:
+            async with self._out_r:
+                async for data in self._out_r:
+                    chunks = [data]
+                    while True:
+                        try:
+                            chunks.append(await self._out_r.receive_nowait())
+                        except (anyio.WouldBlock, anyio.EndOfStream):
+                            break
+                    await send_frames(self.stream, data if len(chunks) == 1 else ContentFrames.join(chunks))
+        except (anyio.BrokenResourceError, anyio.ClosedResourceError):
+            pass
+        finally:
+            await self.stream.aclose()
+
+    async def _heartbeat(self):
+        async with anyio.open_cancel_scope() as scope:
+            self._heartbeat_scope = scope
+            while True:
+                await anyio.sleep(self.heartbeat / 2)
+                await self.send(pamqp.frame.marshal(pamqp.heartbeat.Heartbeat(), 0))
+
+    async def _reader(self):
+        stream = BufferedByteReceiveStream(self.stream)
+        try:
+            header = await stream.receive_exactly(8)
+        except (anyio.EndOfStream, anyio.IncompleteRead, anyio.BrokenResourceError):
+            return
+        if header not in PROTOCOL_HEADERS:
+            await self.send(PROTOCOL_HEADERS[0])
+            return
+
+        await self.send_method(0, spec.Connection.Start(
+            version_major=0,
+            version_minor=9,
+            server_properties=SERVER_PROPERTIES,
+            mechanisms='AMQPLAIN PLAIN',
+            locales='en_US',
+        ))
+        reader = FrameReader(stream)
+        while not self.done:
+            channel_id, frame = await reader.read_frame()
+            try:
+                await self._dispatch(channel_id, frame)
+            except _ConnectionError as exc:
+                await self._connection_error(exc, frame)
+            except _ChannelError as exc:
+                await self._channel_error(channel_id, exc, frame)
+
+    async def _dispatch(self, channel_id, frame):
+        frame_type = type(frame)
+        if frame_type is pamqp.heartbeat.Heartbeat:
+            return
+
+        if channel_id == 0:
+            await self._connection_method(frame)
+            return
+        if self.closing:
+            return
+
+        channel = self.channels.get(channel_id)
+        if frame_type is pamqp.body.ContentBody:
+            if channel is None:
+                raise _ConnectionError(CHANNEL_ERROR, "channel %d is not open" % channel_id)
+            if not channel.closing:
+                await channel.content_body(frame)
+            return
+        if frame_type is pamqp.header.ContentHeader:
+            if channel is None:
+                raise _ConnectionError(CHANNEL_ERROR, "channel %d is not open" % channel_id)
+            if not channel.closing:
+                await channel.content_header(frame)
+            return
+
+        index = frame.index
+        if index == spec.Channel.Open.index:
+            if channel is not None:
+                raise _ConnectionError(CHANNEL_ERROR, "channel %d is already open" % channel_id)
+            self.channels[channel_id] = ServerChannel(self, channel_id)
+            await self.send_method(channel_id, spec.Channel.OpenOk())
+            return
+        if channel is None:
+            raise _ConnectionError(CHANNEL_ERROR, "channel %d is not open" % channel_id)
+        if index == spec.Channel.Close.index:
+            await self._drop_channel(channel)
+            await self.send_method(channel_id, spec.Channel.CloseOk())
+            return
+        if index == spec.Channel.CloseOk.index:
+            if channel.closing:
+                del self.channels[channel_id]
+            return
+        if channel.closing:
+            return
+
+        name = CHANNEL_METHODS.get(index)
+        if name is None:
+            raise _ConnectionError(NOT_IMPLEMENTED, "%s is not supported" % frame.name)
+        if channel.content is not None:
+            raise _ConnectionError(UNEXPECTED_FRAME, "expected content, got %s" % frame.name)
+        await getattr(channel, name)(frame)
+
+    async def _connection_method(self, frame):
+        index = getattr(frame, 'index', None)
+        if index == spec.Connection.CloseOk.index:
+            self.done = True
+        elif index == spec.Connection.Close.index:
+            await self.send_method(0, spec.Connection.CloseOk())
+            self.done = True
+        elif self.closing:
+            pass
+        elif index == spec.Connection.StartOk.index:
+            broker = self.broker
+            await self.send_method(0, spec.Connection.Tune(
+                channel_max=broker.channel_max, frame_max=broker.frame_max, heartbeat=broker.heartbeat
+            ))
+        elif index == spec.Connection.TuneOk.index:
+            self.frame_max = frame.frame_max
+            self.heartbeat = frame.heartbeat
+        elif index == spec.Connection.Open.index:
+            await self.send_method(0, spec.Connection.OpenOk())
+            if self.heartbeat:
+                await self._task_group.spawn(self._heartbeat)
+        else:
+            raise _ConnectionError(COMMAND_INVALID, "unexpected %s" % frame.name)
+
+    def _method_ids(self, frame):
+        index = getattr(frame, 'index', 0)
+        return index >> 16, index & 0xffff
+
+    async def _channel_error(self, channel_id, exc, frame):
+        logger.debug("Fake broker closes channel %d: %s %s", channel_id, exc.code, exc.text)
+        channel = self.channels.get(channel_id)
+        if channel is None or channel.closing:
+            return
+        channel.content = None
+        await self._drop_channel(channel, keep=True)
+        class_id, method_id = self._method_ids(frame)
+        await self.send_method(channel_id, spec.Channel.Close(
+            reply_code=exc.code, reply_text=exc.text, class_id=class_id, method_id=method_id
+        ))
+
+    async def _connection_error(self, exc, frame):
+        logger.debug("Fake broker closes the connection: %s %s", exc.code, exc.text)
+        await self._close()
+        class_id, method_id = self._method_ids(frame)
+        await self.send_method(0, spec.Connection.Close(
+            reply_code=exc.code, reply_text=exc.text, class_id=class_id, method_id=method_id
+        ))
+
+    async def _drop_channel(self, channel, keep=False):
+        await channel.close()
+        if keep:
+            channel.closing = True
+        else:
+            self.channels.pop(channel.id, None)
+
+    async def _close(self):
+        """Release all channels and exclusive queues"""
+        if self.closing:
+            return
+        self.closing = True
+        for channel in list(self.channels.values()):
+            await channel.close()
+        self.channels.clear()
+        broker = self.broker
+        for queue in list(broker.queues.values()):
+            if queue.owner is self:
+                await broker.delete_queue(queue)
+        broker.connections.discard(self)
+
+
+class FakeBroker:
+    """An AMQP 0-9-1 broker that runs in-process, for tests and benchmarks.
+
+    Args:
+        host:
+            the address to listen on
+        port:
+            the port to listen on; by default, a free one is chosen.
+            The :attr:`port` attribute has the actual port.
+        frame_max:
+            the largest frame size to propose to clients
+        channel_max:
+            the highest channel number to propose to clients
+        heartbeat:
+            the heartbeat interval to propose to clients, in seconds
+
+    The broker's state is accessible for tests: :attr:`exchanges` and
+    :attr:`queues` map names to :class:`Exchange` and :class:`Queue`
+    objects, and a queue's ``messages`` is a deque of :class:`Message`.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, frame_max=131072, channel_max=2047, heartbeat=0):
+        self.host = host
+        self.port = port
+        self.frame_max = frame_max
+        self.channel_max = channel_max
+        self.heartbeat = heartbeat
+        self.connections = set()
+        self.queues = {}
+        self.exchanges = {}
+        for name, type_name in (
+            ('', 'direct'),
+            ('amq.direct', 'direct'),
+            ('amq.fanout', 'fanout'),
+            ('amq.topic', 'topic'),
+            ('amq.headers', 'headers'),
+            ('amq.match', 'headers'),
+        ):
+            self.exchanges[name] = Exchange(name, type_name)
+        self._task_group = None
+        self._listener = None
+
+    async def __aenter__(self):
+        self._listener = await anyio.create_tcp_listener(local_host=self.host, local_port=self.port)
+        self.port = self._listener.listeners[0].extra(SocketAttribute.local_port)
+        self._task_group = anyio.create_task_group()
+        await self._task_group.__aenter__()
+        await self._task_group.spawn(self._accept)
+        return self
+
+    async def __aexit__(self, *tb):
+        await self._task_group.cancel_scope.cancel()
+        try:
+            return await self._task_group.__aexit__(*tb)
+        finally:
+            if self._listener is not None:
+                await self._listener.aclose()
+                self._listener = None
+            self._task_group = None
+
+    async def _accept(self):
+        try:
+            await self._listener.serve(self._serve, self._task_group)
+        except anyio.ClosedResourceError:
+            pass  # stopped
+
+    async def stop(self):
+        """Stop accepting connections and drop the existing ones, like a
+        broker that went down"""
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            await listener.aclose()
+        await self.drop_connections()
+
+    async def drop_connections(self):
+        """Close all client connections abruptly, like a network failure"""
+        for connection in list(self.connections):
+            await connection.abort()
+
+    async def _serve(self, stream):
+        connection = ServerConnection(self, stream)
+        self.connections.add(connection)
+        await connection.run()
+
+    #
+    # Routing and delivery
+    #
+
+    def get_exchange(self, name):
+        try:
+            return self.exchanges[name]
+        except KeyError:
+            raise _ChannelError(NOT_FOUND, "no exchange '%s'" % name) from None
+
+    def get_queue(self, name, connection):
+        try:
+            queue = self.queues[name]
+        except KeyError:
+            raise _ChannelError(NOT_FOUND, "no queue '%s'" % name) from None
+        self.check_owner(queue, connection)
+        return queue
+
+    def check_owner(self, queue, connection):
+        if queue.owner is not None and queue.owner is not connection:
+            raise _ChannelError(RESOURCE_LOCKED, "queue '%s' is exclusive" % queue.name)
+
+    def route(self, exchange, routing_key, properties):
+        """Return the queues that a message should be sent to"""
+        if exchange.name == '':
+            queue = self.queues.get(routing_key)
+            return [queue] if queue is not None else []
+
+        queues = []
+        seen = {exchange}
+        todo = [exchange]
+        while todo:
+            source = todo.pop()
+            for destination, binding_key, arguments in source.bindings:
+                if not source.matches(binding_key, arguments, routing_key, properties):
+                    continue
+                if isinstance(destination, Queue):
+                    if destination not in queues:
+                        queues.append(destination)
+                elif destination not in seen:
+                    seen.add(destination)
+                    todo.append(destination)
+        return queues
+
+    async def publish(self, channel, method, header, body):
+        exchange = self.get_exchange(method.exchange)
+        queues = self.route(exchange, method.routing_key, header.properties)
+        if not queues:
+            if method.mandatory:
+                await channel.connection.send_content(
+                    channel.id,
+                    spec.Basic.Return(
+                        reply_code=NO_ROUTE,
+                        reply_text='NO_ROUTE',
+                        exchange=method.exchange,
+                        routing_key=method.routing_key,
+                    ),
+                    header,
+                    body,
+                )
+            return
+        for queue in queues:
+            queue.messages.append(Message(method.exchange, method.routing_key, header, body))
+            await self.deliver(queue)
+
+    async def deliver(self, queue):
+        """Hand queued messages to consumers that have room for them"""
+        consumers = queue.consumers
+        while queue.messages and consumers:
+            for _ in range(len(consumers)):
+                consumer = consumers[0]
+                consumers.rotate(-1)
+                if consumer.can_take():
+                    break
+            else:
+                return
+            await consumer.channel.deliver(consumer, queue, queue.messages.popleft())
+
+    async def cancel(self, consumer, notify=False):
+        """Remove a consumer"""
+        channel = consumer.channel
+        channel.consumers.pop(consumer.tag, None)
+        queue = consumer.queue
+        try:
+            queue.consumers.remove(consumer)
+        except ValueError:
+            pass
+        if notify:
+            await channel.send_method(spec.Basic.Cancel(consumer_tag=consumer.tag, nowait=True))
+        if queue.auto_delete and not queue.consumers and self.queues.get(queue.name) is queue:
+            await self.delete_queue(queue)
+
+    def unbind(self, source, destination, routing_key, arguments):
+        binding = (destination, routing_key, arguments)
+        try:
+            source.bindings.remove(binding)
+        except ValueError:
+            pass
+        self._auto_delete_exchange(source)
+
+    async def delete_queue(self, queue):
+        del self.queues[queue.name]
+        queue.auto_delete = False
+        for consumer in list(queue.consumers):
+            await self.cancel(consumer, notify=True)
+        for exchange in list(self.exchanges.values()):
+            before = len(exchange.bindings)
+            exchange.bindings = [b for b in exchange.bindings if b[0] is not queue]
+            if len(exchange.bindings) != before:
+                self._auto_delete_exchange(exchange)
+
+    def delete_exchange(self, exchange):
+        self.exchanges.pop(exchange.name, None)
+        for other in list(self.exchanges.values()):
+            before = len(other.bindings)
+            other.bindings = [b for b in other.bindings if b[0] is not exchange]
+            if len(other.bindings) != before:
+                self._auto_delete_exchange(other)
+
+    def _auto_delete_exchange(self, exchange):
+        if exchange.auto_delete and not exchange.bindings and self.exchanges.get(exchange.name) is exchange:
+            self.delete_exchange(exchange)
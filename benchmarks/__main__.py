@@ -0,0 +1,107 @@
+"""
+    Run the async_amqp benchmarks
+
+Usage::
+
+    python -m benchmarks [SCENARIO ...] [--url URL] [--count N] [--size BYTES] [--json FILE]
+
+Without ``--url``, the benchmarks run against the in-process fake broker
+from :mod:`async_amqp.testing`, which shares the CPU with the client but
+gives repeatable numbers on a single machine. ``--json`` writes the results,
+plus some information about the environment, for tracking regressions;
+``--json -`` prints them instead of the table.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from functools import partial
+from urllib.parse import urlparse
+
+import anyio
+import async_amqp
+from async_amqp.testing import FakeBroker
+
+from .scenarios import SCENARIOS
+
+
+def package_version():
+    try:
+        from importlib.metadata import version
+        return version('async_amqp')
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+def print_table(results):
+    print("%-18s %9s %10s %9s %11s %9s %9s" % (
+        "scenario", "messages", "size", "seconds", "msg/s", "p50 ms", "p99 ms"))
+    for result in results:
+        print("%-18s %9d %10d %9.3f %11.0f %9.3f %9.3f" % (
+            result['name'], result['messages'], result['size'], result['seconds'],
+            result['msg_per_sec'], result['latency_p50_ms'], result['latency_p99_ms'],
+        ))
+
+
+async def run_all(args, connect):
+    results = []
+    for name in args.scenarios:
+        scenario, count, size = SCENARIOS[name]
+        if args.count is not None:
+            count = args.count
+        if args.size is not None and not name.startswith(('large_', 'receive_')):
+            size = args.size
+        result = await scenario(connect, count, size)
+        results.append(result.as_dict())
+        if args.json != '-':
+            print("%s done" % name, file=sys.stderr)
+    return results
+
+
+async def run(args):
+    if args.url:
+        return await run_all(args, partial(async_amqp.connect_from_url, args.url))
+    async with FakeBroker() as broker:
+        return await run_all(args, partial(async_amqp.connect_amqp, port=broker.port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help="scenarios to run: %s (default: all)" % ', '.join(SCENARIOS))
+    parser.add_argument('--url', help="amqp:// URL of the broker to use, instead of the fake one")
+    parser.add_argument('--count', type=int, help="number of messages, instead of each scenario's default")
+    parser.add_argument('--size', type=int, help="message size in bytes (not for large_* and receive_* scenarios)")
+    parser.add_argument('--json', metavar='FILE', help="write the results as JSON to FILE, or '-' for stdout")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: %s" % ', '.join(sorted(unknown)))
+    if not args.scenarios:
+        args.scenarios = list(SCENARIOS)
+
+    results = anyio.run(run, args)
+
+    report = {
+        'timestamp': time.time(),
+        'async_amqp': package_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'broker': args.url and urlparse(args.url).hostname or 'fake',
+        'results': results,
+    }
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+"""
+    Benchmark scenarios
+
+Each scenario is a coroutine function that takes a ``connect`` callable
+(which returns an async context manager yielding a connection), the number
+of messages and their size, and returns a :class:`Result`.
+"""
+
+import struct
+import time
+import uuid
+
+import anyio
+import pamqp.body
+import pamqp.header
+import pamqp.specification
+
+from async_amqp import channel as amqp_channel
+from async_amqp import protocol as amqp_protocol
+from async_amqp.properties import Properties
+
+# Consumers measure latency from a timestamp at the start of the body
+TIMESTAMP = struct.Struct('>d')
+
+
+def percentile(values, pct):
+    """The @pct percentile of @values, by nearest rank"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+class Result:
+    """Measurements of one scenario"""
+
+    def __init__(self, name, count, size, elapsed, latencies, frames=None):
+        self.name = name
+        self.count = count
+        self.size = size
+        self.elapsed = elapsed
+        self.latencies = latencies
+        self.frames = frames  # only counted by the dispatch scenarios
+
+    def as_dict(self):
+        p50 = percentile(self.latencies, 50)
+        p99 = percentile(self.latencies, 99)
+        return {
+            'name': self.name,
+            'messages': self.count,
+            'size': self.size,
+            'seconds': self.elapsed,
+            'msg_per_sec': self.count / self.elapsed,
+            'mb_per_sec': self.count * self.size / self.elapsed / 1e6,
+            'frames': self.frames,
+            'frames_per_sec': None if self.frames is None else self.frames / self.elapsed,
+            'latency_p50_ms': None if p50 is None else p50 * 1000,
+            'latency_p99_ms': None if p99 is None else p99 * 1000,
+        }
+
+
+def stamped(size):
+    """A message body that starts with the current time"""
+    return TIMESTAMP.pack(time.perf_counter()) + bytes(max(size - TIMESTAMP.size, 0))
+
+
+def age(body):
+    return time.perf_counter() - TIMESTAMP.unpack_from(body)[0]
+
+
+async def declare_queue(channel):
+    result = await channel.queue_declare('', exclusive=True)
+    return result['queue']
+
+
+async def _publish(connect, name, count, size, confirm, template=False):
+    async with connect() as conn:
+        async with conn.new_channel() as channel:
+            if confirm:
+                await channel.confirm_select()
+            queue_name = await declare_queue(channel)
+            payload = bytes(size)
+            latencies = []
+            publisher = channel.publisher('', queue_name) if template else None
+
+            start = time.perf_counter()
+            for _ in range(count):
+                sent = time.perf_counter()
+                if publisher is not None:
+                    await publisher.publish(payload)
+                else:
+                    await channel.publish(payload, '', routing_key=queue_name)
+                latencies.append(time.perf_counter() - sent)
+            # a synchronous round trip: everything before it has been sent
+            await channel.queue_declare(queue_name, passive=True)
+            return Result(name, count, size, time.perf_counter() - start, latencies)
+
+
+async def publish(connect, count, size):
+    """Channel.publish, without confirms; latency is the time per call"""
+    return await _publish(connect, 'publish', count, size, confirm=False)
+
+
+async def publisher(connect, count, size):
+    """Channel.publisher, without confirms; latency is the time per call"""
+    return await _publish(connect, 'publisher', count, size, confirm=False, template=True)
+
+
+async def publish_many(connect, count, size):
+    """Channel.publish_many in batches of 500; latency is the time per call"""
+    async with connect() as conn:
+        async with conn.new_channel() as channel:
+            queue_name = await declare_queue(channel)
+            message = (bytes(size), '', queue_name)
+            latencies = []
+
+            start = time.perf_counter()
+            for offset in range(0, count, 500):
+                sent = time.perf_counter()
+                await channel.publish_many([message] * min(500, count - offset))
+                latencies.append(time.perf_counter() - sent)
+            # a synchronous round trip: everything before it has been sent
+            await channel.queue_declare(queue_name, passive=True)
+            return Result('publish_many', count, size, time.perf_counter() - start, latencies)
+
+
+async def confirmed_publish(connect, count, size):
+    """Channel.publish with confirms, waiting for each one"""
+    return await _publish(connect, 'confirmed_publish', count, size, confirm=True)
+
+
+async def basic_consume(connect, count, size):
+    """Publish and receive through a basic_consume callback"""
+    async with connect() as conn:
+        async with conn.new_channel() as channel:
+            queue_name = await declare_queue(channel)
+            latencies = []
+            done = anyio.create_event()
+
+            async def callback(channel, body, envelope, properties):
+                latencies.append(age(body))
+                if len(latencies) == count:
+                    await done.set()
+
+            await channel.basic_consume(callback, queue_name=queue_name, no_ack=True)
+            start = time.perf_counter()
+            for _ in range(count):
+                await channel.publish(stamped(size), '', routing_key=queue_name)
+            await done.wait()
+            return Result('basic_consume', count, size, time.perf_counter() - start, latencies)
+
+
+async def new_consumer(connect, count, size):
+    """Publish and receive by iterating over a new_consumer listener"""
+    async with connect() as conn:
+        async with conn.new_channel() as channel:
+            queue_name = await declare_queue(channel)
+            latencies = []
+
+            async with channel.new_consumer(queue_name=queue_name, no_ack=True) as listener:
+                async with anyio.create_task_group() as tg:
+                    async def publisher():
+                        for _ in range(count):
+                            await channel.publish(stamped(size), '', routing_key=queue_name)
+
+                    start = time.perf_counter()
+                    await tg.spawn(publisher)
+                    async for body, _envelope, _properties in listener:
+                        latencies.append(age(body))
+                        if len(latencies) == count:
+                            break
+                elapsed = time.perf_counter() - start
+            return Result('new_consumer', count, size, elapsed, latencies)
+
+
+async def basic_get(connect, count, size):
+    """Poll a filled queue with basic_get; latency is the round trip"""
+    async with connect() as conn:
+        async with conn.new_channel() as channel:
+            queue_name = await declare_queue(channel)
+            payload = bytes(size)
+            for offset in range(0, count, 1000):
+                await channel.publish_many(
+                    [(payload, '', queue_name)] * min(1000, count - offset)
+                )
+            latencies = []
+
+            start = time.perf_counter()
+            for _ in range(count):
+                sent = time.perf_counter()
+                await channel.basic_get(queue_name, no_ack=True)
+                latencies.append(time.perf_counter() - sent)
+            return Result('basic_get', count, size, time.perf_counter() - start, latencies)
+
+
+async def rpc(connect, count, size):
+    """Request/reply with reply_to and correlation_id, one call at a time"""
+    async with connect() as server_conn, connect() as client_conn:
+        async with server_conn.new_channel() as server, client_conn.new_channel() as client:
+            request_queue = await declare_queue(server)
+
+            async def on_request(channel, body, envelope, properties):
+                await channel.publish(
+                    body, '', routing_key=properties.reply_to,
+                    properties={'correlation_id': properties.correlation_id},
+                )
+
+            await server.basic_consume(on_request, queue_name=request_queue, no_ack=True)
+            reply_queue = await declare_queue(client)
+            payload = bytes(size)
+            latencies = []
+
+            async with client.new_consumer(queue_name=reply_queue, no_ack=True) as replies:
+                start = time.perf_counter()
+                for _ in range(count):
+                    correlation_id = uuid.uuid4().hex
+                    sent = time.perf_counter()
+                    await client.publish(
+                        payload, '', routing_key=request_queue,
+                        properties={'reply_to': reply_queue, 'correlation_id': correlation_id},
+                    )
+                    _body, _envelope, properties = await replies.get()
+                    assert properties.correlation_id == correlation_id
+                    latencies.append(time.perf_counter() - sent)
+                elapsed = time.perf_counter() - start
+            return Result('rpc', count, size, elapsed, latencies)
+
+
+async def _large(connect, name, count, size):
+    async with connect() as conn:
+        async with conn.new_channel() as channel:
+            queue_name = await declare_queue(channel)
+            payload = bytes(size)
+            latencies = []
+
+            async with channel.new_consumer(queue_name=queue_name, no_ack=True) as listener:
+                start = time.perf_counter()
+                for _ in range(count):
+                    sent = time.perf_counter()
+                    await channel.publish(payload, '', routing_key=queue_name)
+                    body, _envelope, _properties = await listener.get()
+                    assert len(body) == size
+                    latencies.append(time.perf_counter() - sent)
+                elapsed = time.perf_counter() - start
+            return Result(name, count, size, elapsed, latencies)
+
+
+async def large_1mb(connect, count, size):
+    """Send 1 MB messages through the broker and back, one at a time"""
+    return await _large(connect, 'large_1mb', count, size)
+
+
+async def large_100mb(connect, count, size):
+    """Send 100 MB messages through the broker and back, one at a time"""
+    return await _large(connect, 'large_100mb', count, size)
+
+
+async def _receive(connect, name, count, size):
+    async with connect() as conn:
+        async with conn.new_channel() as channel:
+            queue_name = await declare_queue(channel)
+            payload = bytes(size)
+            batch = max(1, 1000000 // size)
+            for offset in range(0, count, batch):
+                await channel.publish_many(
+                    [(payload, '', queue_name)] * min(batch, count - offset)
+                )
+            latencies = []
+
+            async with channel.new_consumer(queue_name=queue_name, no_ack=True) as listener:
+                start = time.perf_counter()
+                for _ in range(count):
+                    waited = time.perf_counter()
+                    body, _envelope, _properties = await listener.get()
+                    assert len(body) == size
+                    latencies.append(time.perf_counter() - waited)
+                elapsed = time.perf_counter() - start
+            return Result(name, count, size, elapsed, latencies)
+
+
+async def receive_4kb(connect, count, size):
+    """Drain a filled queue of 4 KB messages; latency is the wait per message"""
+    return await _receive(connect, 'receive_4kb', count, size)
+
+
+async def receive_128kb(connect, count, size):
+    """Drain a filled queue of 128 KB messages, about one frame each"""
+    return await _receive(connect, 'receive_128kb', count, size)
+
+
+async def receive_4mb(connect, count, size):
+    """Drain a filled queue of 4 MB messages, many frames each"""
+    return await _receive(connect, 'receive_4mb', count, size)
+
+
+class NullQueue:
+    """A consumer queue that discards messages"""
+
+    async def send(self, message):
+        pass
+
+
+class RebuildingChannel(amqp_channel.Channel):
+    """A channel that builds its dispatch tables for every frame, like the
+    dispatcher used to"""
+
+    async def dispatch_frame(self, frame):
+        self._method_handlers = {
+            index: getattr(self, name) for index, name in amqp_channel.METHOD_HANDLERS.items()
+        }
+        await super().dispatch_frame(frame)
+
+    async def dispatch_content(self, content):
+        self._content_handlers = {
+            index: getattr(self, name) for index, name in amqp_channel.CONTENT_HANDLERS.items()
+        }
+        await super().dispatch_content(content)
+
+
+class RebuildingProtocol(amqp_protocol.AmqpProtocol):
+    """A protocol that builds its dispatch table for every frame"""
+
+    async def dispatch_frame(self, frame_channel=None, frame=None):
+        self._method_handlers = {
+            index: getattr(self, name) for index, name in amqp_protocol.METHOD_HANDLERS.items()
+        }
+        await super().dispatch_frame(frame_channel, frame)
+
+
+async def _dispatch(name, protocol_class, channel_class, count, size):
+    protocol = protocol_class(None)
+    # what __aenter__ and channel() would set up
+    protocol.channels = {}
+    protocol._contents = {}
+    channel = channel_class(protocol, 1)
+    channel.consumer_queues['ctag'] = NullQueue()
+    protocol.channels[1] = channel
+    frames = [
+        pamqp.specification.Basic.Deliver(
+            consumer_tag='ctag', delivery_tag=1, exchange='e', routing_key='rk'
+        ),
+        pamqp.header.ContentHeader(body_size=size, properties=Properties()),
+        pamqp.body.ContentBody(memoryview(bytes(size))),
+    ]
+    latencies = []
+
+    start = time.perf_counter()
+    for _ in range(count):
+        received = time.perf_counter()
+        for frame in frames:
+            await protocol.dispatch_frame(1, frame)
+        latencies.append(time.perf_counter() - received)
+    elapsed = time.perf_counter() - start
+    return Result(name, count, size, elapsed, latencies, frames=count * len(frames))
+
+
+async def dispatch(connect, count, size):
+    """Feed Basic.Deliver frames straight into the dispatcher, without a
+    connection; latency is the time per message (three frames)"""
+    return await _dispatch('dispatch', amqp_protocol.AmqpProtocol, amqp_channel.Channel, count, size)
+
+
+async def dispatch_rebuilt(connect, count, size):
+    """Like dispatch, but rebuild the dispatch tables for every frame, as
+    the dispatcher used to, for comparison"""
+    return await _dispatch('dispatch_rebuilt', RebuildingProtocol, RebuildingChannel, count, size)
+
+
+# name => (scenario, default message count, default message size)
+SCENARIOS = {
+    'publish': (publish, 10000, 100),
+    'publisher': (publisher, 10000, 100),
+    'publish_many': (publish_many, 10000, 100),
+    'confirmed_publish': (confirmed_publish, 2000, 100),
+    'basic_consume': (basic_consume, 10000, 100),
+    'new_consumer': (new_consumer, 10000, 100),
+    'basic_get': (basic_get, 2000, 100),
+    'rpc': (rpc, 2000, 100),
+    'receive_4kb': (receive_4kb, 10000, 4096),
+    'receive_128kb': (receive_128kb, 1000, 131072),
+    'receive_4mb': (receive_4mb, 50, 4194304),
+    'dispatch': (dispatch, 100000, 100),
+    'dispatch_rebuilt': (dispatch_rebuilt, 100000, 100),
+    'large_1mb': (large_1mb, 50, 1000000),
+    'large_100mb': (large_100mb, 2, 100000000),
+}
@@ -0,0 +1,71 @@
+"""
+    Test the coalescing of acks
+"""
+
+import pytest
+
+from async_amqp.channel import AckBatcher
+
+
+def frames(requests):
+    return [(request.delivery_tag, request.multiple) for request in requests]
+
+
+class TestAckBatcher:
+
+    def batcher(self, n_delivered):
+        acks = AckBatcher(max_acks=100, max_delay=1)
+        for tag in range(1, n_delivered + 1):
+            acks.delivered(tag)
+        return acks
+
+    @pytest.mark.trio
+    async def test_in_order(self):
+        acks = self.batcher(5)
+        for tag in range(1, 5):
+            assert acks.ack(tag)
+        assert acks.n_acked == 4
+        assert frames(acks.take()) == [(4, True)]
+        assert len(acks) == 1
+        assert acks.take() == []
+
+        acks.ack(5)
+        assert frames(acks.take()) == [(5, False)]
+        assert len(acks) == 0
+
+    @pytest.mark.trio
+    async def test_out_of_order(self):
+        acks = self.batcher(6)
+        for tag in (2, 1, 4, 6):
+            acks.ack(tag)
+        # 3 hasn't been acked, so 4 and 6 can't be covered by a multiple ack
+        assert frames(acks.take()) == [(2, True), (4, False), (6, False)]
+        assert acks.n_acked == 0
+
+        acks.ack(5)
+        assert frames(acks.take()) == [(5, False)]
+        acks.ack(3)
+        assert frames(acks.take()) == [(3, False)]
+        assert len(acks) == 0
+
+    @pytest.mark.trio
+    async def test_unknown_tags(self):
+        acks = self.batcher(2)
+        assert acks.ack(1)
+        # acked twice, or never delivered with ack tracking
+        assert not acks.ack(1)
+        assert not acks.ack(7)
+        assert acks.n_acked == 1
+
+    @pytest.mark.trio
+    async def test_settled(self):
+        acks = self.batcher(6)
+        acks.ack(1)
+        acks.ack(5)
+        acks.settled(2, multiple=False)
+        acks.settled(5, multiple=False)
+        assert acks.n_acked == 1
+        acks.settled(4, multiple=True)
+        assert acks.n_acked == 0
+        assert acks.take() == []
+        assert len(acks) == 1
@@ -49,6 +49,49 @@ class TestQos(testcase.RabbitTestCase):
                         prefetch_size=100000, prefetch_count=1000000000, connection_global=False
                     )
 
+    @pytest.mark.trio
+    async def test_prefetch_sizes_consumer_buffer(self, channel):
+        await channel.basic_qos(prefetch_count=100)
+        assert channel.prefetch_count == 100
+        await channel.queue_declare("q", exclusive=True, no_wait=False)
+        await channel.publish_many((b"msg", "", "q") for _ in range(120))
+
+        async with channel.new_consumer(queue_name="q") as listener:
+            # more than CONSUMER_BUFFER_SIZE messages arrive without being read
+            async with anyio.fail_after(5):
+                while listener.queue_depth < 100:
+                    await anyio.sleep(0.05)
+            assert channel.queue_depth() == 100
+
+            body, envelope, _properties = await listener.get()
+            assert listener.queue_depth == 99
+            await channel.basic_client_ack(envelope.delivery_tag)
+
+    @pytest.mark.trio
+    async def test_auto_qos(self, channel):
+        await channel.auto_qos(min_prefetch=5, max_prefetch=500, interval=0.1)
+        assert channel.prefetch_count == 5
+        await channel.queue_declare("q", exclusive=True, no_wait=False)
+        await channel.publish_many((b"msg", "", "q") for _ in range(300))
+
+        async with channel.new_consumer(queue_name="q") as listener:
+            async with anyio.fail_after(5):
+                async for body, envelope, _properties in listener:
+                    await channel.basic_client_ack(envelope.delivery_tag)
+                    if envelope.delivery_tag == 300:
+                        break
+        await anyio.sleep(0.3)
+        # fast consumers get a bigger window, which idling doesn't shrink
+        assert channel.prefetch_count > 5
+
+        await channel.basic_qos(prefetch_count=10)
+        assert channel._auto_qos is None
+
+    @pytest.mark.trio
+    async def test_auto_qos_wrong_values(self, channel):
+        with pytest.raises(ValueError):
+            await channel.auto_qos(min_prefetch=10, max_prefetch=5)
+
 
 class TestBasicCancel(testcase.RabbitTestCase):
     @pytest.mark.trio
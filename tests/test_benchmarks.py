@@ -0,0 +1,23 @@
+"""
+    Run every benchmark scenario briefly, against the fake broker
+"""
+
+from functools import partial
+
+import pytest
+
+from async_amqp import connect_amqp
+from async_amqp.testing import FakeBroker
+from benchmarks.scenarios import SCENARIOS
+
+
+@pytest.mark.parametrize("name", list(SCENARIOS))
+@pytest.mark.trio
+async def test_scenario(name):
+    scenario, _count, _size = SCENARIOS[name]
+    async with FakeBroker() as broker:
+        result = await scenario(partial(connect_amqp, port=broker.port), 3, 100)
+    result = result.as_dict()
+    assert result['name'] == name
+    assert result['messages'] == 3
+    assert result['seconds'] > 0
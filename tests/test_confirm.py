@@ -0,0 +1,158 @@
+"""
+    Test publisher confirm bookkeeping
+"""
+
+import anyio
+import pytest
+import pamqp.specification
+
+from async_amqp import exceptions
+from async_amqp.channel import Channel
+
+
+class FakeProtocol:
+    """Just enough of AmqpProtocol to let a channel publish"""
+
+    server_frame_max = 4096
+    metrics = None
+
+    def __init__(self):
+        self.connection_closed = anyio.create_event()
+        self.sent = []
+
+    async def ensure_open(self):
+        pass
+
+    async def _write_frame(self, channel_id, request, drain=True):
+        pass
+
+    async def _write_data(self, data):
+        self.sent.append(data)
+
+    async def _drain(self):
+        pass
+
+
+class TestConfirms:
+
+    async def channel(self, max_in_flight=None):
+        channel = Channel(FakeProtocol(), 1)
+        await channel.confirm_select(max_in_flight=max_in_flight, no_wait=True)
+        assert channel.publisher_confirms
+        return channel
+
+    async def publish(self, channel, n):
+        return await channel.publish_many((b"x", "e", "rk") for _ in range(n))
+
+    def ack(self, delivery_tag, multiple=False):
+        return pamqp.specification.Basic.Ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def nack(self, delivery_tag, multiple=False):
+        return pamqp.specification.Basic.Nack(delivery_tag=delivery_tag, multiple=multiple)
+
+    @pytest.mark.trio
+    async def test_multiple_ack(self):
+        channel = await self.channel()
+        futures = await self.publish(channel, 10)
+        assert [fut.delivery_tag for fut in futures] == list(range(1, 11))
+
+        await channel.basic_server_ack(self.ack(7, multiple=True))
+        assert [fut.done() for fut in futures] == [True] * 7 + [False] * 3
+        assert len(channel._confirm_futures) == 3
+
+        await channel.basic_server_ack(self.ack(10, multiple=True))
+        await channel.wait_for_confirms()
+        assert not channel._confirm_futures
+
+    @pytest.mark.trio
+    async def test_out_of_order(self):
+        channel = await self.channel()
+        futures = await self.publish(channel, 5)
+
+        await channel.basic_server_ack(self.ack(3))
+        assert [fut.done() for fut in futures] == [False, False, True, False, False]
+        await channel.basic_server_nack(self.nack(4, multiple=True))
+        await channel.basic_server_ack(self.ack(5))
+
+        assert all(fut.done() for fut in futures)
+        assert await futures[2]() is True
+        with pytest.raises(exceptions.PublishFailed):
+            await futures[0]()
+        with pytest.raises(exceptions.PublishFailed) as exc:
+            await channel.wait_for_confirms()
+        # the caller already knows about the first one
+        assert exc.value.delivery_tag == 2
+        # reported once
+        await channel.wait_for_confirms()
+
+    @pytest.mark.trio
+    async def test_nack_raised_by_publish(self):
+        channel = await self.channel()
+
+        async def nack():
+            await anyio.wait_all_tasks_blocked()
+            await channel.basic_server_nack(self.nack(1))
+
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(nack)
+            with pytest.raises(exceptions.PublishFailed):
+                await channel.publish(b"x", "e", "rk")
+        assert not channel._nacked
+        await channel.wait_for_confirms()
+
+    @pytest.mark.trio
+    async def test_unknown_tag(self):
+        channel = await self.channel()
+        await self.publish(channel, 2)
+        with pytest.raises(exceptions.SynchronizationError):
+            await channel.basic_server_ack(self.ack(3))
+
+    @pytest.mark.trio
+    async def test_window(self):
+        channel = await self.channel(max_in_flight=3)
+        futures = await self.publish(channel, 3)
+        assert len(channel.protocol.sent) == 1
+
+        async with anyio.move_on_after(0.1) as scope:
+            await channel.publish(b"x", "e", "rk")
+        assert scope.cancel_called
+        assert len(channel.protocol.sent) == 1
+
+        await channel.basic_server_ack(self.ack(2, multiple=True))
+        futures.extend(await self.publish(channel, 2))
+        assert [fut.delivery_tag for fut in futures] == [1, 2, 3, 4, 5]
+
+    @pytest.mark.trio
+    async def test_failed_write_reuses_tags(self):
+        channel = await self.channel()
+        await self.publish(channel, 2)
+
+        async def broken(data):
+            raise exceptions.AmqpClosedConnection()
+        write_data, channel.protocol._write_data = channel.protocol._write_data, broken
+        with pytest.raises(exceptions.AmqpClosedConnection):
+            await self.publish(channel, 3)
+        assert len(channel._confirm_futures) == 2
+
+        channel.protocol._write_data = write_data
+        futures = await self.publish(channel, 1)
+        assert futures[0].delivery_tag == 3
+
+    @pytest.mark.trio
+    async def test_cancelled_write_keeps_tags(self):
+        channel = await self.channel()
+        await self.publish(channel, 2)
+
+        async def slow(data):
+            # the writer has taken the data, but hasn't woken us up yet
+            channel.protocol.sent.append(data)
+            await anyio.sleep(0.1)
+        write_data, channel.protocol._write_data = channel.protocol._write_data, slow
+        async with anyio.move_on_after(0.01):
+            await self.publish(channel, 3)
+        assert len(channel.protocol.sent) == 2
+        assert len(channel._confirm_futures) == 5
+
+        channel.protocol._write_data = write_data
+        futures = await self.publish(channel, 1)
+        assert futures[0].delivery_tag == 6
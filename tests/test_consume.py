@@ -202,3 +202,35 @@ class TestConsume(testcase.RabbitTestCase):
 
                 await channel.basic_consume(callback, queue_name="q")
                 await sync_future.set()
+
+    @pytest.mark.trio
+    async def test_slow_callback_does_not_block_reader(self, amqp):
+        async with amqp.new_channel() as channel:
+            await channel.queue_declare("q", exclusive=True, no_wait=False)
+            await channel.exchange_declare("e", "fanout")
+            await channel.queue_bind("q", "e", routing_key='')
+
+            unblock = anyio.create_event()
+            done = anyio.create_event()
+            bodies = []
+
+            async def callback(channel, body, envelope, properties):
+                await unblock.wait()
+                bodies.append(body)
+                if len(bodies) == 3:
+                    await done.set()
+
+            await channel.basic_consume(callback, queue_name="q", no_ack=True)
+            for i in range(3):
+                await channel.publish(b"msg%d" % i, "e", routing_key='')
+
+            # The callback is stuck, but the connection keeps working
+            async with anyio.fail_after(5):
+                async with amqp.new_channel() as other:
+                    await other.queue_declare("q", passive=True)
+            assert not bodies
+
+            await unblock.set()
+            async with anyio.fail_after(5):
+                await done.wait()
+            assert bodies == [b"msg0", b"msg1", b"msg2"]
@@ -0,0 +1,114 @@
+"""
+    Test the assembly of message content from interleaved frames
+"""
+
+import pytest
+import pamqp.body
+import pamqp.header
+import pamqp.specification
+
+from async_amqp import exceptions
+from async_amqp.protocol import AmqpProtocol
+
+
+class RecordingChannel:
+    def __init__(self):
+        self.contents = []
+        self.frames = []
+
+    async def dispatch_content(self, content):
+        self.contents.append(content)
+
+    async def dispatch_frame(self, frame):
+        self.frames.append(frame)
+
+    async def start_content(self, content):
+        pass
+
+
+def deliver(tag):
+    return pamqp.specification.Basic.Deliver(consumer_tag='ctag', delivery_tag=tag, exchange='e', routing_key='rk')
+
+
+def header(size):
+    return pamqp.header.ContentHeader(body_size=size, properties=pamqp.specification.Basic.Properties())
+
+
+def body(data):
+    return pamqp.body.ContentBody(memoryview(data))
+
+
+class TestContentAssembly:
+
+    def protocol(self, *channel_ids):
+        # what __aenter__ would set up
+        protocol = AmqpProtocol(None)
+        protocol.channels = {}
+        protocol._contents = {}
+        for channel_id in channel_ids:
+            protocol.channels[channel_id] = RecordingChannel()
+        return protocol
+
+    @pytest.mark.trio
+    async def test_interleaved_channels(self):
+        protocol = self.protocol(1, 2)
+        frames = [
+            (1, deliver(1)),
+            (1, header(6)),
+            (2, deliver(2)),
+            (1, body(b'abc')),
+            (2, header(3)),
+            (2, pamqp.specification.Basic.Ack(delivery_tag=5)),
+            (2, body(b'xyz')),
+            (1, body(b'def')),
+        ]
+        for channel_id, frame in frames:
+            await protocol.dispatch_frame(channel_id, frame)
+
+        one, two = protocol.channels[1], protocol.channels[2]
+        assert [c.body for c in one.contents] == [b'abcdef']
+        assert one.contents[0].method.delivery_tag == 1
+        assert [c.body for c in two.contents] == [b'xyz']
+        assert [f.delivery_tag for f in two.frames] == [5]
+        assert not protocol._contents
+
+    @pytest.mark.trio
+    async def test_empty_body(self):
+        protocol = self.protocol(1)
+        await protocol.dispatch_frame(1, deliver(1))
+        await protocol.dispatch_frame(1, header(0))
+
+        content, = protocol.channels[1].contents
+        assert content.body == b''
+
+    @pytest.mark.trio
+    async def test_body_without_method(self):
+        protocol = self.protocol(1)
+        with pytest.raises(exceptions.SynchronizationError):
+            await protocol.dispatch_frame(1, body(b'abc'))
+
+    @pytest.mark.trio
+    async def test_spill_to_file(self):
+        protocol = self.protocol(1)
+        protocol.spill_threshold = 5
+        frames = [deliver(1), header(6), body(b'abc'), body(b'def'), deliver(2), header(5), body(b'small')]
+        for frame in frames:
+            await protocol.dispatch_frame(1, frame)
+
+        large, small = protocol.channels[1].contents
+        data = large.body
+        assert isinstance(data, memoryview)
+        assert data.readonly
+        assert data == b'abcdef'
+        assert small.body == b'small'
+
+    @pytest.mark.trio
+    async def test_discard_spilled(self):
+        protocol = self.protocol(1)
+        protocol.spill_threshold = 0
+        protocol.channels_ids_free = set()
+        for frame in [deliver(1), header(6), body(b'abc')]:
+            await protocol.dispatch_frame(1, frame)
+        spill = protocol._contents[1]._file
+        protocol.release_channel_id(1)
+        assert spill.closed
@@ -0,0 +1,450 @@
+"""
+    Run the client against the in-process fake broker
+"""
+
+import io
+import mmap
+import random
+
+import anyio
+import pytest
+
+from async_amqp import connect_amqp, exceptions
+from async_amqp.metrics import Metrics
+from async_amqp.protocol import CLOSED
+from async_amqp.testing import FakeBroker, topic_matches
+
+
+@pytest.fixture
+async def broker():
+    async with FakeBroker(frame_max=4096) as broker:
+        yield broker
+
+
+@pytest.fixture
+async def amqp(broker):
+    async with connect_amqp(port=broker.port) as amqp:
+        yield amqp
+
+
+@pytest.fixture
+async def channel(amqp):
+    async with amqp.new_channel() as channel:
+        yield channel
+
+
+@pytest.mark.parametrize("pattern, routing_key, result", [
+    ("a.b", "a.b", True),
+    ("a.*", "a.b", True),
+    ("a.*", "a.b.c", False),
+    ("a.#", "a", True),
+    ("a.#", "a.b.c", True),
+    ("#.c", "a.b.c", True),
+    ("*.b.#", "a.b", True),
+    ("#", "", True),
+    ("a.b", "a.c", False),
+])
+def test_topic_matches(pattern, routing_key, result):
+    assert topic_matches(pattern, routing_key) is result
+
+
+class TestFakeBroker:
+
+    @pytest.mark.trio
+    async def test_publish_get(self, broker, channel):
+        await channel.queue_declare("q")
+        await channel.publish(b"x" * 10000, "", routing_key="q")
+        await channel.publish(b"", "", routing_key="q")
+
+        result = await channel.basic_get("q", no_ack=True)
+        assert result['message'] == b"x" * 10000
+        assert result['message_count'] == 1
+        result = await channel.basic_get("q", no_ack=True)
+        assert result['message'] == b""
+        with pytest.raises(exceptions.EmptyQueue):
+            await channel.basic_get("q")
+
+    @pytest.mark.trio
+    async def test_routing(self, broker, channel):
+        await channel.exchange_declare("topic", "topic")
+        await channel.exchange_declare("fanout", "fanout")
+        for name in ("q1", "q2", "q3"):
+            await channel.queue_declare(name)
+        await channel.queue_bind("q1", "topic", routing_key="a.*")
+        await channel.queue_bind("q2", "topic", routing_key="#")
+        await channel.exchange_bind("fanout", "topic", routing_key="a.#")
+        await channel.queue_bind("q3", "fanout", routing_key="")
+
+        await channel.publish(b"1", "topic", routing_key="a.b")
+        await channel.publish(b"2", "topic", routing_key="b")
+        await channel.publish(b"3", "topic", routing_key="a.b.c")
+
+        result = await channel.queue_declare("q1", passive=True)
+        assert result['message_count'] == 1
+        assert [m.body for m in broker.queues["q2"].messages] == [b"1", b"2", b"3"]
+        assert [m.body for m in broker.queues["q3"].messages] == [b"1", b"3"]
+
+    @pytest.mark.trio
+    async def test_errors(self, channel, amqp):
+        with pytest.raises(exceptions.ChannelClosed) as cm:
+            await channel.queue_declare("missing", passive=True)
+        assert cm.value.code == 404
+
+        async with amqp.new_channel() as other:
+            await other.exchange_declare("e", "direct")
+            with pytest.raises(exceptions.ChannelClosed) as cm:
+                await other.exchange_declare("e", "fanout")
+            assert cm.value.code == 406
+
+    @pytest.mark.trio
+    async def test_confirms_and_returns(self, channel):
+        await channel.confirm_select(max_in_flight=10)
+        await channel.queue_declare("q")
+        futures = await channel.publish_many((b"m%d" % i, "", "q") for i in range(25))
+        await channel.wait_for_confirms()
+        assert all(fut.done() for fut in futures)
+
+        returned = []
+        async with anyio.create_task_group() as tg:
+            async def watch():
+                async for body, envelope, _properties in channel:
+                    returned.append((body, envelope.reply_code))
+                    return
+            await tg.spawn(watch)
+            await anyio.sleep(0)
+            await channel.publish(b"lost", "", routing_key="nowhere", mandatory=True)
+        assert returned == [(b"lost", 312)]
+
+    @pytest.mark.trio
+    async def test_publish_buffers(self, broker, channel):
+        await channel.queue_declare("q")
+        buf = bytearray(b"a" * 200000)
+        await channel.publish(buf, "", routing_key="q")
+        # the buffer has been sent when publish returns
+        buf[:] = b"b" * 200000
+        await channel.publish(memoryview(buf)[:70000], "", routing_key="q")
+        with mmap.mmap(-1, 100000) as region:
+            region.write(b"c" * 100000)
+            await channel.publish_many([(region, "", "q"), (b"small", "", "q")])
+
+        result = await channel.basic_get("q", no_ack=True)
+        assert result['message'] == b"a" * 200000
+        assert [m.body for m in broker.queues["q"].messages] == [b"b" * 70000, b"c" * 100000, b"small"]
+
+    @pytest.mark.trio
+    async def test_publish_buffer_writer_gone(self, broker):
+        async with connect_amqp(port=broker.port) as amqp:
+            async with amqp.new_channel() as channel:
+                await amqp._writer_scope.cancel()
+                async with anyio.fail_after(5):
+                    with pytest.raises((exceptions.AmqpClosedConnection, exceptions.ChannelClosed)):
+                        await channel.publish(bytearray(100000), "", "q")
+
+    @pytest.mark.trio
+    async def test_publish_stream(self, broker, channel):
+        await channel.queue_declare("q")
+        body = bytes(range(256)) * 200
+
+        started = anyio.create_event()
+
+        async def chunks():
+            for i in range(0, len(body), 1000):
+                yield body[i:i + 1000]
+                await started.set()
+                await anyio.sleep(0)
+
+        async def publish_small():
+            await started.wait()
+            # waits for the streamed message to be complete
+            await channel.publish(b"small", "", "q")
+
+        class AsyncFile:
+            def __init__(self, data):
+                self.data = io.BytesIO(data)
+
+            async def read(self, size):
+                await anyio.sleep(0)
+                return self.data.read(size)
+
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(channel.publish_stream, "", "q", chunks(), len(body))
+            await tg.spawn(publish_small)
+        await channel.confirm_select()
+        await channel.publish_stream("", "q", io.BytesIO(body + b"rest"), len(body), {'app_id': 'a'})
+        await channel.publish_stream("", "q", AsyncFile(body), len(body))
+        await channel.publish_stream("", "q", AsyncFile(b""), 0)
+
+        messages = broker.queues["q"].messages
+        assert [m.body for m in messages] == [body, b"small", body, body, b""]
+        assert messages[2].header.properties.app_id == 'a'
+
+    @pytest.mark.trio
+    @pytest.mark.parametrize("data", [b"x" * 5000, b"x" * 20000])
+    async def test_publish_stream_wrong_size(self, broker, data):
+        async def chunks():
+            yield data
+
+        with pytest.raises(ValueError):
+            async with connect_amqp(port=broker.port) as amqp:
+                async with amqp.new_channel() as channel:
+                    await channel.publish_stream("", "q", chunks(), 10000)
+        # the message can't be completed
+        assert amqp.state == CLOSED
+
+    @pytest.mark.trio
+    async def test_publisher(self, broker, channel):
+        await channel.queue_declare("q")
+        publisher = channel.publisher("", "q", properties={'message_id': 'm', 'priority': 3})
+        assert publisher._marshal(b"abc") == channel._marshal_publish(
+            b"abc", "", "q", {'priority': 3, 'message_id': 'm'}
+        )
+
+        await publisher.publish(b"x" * 10000)
+        await channel.confirm_select()
+        futures = await publisher.publish_many([b"", b"two"])
+        assert len(futures) == 2
+        await channel.wait_for_confirms()
+
+        messages = broker.queues["q"].messages
+        assert [m.body for m in messages] == [b"x" * 10000, b"", b"two"]
+        assert all(m.header.properties.priority == 3 for m in messages)
+
+    @pytest.mark.trio
+    async def test_consume_with_prefetch(self, broker, channel):
+        await channel.basic_qos(prefetch_count=5)
+        await channel.queue_declare("q")
+        await channel.publish_many((b"m%d" % i, "", "q") for i in range(20))
+
+        bodies = []
+        async with channel.new_consumer(queue_name="q") as listener:
+            async with anyio.fail_after(5):
+                while listener.queue_depth < 5:
+                    await anyio.sleep(0.01)
+            # the broker respects the prefetch window
+            assert len(broker.queues["q"].messages) == 15
+
+            async for body, envelope, _properties in listener:
+                bodies.append(body)
+                await channel.basic_client_ack(envelope.delivery_tag)
+                if len(bodies) == 20:
+                    break
+        assert bodies == [b"m%d" % i for i in range(20)]
+
+    @pytest.mark.trio
+    async def test_consume_stream_body(self, channel):
+        await channel.queue_declare("q")
+        body = bytes(range(256)) * 100  # many frames
+        await channel.publish_many([(body, "", "q"), (b"", "", "q"), (body, "", "q"), (b"last", "", "q")])
+
+        received = []
+        done = anyio.create_event()
+
+        async def callback(channel, stream, envelope, properties):
+            assert stream.body_size == [len(body), 0, len(body), 4][len(received)]
+            if len(received) == 2:
+                # the rest of the body is discarded
+                chunk = await stream.__anext__()
+                received.append(bytes(chunk))
+                return
+            chunks = [chunk async for chunk in stream]
+            assert all(len(chunk) < 4096 for chunk in chunks)
+            received.append(b"".join(chunks))
+            if len(received) == 4:
+                await done.set()
+
+        await channel.basic_consume(callback, queue_name="q", no_ack=True, stream_body=True)
+        async with anyio.fail_after(5):
+            await done.wait()
+        assert received[0] == body
+        assert received[1] == b""
+        assert body.startswith(received[2])
+        assert received[3] == b"last"
+
+    @pytest.mark.trio
+    async def test_consume_stream_body_queued(self, channel):
+        await channel.queue_declare("q")
+        body = b"x" * 50000
+        await channel.publish_many([(body, "", "q")] * 3)
+
+        received = []
+        done = anyio.create_event()
+
+        async def callback(channel, stream, envelope, properties):
+            received.append(await stream.read())
+            # the other streams are queued meanwhile; they don't block the
+            # reader, which has to receive the reply
+            await channel.queue_declare("q%d" % len(received))
+            if len(received) == 3:
+                await done.set()
+
+        await channel.basic_consume(callback, queue_name="q", no_ack=True, stream_body=True)
+        async with anyio.fail_after(5):
+            await done.wait()
+        assert received == [body] * 3
+
+    @pytest.mark.trio
+    async def test_consumer_stream_body(self, channel):
+        await channel.queue_declare("q")
+        await channel.publish(b"x" * 50000, "", "q")
+        async with channel.new_consumer(queue_name="q", no_ack=True, stream_body=True) as listener:
+            async for stream, _envelope, _properties in listener:
+                assert stream.body_size == 50000
+                assert await stream.read() == b"x" * 50000
+                assert stream.received == 50000
+                break
+
+    @pytest.mark.trio
+    async def test_consumer_stream_body_unread(self, channel):
+        await channel.queue_declare("q")
+        for _ in range(3):
+            await channel.publish(b"x" * 50000, "", "q")
+        async with anyio.fail_after(5):
+            async with channel.new_consumer(queue_name="q", no_ack=True, stream_body=True) as listener:
+                # get() discards the rest of the previous body
+                stream, _envelope, _properties = await listener.get()
+                await stream.__anext__()
+                stream, _envelope, _properties = await listener.get()
+                assert stream.body_size == 50000
+                # leaving discards the bodies that are still pending
+            await channel.queue_declare("q2")
+            await channel.publish(b"y", "", "q2")
+            result = await channel.basic_get("q2", no_ack=True)
+            assert result['message'] == b"y"
+
+    @pytest.mark.trio
+    async def test_spill_large_bodies(self, broker):
+        body = bytes(range(256)) * 100
+        async with connect_amqp(port=broker.port, spill_threshold=10000) as amqp:
+            async with amqp.new_channel() as channel:
+                await channel.queue_declare("q")
+                await channel.publish_many([(body, "", "q"), (b"small", "", "q"), (body, "", "q")])
+
+                result = await channel.basic_get("q", no_ack=True)
+                assert isinstance(result['message'], memoryview)
+                assert result['message'] == body
+                async with channel.new_consumer(queue_name="q", no_ack=True) as listener:
+                    received = [(await listener.get())[0] for _ in range(2)]
+        assert received[0] == b"small"
+        assert isinstance(received[1], memoryview)
+        assert received[1] == body
+
+    @pytest.mark.trio
+    async def test_coalesce_acks(self, broker):
+        metrics = Metrics()
+        async with connect_amqp(port=broker.port, metrics=metrics) as amqp:
+            async with amqp.new_channel() as channel:
+                await channel.basic_qos(prefetch_count=40)
+                await channel.coalesce_acks(max_acks=10, max_delay=0.05)
+                await channel.queue_declare("q")
+                await channel.publish_many((b"m%d" % i, "", "q") for i in range(100))
+
+                frames_before = metrics.frames_out
+                async with channel.new_consumer(queue_name="q") as listener:
+                    for _ in range(100):
+                        _body, envelope, _properties = await listener.get()
+                        await channel.basic_client_ack(envelope.delivery_tag)
+                    assert metrics.frames_out - frames_before <= 12
+
+                    await channel.publish(b"late", "", "q")
+                    _body, envelope, _properties = await listener.get()
+                    await channel.basic_client_ack(envelope.delivery_tag)
+                    # sent after max_delay
+                    async with anyio.fail_after(5):
+                        while broker.queues["q"].consumers[0].unacked:
+                            await anyio.sleep(0.01)
+            # nothing was requeued when the channel closed
+            async with amqp.new_channel() as channel:
+                result = await channel.queue_declare("q", passive=True)
+                assert result['message_count'] == 0
+
+    @pytest.mark.trio
+    async def test_coalesce_acks_connection_close(self, broker):
+        async with connect_amqp(port=broker.port) as amqp:
+            channel = await amqp.channel()
+            await channel.coalesce_acks(max_acks=100, max_delay=5)
+            await channel.queue_declare("q")
+            await channel.publish_many((b"m%d" % i, "", "q") for i in range(5))
+            for _ in range(5):
+                result = await channel.basic_get("q")
+                await channel.basic_client_ack(result['delivery_tag'])
+            assert channel._acks.n_acked == 5
+        # the acks were sent before the connection was closed
+        async with connect_amqp(port=broker.port) as amqp:
+            async with amqp.new_channel() as channel:
+                result = await channel.queue_declare("q", passive=True)
+                assert result['message_count'] == 0
+
+    @pytest.mark.trio
+    async def test_coalesce_acks_out_of_order(self, broker):
+        async with connect_amqp(port=broker.port) as amqp:
+            async with amqp.new_channel() as channel:
+                await channel.basic_qos(prefetch_count=20)
+                await channel.coalesce_acks(max_acks=5)
+                await channel.queue_declare("q")
+                await channel.publish_many((b"m%d" % i, "", "q") for i in range(60))
+
+                rng = random.Random(1)
+                async with channel.new_consumer(queue_name="q") as listener:
+                    envelopes = []
+                    for _ in range(60):
+                        envelopes.append((await listener.get())[1])
+                        if len(envelopes) == 10:
+                            rng.shuffle(envelopes)
+                            for envelope in envelopes[:-1]:
+                                if envelope.delivery_tag % 7 == 0:
+                                    await channel.basic_reject(envelope.delivery_tag)
+                                else:
+                                    await channel.basic_client_ack(envelope.delivery_tag)
+                            # drops every held back ack before it
+                            await channel.basic_client_nack(envelopes[-1].delivery_tag, multiple=True, requeue=False)
+                            envelopes = []
+                # the broker would have closed the channel on an unknown tag
+                assert channel.is_open
+            async with amqp.new_channel() as channel:
+                result = await channel.queue_declare("q", passive=True)
+                assert result['message_count'] == 0
+
+    @pytest.mark.trio
+    async def test_nack_requeues(self, channel):
+        await channel.queue_declare("q")
+        await channel.publish(b"again", "", routing_key="q")
+
+        result = await channel.basic_get("q")
+        assert not result['redelivered']
+        await channel.basic_client_nack(result['delivery_tag'], requeue=True)
+        result = await channel.basic_get("q", no_ack=True)
+        assert result['message'] == b"again"
+        assert result['redelivered']
+
+    @pytest.mark.trio
+    async def test_interleaved_channels(self, amqp):
+        payload = bytes(range(256)) * 100  # many frames each
+        async with amqp.new_channel() as one, amqp.new_channel() as two:
+            await one.queue_declare("q")
+            received = []
+            done = anyio.create_event()
+
+            async def callback(channel, body, envelope, properties):
+                received.append(body)
+                if len(received) == 20:
+                    await done.set()
+
+            await two.basic_consume(callback, queue_name="q", no_ack=True)
+            await one.publish_many((payload, "", "q") for _ in range(10))
+            await two.publish_many((payload, "", "q") for _ in range(10))
+            async with anyio.fail_after(5):
+                await done.wait()
+        assert received == [payload] * 20
+
+    @pytest.mark.trio
+    async def test_exclusive_queue(self, broker, channel):
+        async with connect_amqp(port=broker.port) as owner:
+            async with owner.new_channel() as owner_channel:
+                await owner_channel.queue_declare("q", exclusive=True)
+                with pytest.raises(exceptions.ChannelClosed) as cm:
+                    await channel.basic_get("q")
+                assert cm.value.code == 405
+        # deleted along with its connection
+        async with anyio.fail_after(5):
+            while "q" in broker.queues:
+                await anyio.sleep(0.01)
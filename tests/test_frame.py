@@ -0,0 +1,214 @@
+"""
+    Test the frame reader
+"""
+
+import array
+
+import anyio
+import pytest
+import pamqp.body
+import pamqp.frame
+import pamqp.header
+import pamqp.heartbeat
+import pamqp.specification
+
+from async_amqp import exceptions
+from async_amqp import frame as amqp_frame
+from async_amqp.frame import COPY_LIMIT, ContentFrames, FrameReader, marshal_content
+from async_amqp.protocol import AmqpProtocol
+
+
+class ChunkStream:
+    """A receive stream that returns pre-cut chunks of data"""
+
+    def __init__(self, data, chunk_size):
+        self.chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        self.reads = 0
+
+    async def receive(self, max_bytes=65536):
+        if not self.chunks:
+            raise exceptions.AmqpClosedConnection()
+        self.reads += 1
+        return self.chunks.pop(0)
+
+
+def wire_data():
+    frames = [
+        (1, pamqp.specification.Basic.Deliver(consumer_tag='ctag', delivery_tag=1, exchange='e', routing_key='rk')),
+        (1, pamqp.header.ContentHeader(body_size=3000, properties=pamqp.specification.Basic.Properties(content_type='text/plain'))),
+        (1, pamqp.body.ContentBody(b'x' * 1000)),
+        (1, pamqp.body.ContentBody(b'y' * 2000)),
+        (0, pamqp.heartbeat.Heartbeat()),
+        (2, pamqp.specification.Basic.Ack(delivery_tag=7)),
+    ]
+    return b''.join(pamqp.frame.marshal(frame, channel) for channel, frame in frames)
+
+
+class TestFrameReader:
+
+    async def read_all(self, reader, count):
+        return [await reader.read_frame() for _ in range(count)]
+
+    @pytest.mark.trio
+    @pytest.mark.parametrize("chunk_size", [1, 7, 100, 1500, 100000])
+    async def test_split(self, chunk_size):
+        reader = FrameReader(ChunkStream(wire_data(), chunk_size))
+        frames = await self.read_all(reader, 6)
+
+        assert [channel for channel, _ in frames] == [1, 1, 1, 1, 0, 2]
+        assert frames[0][1].name == 'Basic.Deliver'
+        assert frames[0][1].routing_key == 'rk'
+        assert frames[1][1].body_size == 3000
+        assert frames[1][1].properties.content_type == 'text/plain'
+        assert bytes(frames[2][1].value) == b'x' * 1000
+        assert bytes(frames[3][1].value) == b'y' * 2000
+        assert isinstance(frames[4][1], pamqp.heartbeat.Heartbeat)
+        assert frames[5][1].delivery_tag == 7
+
+        with pytest.raises(exceptions.AmqpClosedConnection):
+            await reader.read_frame()
+
+    @pytest.mark.trio
+    async def test_many_frames_per_read(self):
+        stream = ChunkStream(wire_data(), 100000)
+        reader = FrameReader(stream)
+        await self.read_all(reader, 6)
+        assert stream.reads == 1
+
+
+class TestMarshalContent:
+
+    def message(self, payload, frame_max):
+        method = pamqp.specification.Basic.Publish(exchange='e', routing_key='rk')
+        return marshal_content(3, method, {'message_id': 'm1'}, payload, frame_max)
+
+    @pytest.mark.trio
+    @pytest.mark.parametrize("frame_max", [0, 108, 4096])
+    async def test_roundtrip(self, frame_max):
+        payload = bytes(range(256)) * 4
+        data = self.message(payload, frame_max)
+        reader = FrameReader(ChunkStream(bytes(data), 1000))
+
+        channel, method = await reader.read_frame()
+        assert channel == 3
+        assert method.name == 'Basic.Publish'
+        assert method.routing_key == 'rk'
+        _, header = await reader.read_frame()
+        assert header.body_size == len(payload)
+        assert header.properties.message_id == 'm1'
+
+        body = b''
+        while len(body) < len(payload):
+            _, frame = await reader.read_frame()
+            if frame_max:
+                assert len(frame.value) <= frame_max - 8
+            body += bytes(frame.value)
+        assert body == payload
+
+    def test_same_as_pamqp(self):
+        payload = b'x' * 250
+        data = self.message(payload, 108)
+        frames = [
+            pamqp.specification.Basic.Publish(exchange='e', routing_key='rk'),
+            pamqp.header.ContentHeader(
+                body_size=len(payload),
+                properties=pamqp.specification.Basic.Properties(message_id='m1'),
+            ),
+            pamqp.body.ContentBody(payload[:100]),
+            pamqp.body.ContentBody(payload[100:200]),
+            pamqp.body.ContentBody(payload[200:]),
+        ]
+        assert data == b''.join(pamqp.frame.marshal(frame, 3) for frame in frames)
+
+    @pytest.mark.parametrize("frame_max", [4096, 0])
+    def test_empty_body(self, frame_max):
+        data = self.message(b'', frame_max)
+        frames = [
+            pamqp.specification.Basic.Publish(exchange='e', routing_key='rk'),
+            pamqp.header.ContentHeader(
+                body_size=0,
+                properties=pamqp.specification.Basic.Properties(message_id='m1'),
+            ),
+        ]
+        assert data == b''.join(pamqp.frame.marshal(frame, 3) for frame in frames)
+
+    def flatten(self, data):
+        if isinstance(data, ContentFrames):
+            return b''.join(data.pieces)
+        return bytes(data)
+
+    def copied(self, payload, frame_max, monkeypatch):
+        with monkeypatch.context() as patch:
+            patch.setattr(amqp_frame, 'COPY_LIMIT', float('inf'))
+            return bytes(self.message(payload, frame_max))
+
+    def test_large_body_not_copied(self, monkeypatch):
+        payload = bytes(range(256)) * 1000
+        data = self.message(payload, 4096)
+        assert isinstance(data, ContentFrames)
+        assert data.sent == ()
+        views = [piece for piece in data.pieces if isinstance(piece, memoryview)]
+        assert len(views) == -(-len(payload) // 4088)
+        assert all(view.obj is payload for view in views)
+        assert self.flatten(data) == self.copied(payload, 4096, monkeypatch)
+        assert len(data) == len(self.flatten(data))
+
+    @pytest.mark.trio
+    @pytest.mark.parametrize("payload", [
+        bytearray(b'abc' * 30000),
+        memoryview(b'abcdef' * 20000)[::2],
+        array.array('d', range(10000)),
+        array.array('b', range(100)),
+    ])
+    async def test_buffer_types(self, payload, monkeypatch):
+        expected = memoryview(payload).tobytes()
+        assert self.flatten(self.message(payload, 4096)) == self.copied(expected, 4096, monkeypatch)
+
+    @pytest.mark.trio
+    async def test_mutable_body(self):
+        data = self.message(bytearray(COPY_LIMIT), 0)
+        assert len(data.sent) == 1
+
+    def test_not_a_buffer(self):
+        with pytest.raises(TypeError):
+            self.message("text", 4096)
+
+    def test_join(self):
+        large = self.message(bytes(COPY_LIMIT), 4096)
+        joined = ContentFrames.join([b'ab', large, b'cd'])
+        assert self.flatten(joined) == b'ab' + self.flatten(large) + b'cd'
+        assert ContentFrames.join([b'ab', bytearray(b'cd')]) == b'abcd'
+
+    @pytest.mark.trio
+    async def test_send_failed(self):
+        class BrokenStream:
+            async def send(self, data):
+                raise anyio.BrokenResourceError()
+
+        data = self.message(bytearray(COPY_LIMIT), 4096)
+        with pytest.raises(anyio.BrokenResourceError):
+            await amqp_frame.send(BrokenStream(), data)
+        with pytest.raises(exceptions.AmqpClosedConnection):
+            await amqp_frame.wait_sent(data)
+
+    @pytest.mark.trio
+    async def test_queued_when_writer_stops(self):
+        protocol = AmqpProtocol(None)
+        protocol._send_queue_w, protocol._send_queue_r = anyio.create_memory_object_stream(1)
+        data = self.message(bytearray(COPY_LIMIT), 4096)
+        await protocol._write_data(data)
+        waiting = self.message(bytearray(COPY_LIMIT), 4096)
+
+        async with anyio.create_task_group() as tg:
+            # this one waits for room in the queue
+            await tg.spawn(protocol._write_data, waiting)
+            await anyio.wait_all_tasks_blocked()
+            assert protocol.send_queue_depth == 2
+            await protocol._close_send_queue()
+        assert protocol.send_queue_depth == 0
+        for queued in (data, waiting):
+            with pytest.raises(exceptions.AmqpClosedConnection):
+                async with anyio.fail_after(1):
+                    await amqp_frame.wait_sent(queued)
+        with pytest.raises(exceptions.AmqpClosedConnection):
+            await protocol._write_data(b'x')
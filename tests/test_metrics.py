@@ -0,0 +1,104 @@
+"""
+    Test the connection metrics
+"""
+
+import anyio
+import pytest
+
+from async_amqp import connect_amqp
+from async_amqp.metrics import Histogram, Metrics, prometheus_text
+from async_amqp.testing import FakeBroker
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(3.65)
+    assert [total for _bound, total in histogram.cumulative()] == [2, 3, 4]
+
+
+class TestMetrics:
+
+    @pytest.mark.trio
+    async def test_counters(self):
+        metrics = Metrics()
+        events = []
+        metrics.add_hook(lambda event, **info: events.append(event))
+
+        async with FakeBroker(frame_max=4096) as broker:
+            async with connect_amqp(port=broker.port, metrics=metrics) as amqp:
+                async with amqp.new_channel() as channel:
+                    await channel.queue_declare("q")
+                    assert metrics.rpc_seconds.count == 2  # channel open, queue declare
+
+                    received = anyio.create_event()
+
+                    async def callback(channel, body, envelope, properties):
+                        await received.set()
+
+                    await channel.basic_consume(callback, queue_name="q", no_ack=True)
+                    await channel.publish(b"x" * 10000, "", routing_key="q")
+                    async with anyio.fail_after(5):
+                        await received.wait()
+
+                    gauges = metrics.gauges()
+                    assert gauges['connections'] == 1
+                    assert gauges['channels'] == 1
+                    assert gauges['outstanding_futures'] == 0
+
+        assert metrics.messages_published == 1
+        assert metrics.bytes_published == 10000
+        assert metrics.messages_delivered == 1
+        assert metrics.bytes_delivered == 10000
+        # method, header and three body frames each way
+        assert metrics.frames_in >= 5
+        assert metrics.frames_out >= 5
+        assert metrics.bytes_out > 10000 and metrics.bytes_in > 10000
+        assert metrics.writes == metrics.write_seconds.count > 0
+        assert metrics.frames_in == metrics.dispatch_seconds.count
+        assert metrics.gauges()['connections'] == 0
+        for event in ('connected', 'publish', 'write', 'frame', 'rpc', 'deliver', 'closed'):
+            assert event in events
+
+    @pytest.mark.trio
+    async def test_broken_hook(self):
+        metrics = Metrics()
+
+        def hook(event, **info):
+            raise RuntimeError(event)
+        metrics.add_hook(hook)
+
+        async with FakeBroker() as broker:
+            async with connect_amqp(port=broker.port, metrics=metrics) as amqp:
+                async with amqp.new_channel() as channel:
+                    await channel.queue_declare("q")
+        assert metrics.rpc_seconds.count == 3  # channel open, queue declare, channel close
+
+    @pytest.mark.trio
+    async def test_send_queue_depth(self):
+        metrics = Metrics()
+        async with FakeBroker() as broker:
+            async with connect_amqp(port=broker.port, metrics=metrics) as amqp:
+                async with amqp.new_channel() as channel:
+                    await channel.queue_declare("q")
+                    # queued, but not necessarily sent yet
+                    for _ in range(3):
+                        await channel.publish_many([(b"x", "", "q")] * 10)
+                    assert 0 < metrics.gauges()['send_queue_depth'] <= 3
+                    # a round trip: everything before it has been sent
+                    await channel.queue_declare("q", passive=True)
+                    assert metrics.gauges()['send_queue_depth'] == 0
+
+    def test_prometheus_text(self):
+        metrics = Metrics()
+        metrics.frames_in = 3
+        metrics.write_seconds.observe(0.002)
+        text = prometheus_text(metrics)
+        assert "# TYPE async_amqp_frames_in_total counter\nasync_amqp_frames_in_total 3\n" in text
+        assert "async_amqp_connections 0\n" in text
+        assert 'async_amqp_write_seconds_bucket{le="0.001"} 0\n' in text
+        assert 'async_amqp_write_seconds_bucket{le="0.005"} 1\n' in text
+        assert 'async_amqp_write_seconds_bucket{le="+Inf"} 1\n' in text
+        assert "async_amqp_write_seconds_count 1\n" in text
@@ -0,0 +1,83 @@
+"""
+    Test the connection pool
+"""
+
+import anyio
+import pytest
+
+from async_amqp import connect_pool, exceptions
+from async_amqp.metrics import Metrics
+from async_amqp.testing import FakeBroker
+
+
+@pytest.fixture
+async def broker():
+    async with FakeBroker() as broker:
+        yield broker
+
+
+class TestPool:
+
+    @pytest.mark.trio
+    async def test_borrow_without_round_trip(self, broker):
+        metrics = Metrics()
+        async with connect_pool(port=broker.port, connections=2, channels=3, metrics=metrics) as pool:
+            assert len(broker.connections) == 2
+            round_trips = metrics.rpc_seconds.count
+            assert round_trips == 6  # Channel.Open
+
+            borrowed = [await pool.acquire() for _ in range(4)]
+            assert metrics.rpc_seconds.count == round_trips
+            # spread over both connections
+            assert {channel.protocol for channel in borrowed} == set(pool.connections)
+            for channel in borrowed:
+                await pool.release(channel)
+
+            async with pool.channel() as channel:
+                await channel.queue_declare("q")
+                await channel.publish(b"hello", "", routing_key="q")
+        assert [m.body for m in broker.queues["q"].messages] == [b"hello"]
+
+    @pytest.mark.trio
+    async def test_wait_for_channel(self, broker):
+        async with connect_pool(port=broker.port, connections=1, channels=2) as pool:
+            one = await pool.acquire()
+            two = await pool.acquire()
+            got = []
+
+            async with anyio.create_task_group() as tg:
+                async def borrow():
+                    async with pool.channel() as channel:
+                        got.append(channel)
+                await tg.spawn(borrow)
+                await anyio.sleep(0.05)
+                assert got == []
+                await pool.release(two)
+            assert got == [two]
+            await pool.release(one)
+
+    @pytest.mark.trio
+    async def test_replace_closed_channel(self, broker):
+        async with connect_pool(port=broker.port, connections=1, channels=1) as pool:
+            async with pool.channel() as channel:
+                with pytest.raises(exceptions.ChannelClosed):
+                    await channel.queue_declare("missing", passive=True)
+                assert not channel.is_open
+
+            async with anyio.fail_after(5):
+                async with pool.channel() as replacement:
+                    assert replacement.is_open
+                    await replacement.queue_declare("q")
+
+    @pytest.mark.trio
+    async def test_server_channel_max(self):
+        async with FakeBroker(channel_max=2) as broker:
+            async with connect_pool(port=broker.port, connections=1, channels=10) as pool:
+                conn, = pool.connections
+                assert conn.channels_ids_count == 2
+
+    @pytest.mark.trio
+    async def test_wrong_size(self, broker):
+        with pytest.raises(ValueError):
+            async with connect_pool(port=broker.port, connections=0):
+                pass
@@ -0,0 +1,107 @@
+"""
+    Test encoding and decoding message properties
+"""
+
+import time
+from decimal import Decimal
+
+import pamqp.decode
+import pamqp.specification
+import pytest
+
+from async_amqp import connect_amqp
+from async_amqp import properties as amqp_properties
+from async_amqp.constants import MESSAGE_PROPERTIES
+from async_amqp.properties import Properties
+from async_amqp.testing import FakeBroker
+
+ALL = dict(
+    content_type='application/json',
+    content_encoding='gzip',
+    headers={'x-retries': 3, 'nested': {'ok': True}, 'name': b'caf\xc3\xa9'},
+    delivery_mode=2,
+    priority=5,
+    correlation_id='c1',
+    reply_to='replies',
+    expiration='60000',
+    message_id='m1',
+    timestamp=time.gmtime(1600000000),
+    message_type='event',
+    user_id='guest',
+    app_id='app',
+    cluster_id='',
+)
+
+
+class TestPropertyCodec:
+
+    @pytest.mark.parametrize("properties", [
+        {},
+        {'message_id': 'm1'},
+        {'priority': 0, 'reply_to': 'r'},
+        ALL,
+    ])
+    def test_same_as_pamqp(self, properties):
+        expected = pamqp.specification.Basic.Properties(**properties).marshal()
+        assert amqp_properties.encode(properties) == expected
+        assert amqp_properties.encode(Properties(**properties)) == expected
+
+    def test_dict_order(self):
+        assert amqp_properties.encode({'app_id': 'a', 'content_type': 't'}) == \
+            amqp_properties.encode({'content_type': 't', 'app_id': 'a'})
+
+    def test_none(self):
+        assert amqp_properties.encode(None) == b'\x00\x00'
+
+    def test_unknown_property(self):
+        with pytest.raises(TypeError):
+            amqp_properties.encode({'message_idd': 'm1'})
+
+    def test_roundtrip(self):
+        data = b'xyz' + amqp_properties.encode(ALL)
+        props = amqp_properties.decode(memoryview(data), 3)
+        for name in MESSAGE_PROPERTIES:
+            if name == 'cluster_id':
+                assert props.cluster_id is None
+            elif name == 'headers':
+                assert props.headers == {'x-retries': 3, 'nested': {'ok': True}, 'name': b'caf\xc3\xa9'}
+            else:
+                assert getattr(props, name) == ALL[name]
+
+    def test_headers_decoded_on_access(self):
+        props = amqp_properties.decode(amqp_properties.encode({'headers': {'a': 1}}))
+        assert props._raw_headers is not None
+        assert props.headers == {'a': 1}
+        assert props._raw_headers is None
+
+        props.headers = {'b': 2}
+        assert amqp_properties.decode(amqp_properties.encode(props)).headers == {'b': 2}
+
+    def test_no_headers(self):
+        props = amqp_properties.decode(amqp_properties.encode({'app_id': 'a'}))
+        assert props.headers is None
+        assert props.app_id == 'a'
+
+    def test_forward_raw_headers(self, monkeypatch):
+        data = amqp_properties.encode({'headers': {'price': Decimal('1.50'), 'n': 1}, 'app_id': 'a'})
+        props = amqp_properties.decode(data)
+
+        def fail(value):
+            raise AssertionError("headers were decoded")
+        monkeypatch.setattr(pamqp.decode, 'field_table', fail)
+        props.app_id = 'b'
+        assert amqp_properties.encode(props) == data.replace(b'\x01a', b'\x01b')
+        assert props._raw_headers is not None
+
+    @pytest.mark.trio
+    async def test_republish(self):
+        async with FakeBroker() as broker, connect_amqp(port=broker.port) as amqp:
+            async with amqp.new_channel() as channel:
+                await channel.queue_declare("in")
+                await channel.queue_declare("out")
+                await channel.publish(b"x", "", "in", properties={'headers': {'hops': 1}})
+
+                result = await channel.basic_get("in", no_ack=True)
+                await channel.publish(result['message'], "", "out", properties=result['properties'])
+                result = await channel.basic_get("out", no_ack=True)
+                assert result['properties'].headers == {'hops': 1}
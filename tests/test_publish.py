@@ -58,6 +58,95 @@ class TestPublish(testcase.RabbitTestCase):
 
         await self.check_messages(channel.protocol, "q", 1)
 
+    @pytest.mark.trio
+    async def test_publish_burst_keeps_order(self, channel):
+        # declare
+        await channel.queue_declare("q", exclusive=True, no_wait=False)
+        await channel.exchange_declare("e", "fanout")
+        await channel.queue_bind("q", "e", routing_key='')
+
+        # publish faster than the writer can send, so that frames get batched
+        for i in range(200):
+            await channel.publish(b"msg%d" % i, "e", routing_key='')
+
+        for i in range(200):
+            result = await channel.basic_get("q", no_ack=True)
+            assert result['message'] == b"msg%d" % i
+
+    @pytest.mark.trio
+    async def test_publish_many(self, channel):
+        # declare
+        await channel.queue_declare("q", exclusive=True, no_wait=False)
+        await channel.exchange_declare("e", "fanout")
+        await channel.queue_bind("q", "e", routing_key='')
+
+        # publish
+        res = await channel.publish_many(
+            [(b"msg%d" % i, "e", '') for i in range(50)]
+            + [dict(payload=b"last", exchange_name="e", routing_key='')]
+        )
+        assert res is None
+
+        for i in range(50):
+            result = await channel.basic_get("q", no_ack=True)
+            assert result['message'] == b"msg%d" % i
+        result = await channel.basic_get("q", no_ack=True)
+        assert result['message'] == b"last"
+
+    @pytest.mark.trio
+    async def test_confirmed_publish_many(self, channel):
+        # declare
+        await channel.confirm_select()
+        await channel.queue_declare("q", exclusive=True, no_wait=False)
+        await channel.exchange_declare("e", "fanout")
+        await channel.queue_bind("q", "e", routing_key='')
+
+        # publish
+        futures = await channel.publish_many((b"coucou", "e", '') for _ in range(10))
+        assert len(futures) == 10
+        for fut in futures:
+            await fut()
+
+        result = await channel.queue_declare("q", passive=True)
+        assert result['message_count'] == 10
+
+    @pytest.mark.trio
+    async def test_publish_from(self, channel):
+        # declare
+        await channel.confirm_select()
+        await channel.queue_declare("q", exclusive=True, no_wait=False)
+        await channel.exchange_declare("e", "fanout")
+        await channel.queue_bind("q", "e", routing_key='')
+
+        async def messages():
+            for i in range(25):
+                yield (b"msg%d" % i, "e", '')
+
+        # publish
+        assert await channel.publish_from(messages(), batch_size=10) == 25
+
+        result = await channel.queue_declare("q", passive=True)
+        assert result['message_count'] == 25
+
+    @pytest.mark.trio
+    async def test_pipelined_confirms(self, channel):
+        # declare
+        await channel.confirm_select(max_in_flight=5)
+        await channel.queue_declare("q", exclusive=True, no_wait=False)
+        await channel.exchange_declare("e", "fanout")
+        await channel.queue_bind("q", "e", routing_key='')
+
+        # publish
+        futures = []
+        for _ in range(20):
+            futures.append(await channel.publish(b"coucou", "e", routing_key=''))
+        futures.extend(await channel.publish_many((b"coucou", "e", '') for _ in range(12)))
+        await channel.wait_for_confirms()
+        assert all(fut.done() for fut in futures)
+
+        result = await channel.queue_declare("q", passive=True)
+        assert result['message_count'] == 32
+
 
     @pytest.mark.skip("This callback doesn't exist in async_amqp")
     @pytest.mark.trio
@@ -0,0 +1,125 @@
+"""
+    Test reconnection and topology recovery
+"""
+
+import anyio
+import pytest
+
+from async_amqp.robust import connect_robust
+from async_amqp.testing import FakeBroker
+
+
+async def wait_reconnected(conn, reconnects=1):
+    async with anyio.fail_after(5):
+        while conn.reconnects < reconnects or not conn.is_connected:
+            await anyio.sleep(0.01)
+
+
+class TestRobust:
+
+    @pytest.mark.trio
+    async def test_recover_topology_and_consumer(self):
+        async with FakeBroker() as broker:
+            hosts = ["127.0.0.1:%d" % broker.port]
+            async with connect_robust(hosts, reconnect_delay=0.01) as conn:
+                async with conn.new_channel() as channel:
+                    await channel.exchange_declare("events", "topic")
+                    await channel.queue_declare("q", exclusive=True)
+                    await channel.queue_bind("q", "events", routing_key="a.*")
+                    await channel.basic_qos(prefetch_count=3)
+
+                    received = []
+                    events = [anyio.create_event(), anyio.create_event()]
+
+                    async def callback(channel, body, envelope, properties):
+                        received.append(body)
+                        await channel.basic_client_ack(envelope.delivery_tag)
+                        await events[len(received) - 1].set()
+
+                    result = await channel.basic_consume(callback, queue_name="q")
+                    await channel.publish(b"one", "events", routing_key="a.b")
+                    async with anyio.fail_after(5):
+                        await events[0].wait()
+
+                    await broker.drop_connections()
+                    await wait_reconnected(conn)
+
+                    # the exclusive queue was deleted along with the old
+                    # connection, and is back with its binding and consumer
+                    queue = broker.queues["q"]
+                    assert [binding[:2] for binding in broker.exchanges["events"].bindings] == [(queue, "a.*")]
+                    assert [consumer.tag for consumer in queue.consumers] == [result['consumer_tag']]
+                    await channel.publish(b"two", "events", routing_key="a.c")
+                    async with anyio.fail_after(5):
+                        await events[1].wait()
+                    assert received == [b"one", b"two"]
+                    assert channel.channel.prefetch_count == 3
+
+    @pytest.mark.trio
+    async def test_server_named_queue(self):
+        async with FakeBroker() as broker:
+            async with connect_robust([("127.0.0.1", broker.port)], reconnect_delay=0.01) as conn:
+                async with conn.new_channel() as channel:
+                    first = (await channel.queue_declare("", exclusive=True))['queue']
+                    await channel.queue_bind(first, "amq.fanout", routing_key="")
+
+                    await broker.drop_connections()
+                    await wait_reconnected(conn)
+
+                    assert first not in broker.queues
+                    await channel.publish(b"hello", "amq.fanout", routing_key="")
+                    # the old name still works
+                    result = await channel.basic_get(first, no_ack=True)
+                    assert result['message'] == b"hello"
+
+    @pytest.mark.trio
+    async def test_publish_buffer_and_failover(self):
+        async with FakeBroker() as standby, FakeBroker() as primary:
+            hosts = [("127.0.0.1", primary.port), ("127.0.0.1", standby.port)]
+            async with connect_robust(hosts, reconnect_delay=0.2, publish_buffer=5) as conn:
+                async with conn.new_channel() as channel:
+                    await channel.queue_declare("q")
+                    assert "q" in primary.queues
+
+                    await primary.stop()
+                    async with anyio.fail_after(5):
+                        while conn.is_connected:
+                            await anyio.sleep(0.01)
+                    for i in range(3):
+                        await channel.publish(b"%d" % i, "", routing_key="q")
+                    assert len(channel._buffer) == 3
+
+                    await wait_reconnected(conn)
+                    await channel.queue_declare("q", passive=True)
+                    assert [m.body for m in standby.queues["q"].messages] == [b"0", b"1", b"2"]
+
+    @pytest.mark.trio
+    async def test_no_hosts(self):
+        with pytest.raises(ValueError):
+            async with connect_robust([]):
+                pass
+
+    @pytest.mark.trio
+    async def test_publish_during_drop(self):
+        async with FakeBroker() as broker:
+            hosts = [("127.0.0.1", broker.port)]
+            async with connect_robust(hosts, reconnect_delay=0.01, write_batch_frames=1) as conn:
+                async with conn.new_channel() as channel:
+                    await channel.queue_declare("q")
+                    payload = bytes(1000000)
+                    published = 0
+
+                    async def publish():
+                        nonlocal published
+                        while published < 6:
+                            await channel.publish(payload, "", routing_key="q")
+                            published += 1
+
+                    async with anyio.fail_after(10):
+                        async with anyio.create_task_group() as tg:
+                            await tg.spawn(publish)
+                            for _ in range(3):
+                                await anyio.sleep(0.01)
+                                await broker.drop_connections()
+                    # none of the publishes got stuck on a dropped connection
+                    assert published == 6